@@ -6,6 +6,7 @@ from service_catalog.service_catalog_cicd_stack import ServiceCatalogCICDStack
 from service_catalog.service_catalog_cicd_dependency import ServiceCatalogCICDDependency
 from service_catalog.billing_report_stack import ReportStack
 from service_catalog.sagemaker_with_git import SagemakerDevGit
+from service_catalog.layer_size_report import report_layer_sizes
 
 # ===============================
 # MDP Account IDs
@@ -61,4 +62,7 @@ SagemakerDevGit(
     app, "hd-datascience-product-git-{}".format(product_branch), branch=product_branch
 )
 
-app.synth()
+assembly = app.synth()
+
+# Bundled layers and their impact on the 250 MB limit of each function
+report_layer_sizes(assembly)
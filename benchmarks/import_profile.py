@@ -0,0 +1,100 @@
+"""Import-time profile of the Lambda handlers, i.e. the cold start before the handler runs.
+
+Every handler module is imported in fresh interpreters with python -X importtime,
+like a new Lambda container would do. The script reports the median cumulative
+import time and the number of boto3 clients created during the import.
+
+Usage (from the repository root):
+    python benchmarks/import_profile.py
+    python benchmarks/import_profile.py --runs 20
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER_PATH = os.path.join(
+    REPOSITORY_ROOT, "src/lambda_layer/python/lib/python3.7/site-packages"
+)
+
+# Handler module and its code directory
+HANDLERS = {
+    "sync_catalog": "src/lambda/update_servicecatalog",
+    "git_metadata": "src/lambda/git_metadata",
+    "principal_management": "src/lambda/principal_management",
+    "remove_portfolio": "src/lambda/remove_portfolio",
+}
+
+# Counts the clients created while importing the handler module
+IMPORT_SCRIPT = """
+import botocore.session
+created_clients = []
+create_client = botocore.session.Session.create_client
+def counting_create_client(self, service_name, *args, **kwargs):
+    created_clients.append(service_name)
+    return create_client(self, service_name, *args, **kwargs)
+botocore.session.Session.create_client = counting_create_client
+import {module}
+print(len(created_clients))
+"""
+
+
+def profile_import(module: str, code_path: str):
+    """Import a handler module in a fresh interpreter.
+
+    Args:
+        module: Name of the handler module
+        code_path: Directory of the handler module within the repository
+
+    Returns:
+        import_time: Cumulative import time of the module in milliseconds
+        clients: Number of boto3 clients created during the import
+    """
+    env = dict(os.environ)
+    env.update(
+        {
+            "PYTHONPATH": os.pathsep.join(
+                [os.path.join(REPOSITORY_ROOT, code_path), LAYER_PATH]
+            ),
+            "AWS_DEFAULT_REGION": env.get("AWS_DEFAULT_REGION", "eu-central-1"),
+            "LOG_LEVEL": "WARNING",
+        }
+    )
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_SCRIPT.format(module=module)],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    # import time: self [us] | cumulative | imported package
+    for line in process.stderr.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000, int(process.stdout.split()[-1])
+    raise RuntimeError("No import time found for {}".format(module))
+
+
+def main():
+    """Print the import-time profile of all handlers."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    print("{:<24} {:>12} {:>8}".format("handler", "import [ms]", "clients"))
+    for module, code_path in HANDLERS.items():
+        results = [profile_import(module, code_path) for _ in range(args.runs)]
+        print(
+            "{:<24} {:>12.1f} {:>8}".format(
+                module,
+                statistics.median(import_time for import_time, _ in results),
+                results[0][1],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
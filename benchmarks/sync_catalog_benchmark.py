@@ -0,0 +1,749 @@
+"""Offline benchmark of service_catalog_janitor for growing portfolios.
+
+The janitor runs against in-memory fakes of Service Catalog, S3, SQS and CodePipeline,
+which answer every API call at the before-call event of botocore. Nothing is sent
+over the network. Each scenario reports the wall time, the API calls per operation
+and the peak memory of one janitor invocation. The fan-out scenarios deliver the
+work items of the sync queue to process_work_items() within the same process.
+
+Usage (from the repository root):
+    python benchmarks/sync_catalog_benchmark.py                 # compare with baselines
+    python benchmarks/sync_catalog_benchmark.py --save          # update the baselines
+    python benchmarks/sync_catalog_benchmark.py --check --sizes 10 100
+"""
+import argparse
+import configparser
+import datetime
+import glob
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+import zipfile
+
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+
+# The clients are created at import time, so the environment has to be set first
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("LOCAL_ROLE_NAME_SC", "ServiceCatalogLaunchRole")
+# Measure the sync itself, not the rate limiter
+os.environ.setdefault("API_READ_RATE", "1000000")
+os.environ.setdefault("API_WRITE_RATE", "1000000")
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(
+    0,
+    os.path.join(
+        REPOSITORY_ROOT, "src/lambda_layer/python/lib/python3.7/site-packages"
+    ),
+)
+sys.path.insert(0, os.path.join(REPOSITORY_ROOT, "src/lambda/update_servicecatalog"))
+
+import servicecatalog  # noqa: E402
+import sync_catalog  # noqa: E402
+
+BASELINE_FILE = os.path.join(REPOSITORY_ROOT, "benchmarks", "baselines.json")
+
+# Synthetic repository layout within the source artifact
+PRODUCTS_PATH = "service_catalog/products/"
+CONFIG_PATH = "service_catalog/config/config_benchmark.ini"
+TEMPLATE_PREFIX = "benchmark_product_"
+
+ARTIFACT_BUCKET = "benchmark-artifact-bucket"
+ARTIFACT_KEY = "source/artifact.zip"
+MANIFEST_KEY = "change-manifests/benchmark-job.json"
+PORTFOLIO_ID = "port-benchmark"
+
+# Wall time and memory above baseline * tolerance are reported as regression
+TOLERANCE = 1.5
+
+TEMPLATE_BODY = """AWSTemplateFormatVersion: "2010-09-09"
+Description: Synthetic benchmark product {index}
+Resources:
+  Bucket:
+    Type: AWS::S3::Bucket
+    Properties:
+      BucketName: !Sub "${{AWS::AccountId}}-benchmark-{index}-{revision}"
+"""
+
+
+class FakeAwsError(Exception):
+    """Error response of a fake API call."""
+
+    def __init__(self, code: str, status_code: int = 400):
+        """Init the error.
+
+        Args:
+            code: AWS error code
+            status_code: HTTP status code
+        """
+        super().__init__(code)
+        self.code = code
+        self.status_code = status_code
+
+
+class LocalSyncQueue:
+    """Stand-in for the sync queue and its SQS event sources.
+
+    Work items are delivered one by one to process_work_items(), like the event source
+    with a batch size of 1 does. A work item, which fails MAX_RECEIVE_COUNT times, is
+    moved to the dead-letter queue and handed to process_dead_letters().
+    """
+
+    # maxReceiveCount of the redrive policy of ServiceCatalogSyncQueue
+    MAX_RECEIVE_COUNT = 5
+
+    def __init__(self):
+        """Init an empty queue."""
+        self.messages = queue.Queue()
+        self.dead_letters = []
+        self._worker = None
+
+    def send_message_batch(self, params):
+        """Queue the work items and start the worker."""
+        for entry in params["Entries"]:
+            self.messages.put(entry["MessageBody"])
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._work, daemon=True)
+            self._worker.start()
+        return {
+            "Successful": [
+                {"Id": entry["Id"], "MessageId": entry["Id"], "MD5OfMessageBody": ""}
+                for entry in params["Entries"]
+            ],
+            "Failed": [],
+        }
+
+    def _work(self):
+        while True:
+            body = self.messages.get()
+            event = {"Records": [{"body": body}]}
+            try:
+                for _ in range(self.MAX_RECEIVE_COUNT):
+                    try:
+                        sync_catalog.process_work_items.__wrapped__(event, None)
+                        break
+                    except Exception as e:
+                        print("    Work item failed ... {}".format(e))
+                else:
+                    self.dead_letters.append(body)
+                    sync_catalog.process_dead_letters.__wrapped__(event, None)
+            finally:
+                self.messages.task_done()
+
+    def wait(self):
+        """Block until every queued work item has been processed."""
+        self.messages.join()
+
+
+class FakeAws:
+    """In-memory state of Service Catalog, S3, SQS and CodePipeline for one scenario."""
+
+    def __init__(self):
+        """Init empty services."""
+        self.sync_queue = LocalSyncQueue()
+        self.products = {}
+        self.portfolio_products = []
+        self.constraints = {}
+        self.objects = {}
+        self.tags = {}
+        self.job_results = []
+        self._ids = 0
+        self.handlers = {
+            "SearchProductsAsAdmin": self.search_products_as_admin,
+            "ListConstraintsForPortfolio": self.list_constraints_for_portfolio,
+            "DescribeConstraint": self.describe_constraint,
+            "CreateConstraint": self.create_constraint,
+            "DeleteConstraint": self.delete_constraint,
+            "CreateProduct": self.create_product,
+            "DeleteProduct": self.delete_product,
+            "AssociateProductWithPortfolio": self.associate_product_with_portfolio,
+            "AssociatePrincipalWithPortfolio": lambda params: {},
+            "ListProvisioningArtifacts": self.list_provisioning_artifacts,
+            "CreateProvisioningArtifact": self.create_provisioning_artifact,
+            "UpdateProvisioningArtifact": lambda params: {},
+            "DeleteProvisioningArtifact": self.delete_provisioning_artifact,
+            "SearchProvisionedProducts": lambda params: {"ProvisionedProducts": []},
+            "DescribePortfolioShares": lambda params: {"PortfolioShareDetails": []},
+            "ListPortfolioAccess": lambda params: {"AccountIds": []},
+            "HeadObject": self.head_object,
+            "GetObject": self.get_object,
+            "PutObject": self.put_object,
+            "DeleteObject": self.delete_object,
+            "ListObjectsV2": self.list_objects_v2,
+            "GetObjectTagging": self.get_object_tagging,
+            "PutObjectTagging": self.put_object_tagging,
+            "PutJobSuccessResult": self.put_job_success_result,
+            "PutJobFailureResult": self.put_job_failure_result,
+            "SendMessageBatch": self.sync_queue.send_message_batch,
+        }
+
+    def attach(self, client):
+        """Answer all calls of a client from this fake.
+
+        The handler is registered last, so the rate limiter and the API call
+        metrics of the layer still see every call.
+
+        Args:
+            client: A boto3 client or ThrottledClient
+
+        Returns:
+            No return.
+        """
+        client.meta.events.unregister(
+            "before-parameter-build", unique_id="benchmark-fake-params"
+        )
+        client.meta.events.register(
+            "before-parameter-build",
+            self._keep_params,
+            unique_id="benchmark-fake-params",
+        )
+        client.meta.events.unregister("before-call", unique_id="benchmark-fake")
+        client.meta.events.register_last(
+            "before-call", self._handle, unique_id="benchmark-fake"
+        )
+
+    @staticmethod
+    def _keep_params(params, context, **kwargs):
+        # before-call only gets the serialised request
+        context["benchmark_params"] = dict(params)
+
+    def _handle(self, model, context, **kwargs):
+        params = context["benchmark_params"]
+        if model.name not in self.handlers:
+            raise NotImplementedError(
+                "{} is not supported by the benchmark".format(model.name)
+            )
+        status_code = 200
+        try:
+            parsed = self.handlers[model.name](params)
+        except KeyError:
+            status_code = 400
+            parsed = {"Error": {"Code": "ResourceNotFoundException", "Message": ""}}
+        except FakeAwsError as e:
+            status_code = e.status_code
+            parsed = {"Error": {"Code": e.code, "Message": ""}}
+        parsed.setdefault(
+            "ResponseMetadata", {"HTTPStatusCode": status_code, "RetryAttempts": 0}
+        )
+        return AWSResponse(None, status_code, {}, None), parsed
+
+    def _new_id(self, prefix: str):
+        self._ids += 1
+        return "{}-{:08d}".format(prefix, self._ids)
+
+    @staticmethod
+    def _page(items: list, params: dict, page_size: int):
+        start = int(params.get("PageToken") or 0)
+        page_size = params.get("PageSize") or page_size
+        next_token = start + page_size
+        return (
+            items[start:next_token],
+            str(next_token) if next_token < len(items) else None,
+        )
+
+    # Service Catalog
+
+    def add_product(self, name: str, artifacts: int = 2):
+        """Create a product with artifacts and LAUNCH constraint within the portfolio.
+
+        Args:
+            name: Product name
+            artifacts: Number of provisioning artifacts
+
+        Returns:
+            product_id: Id of the new product
+        """
+        product_id = self.create_product({"Name": name})["ProductViewDetail"][
+            "ProductViewSummary"
+        ]["ProductId"]
+        for _ in range(artifacts - 1):
+            self.create_provisioning_artifact({"ProductId": product_id})
+        self.associate_product_with_portfolio({"ProductId": product_id})
+        self.create_constraint(
+            {
+                "ProductId": product_id,
+                "PortfolioId": PORTFOLIO_ID,
+                "Type": "LAUNCH",
+                "Parameters": sync_catalog.parsed_string,
+            }
+        )
+        return product_id
+
+    def search_products_as_admin(self, params):
+        """Page through the products of the portfolio."""
+        products, next_token = self._page(self.portfolio_products, params, 20)
+        response = {
+            "ProductViewDetails": [
+                {
+                    "ProductViewSummary": {
+                        "ProductId": product_id,
+                        "Name": self.products[product_id]["Name"],
+                    }
+                }
+                for product_id in products
+            ]
+        }
+        if next_token:
+            response["NextPageToken"] = next_token
+        return response
+
+    def list_constraints_for_portfolio(self, params):
+        """Page through the constraints of the portfolio."""
+        constraints, next_token = self._page(
+            list(self.constraints.values()), params, 20
+        )
+        response = {"ConstraintDetails": [dict(c["Detail"]) for c in constraints]}
+        if next_token:
+            response["NextPageToken"] = next_token
+        return response
+
+    def describe_constraint(self, params):
+        """Return a constraint with its parameters."""
+        constraint = self.constraints[params["Id"]]
+        return {
+            "ConstraintDetail": dict(constraint["Detail"]),
+            "ConstraintParameters": constraint["Parameters"],
+            "Status": "AVAILABLE",
+        }
+
+    def create_constraint(self, params):
+        """Create a constraint."""
+        constraint_id = self._new_id("cons")
+        detail = {
+            "ConstraintId": constraint_id,
+            "Type": params["Type"],
+            "ProductId": params["ProductId"],
+            "PortfolioId": params["PortfolioId"],
+        }
+        self.constraints[constraint_id] = {
+            "Detail": detail,
+            "Parameters": params["Parameters"],
+        }
+        return {"ConstraintDetail": dict(detail), "Status": "CREATING"}
+
+    def delete_constraint(self, params):
+        """Delete a constraint."""
+        del self.constraints[params["Id"]]
+        return {}
+
+    def create_product(self, params):
+        """Create a product with its first provisioning artifact."""
+        product_id = self._new_id("prod")
+        self.products[product_id] = {"Name": params["Name"], "Artifacts": []}
+        artifact = self.create_provisioning_artifact({"ProductId": product_id})
+        return {
+            "ProductViewDetail": {
+                "ProductViewSummary": {"ProductId": product_id, "Name": params["Name"]}
+            },
+            "ProvisioningArtifactDetail": artifact["ProvisioningArtifactDetail"],
+        }
+
+    def delete_product(self, params):
+        """Delete a product."""
+        del self.products[params["Id"]]
+        self.portfolio_products.remove(params["Id"])
+        return {}
+
+    def associate_product_with_portfolio(self, params):
+        """Add a product to the portfolio."""
+        self.portfolio_products.append(params["ProductId"])
+        return {}
+
+    def list_provisioning_artifacts(self, params):
+        """List the provisioning artifacts of a product."""
+        return {
+            "ProvisioningArtifactDetails": list(
+                self.products[params["ProductId"]]["Artifacts"]
+            )
+        }
+
+    def create_provisioning_artifact(self, params):
+        """Add a provisioning artifact to a product."""
+        artifact = {
+            "Id": self._new_id("pa"),
+            "CreatedTime": datetime.datetime(2020, 1, 1)
+            + datetime.timedelta(seconds=self._ids),
+        }
+        self.products[params["ProductId"]]["Artifacts"].append(artifact)
+        return {"ProvisioningArtifactDetail": dict(artifact)}
+
+    def delete_provisioning_artifact(self, params):
+        """Delete a provisioning artifact."""
+        artifacts = self.products[params["ProductId"]]["Artifacts"]
+        artifacts.remove(
+            next(a for a in artifacts if a["Id"] == params["ProvisioningArtifactId"])
+        )
+        return {}
+
+    # S3
+
+    def head_object(self, params):
+        """Return the size of an object."""
+        body = self.objects.get((params["Bucket"], params["Key"]))
+        if body is None:
+            raise FakeAwsError("404", status_code=404)
+        return {"ContentLength": len(body), "ETag": '"{}"'.format(len(body))}
+
+    def get_object(self, params):
+        """Return an object as streaming body."""
+        body = self.objects.get((params["Bucket"], params["Key"]))
+        if body is None:
+            raise FakeAwsError("NoSuchKey", status_code=404)
+        return {
+            "Body": StreamingBody(io.BytesIO(body), len(body)),
+            "ContentLength": len(body),
+            "ETag": '"{}"'.format(len(body)),
+        }
+
+    def put_object(self, params):
+        """Store an object."""
+        body = params.get("Body", b"")
+        if hasattr(body, "read"):
+            body = body.read()
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.objects[(params["Bucket"], params["Key"])] = body
+        return {"ETag": '"{}"'.format(len(body))}
+
+    def delete_object(self, params):
+        """Delete an object."""
+        self.objects.pop((params["Bucket"], params["Key"]), None)
+        return {}
+
+    def list_objects_v2(self, params):
+        """List all object keys with a prefix.
+
+        The sync results are listed after all work items have been processed, so the
+        fan-out scenarios make the same number of calls on every run.
+        """
+        if params.get("Prefix", "").startswith(sync_catalog.SYNC_RESULTS_PATH):
+            self.sync_queue.wait()
+        return {
+            "Contents": [
+                {"Key": key}
+                for bucket, key in sorted(self.objects)
+                if bucket == params["Bucket"]
+                and key.startswith(params.get("Prefix", ""))
+            ]
+        }
+
+    def get_object_tagging(self, params):
+        """Return the tags of an object."""
+        if (params["Bucket"], params["Key"]) not in self.objects:
+            raise FakeAwsError("NoSuchKey", status_code=404)
+        return {"TagSet": self.tags.get((params["Bucket"], params["Key"]), [])}
+
+    def put_object_tagging(self, params):
+        """Replace the tags of an object."""
+        self.tags[(params["Bucket"], params["Key"])] = params["Tagging"]["TagSet"]
+        return {}
+
+    # CodePipeline
+
+    def put_job_success_result(self, params):
+        """Record the successful job."""
+        self.job_results.append("Succeeded")
+        return {}
+
+    def put_job_failure_result(self, params):
+        """Record the failed job."""
+        self.job_results.append(params["failureDetails"]["message"])
+        return {}
+
+
+def build_source_artifact(templates: list, revision: int):
+    """Zip the synthetic templates and their config.ini like the CodePipeline source.
+
+    Args:
+        templates: Template paths within the repository
+        revision: Changes the template bodies between commits
+
+    Returns:
+        The zip archive as bytes
+    """
+    config = configparser.ConfigParser()
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for index, template in enumerate(templates):
+            file_name = os.path.basename(template)
+            archive.writestr(
+                template, TEMPLATE_BODY.format(index=index, revision=revision)
+            )
+            config[file_name] = {
+                "Name": os.path.splitext(file_name)[0],
+                "Owner": "Benchmark",
+                "Description": "Synthetic benchmark product",
+                "SupportDescription": "None",
+                "SupportEmail": "benchmark@example.com",
+                "SupportUrl": "https://example.com",
+                "ProductType": "CLOUD_FORMATION_TEMPLATE",
+                "Key_1": "app",
+                "Value_1": "Benchmark",
+                "Version": "0.{}".format(revision),
+                "Diff_Description": "Revision {}".format(revision),
+                "TemplateURL": "https://example.com/{}".format(file_name),
+            }
+        config_file = io.StringIO()
+        config.write(config_file)
+        archive.writestr(CONFIG_PATH, config_file.getvalue())
+    return buffer.getvalue()
+
+
+def prepare_scenario(products: int, touched: int, resync: bool, fan_out: bool):
+    """Set up a portfolio and the CodePipeline event of a commit.
+
+    Args:
+        products: Number of products within the portfolio
+        touched: Number of modified templates within the commit
+        resync: Sync the commit once beforehand, so all templates are unchanged
+        fan_out: Apply the plan through the local sync queue
+
+    Returns:
+        fake: The FakeAws with the portfolio
+        event: The CodePipeline event for service_catalog_janitor
+    """
+    fake = FakeAws()
+    templates = [
+        "{}{}{:04d}.yaml".format(PRODUCTS_PATH, TEMPLATE_PREFIX, index)
+        for index in range(products)
+    ]
+    for template in templates:
+        fake.add_product(name=os.path.splitext(os.path.basename(template))[0])
+    fake.objects[(ARTIFACT_BUCKET, ARTIFACT_KEY)] = build_source_artifact(
+        templates=templates, revision=1
+    )
+    fake.objects[(ARTIFACT_BUCKET, MANIFEST_KEY)] = json.dumps(
+        {
+            "Changes": [
+                {"ChangeType": "M", "Path": template}
+                for template in templates[:touched]
+            ]
+        }
+    ).encode("utf-8")
+    user_parameters = {
+        "portfolio_id": PORTFOLIO_ID,
+        "change_manifest": MANIFEST_KEY,
+        "commit_id": uuid.uuid4().hex,
+        "before_commit": uuid.uuid4().hex,
+    }
+    event = {
+        "CodePipeline.job": {
+            "id": "benchmark-job",
+            "data": {
+                "actionConfiguration": {
+                    "configuration": {"UserParameters": json.dumps(user_parameters)}
+                },
+                "inputArtifacts": [
+                    {
+                        "location": {
+                            "s3Location": {
+                                "bucketName": ARTIFACT_BUCKET,
+                                "objectKey": ARTIFACT_KEY,
+                            }
+                        }
+                    }
+                ],
+            },
+        }
+    }
+    for client in [
+        sync_catalog.auto_servicecatalog_client,
+        sync_catalog.auto_s3_client,
+        sync_catalog.auto_codepipeline_client,
+        sync_catalog.auto_sqs_client,
+    ]:
+        fake.attach(client)
+    sync_catalog.SYNC_QUEUE_URL = "local-sync-queue" if fan_out else None
+    if resync:
+        invoke_janitor(fake=fake, event=event)
+    return fake, event
+
+
+def invoke_janitor(fake: FakeAws, event: dict):
+    """Run one cold invocation of service_catalog_janitor.
+
+    Args:
+        fake: The FakeAws of the scenario
+        event: The CodePipeline event
+
+    Returns:
+        api_calls: Dictionary with the number of calls per service and operation
+    """
+    sync_catalog.state_cache.clear()
+    with servicecatalog.api_metrics_lock:
+        servicecatalog.api_metrics.clear()
+    # The undecorated handler, so the metrics are not printed and reset
+    sync_catalog.service_catalog_janitor.__wrapped__(event, None)
+    if fake.job_results[-1:] != ["Succeeded"]:
+        raise RuntimeError("The sync failed ... {}".format(fake.job_results))
+    return {
+        "{}.{}".format(service, operation): len(metrics["Latency"])
+        for (service, operation), metrics in sorted(servicecatalog.api_metrics.items())
+    }
+
+
+def run_scenario(
+    products: int, touched: int, resync: bool = False, fan_out: bool = False
+):
+    """Measure one scenario.
+
+    The scenario runs twice, as tracemalloc slows down the measured run.
+
+    Args:
+        products: Number of products within the portfolio
+        touched: Number of modified templates within the commit
+        resync: Sync the commit once beforehand, so all templates are unchanged
+        fan_out: Apply the plan through the local sync queue
+
+    Returns:
+        result: Dictionary with wall time, peak memory and API calls
+    """
+    fake, event = prepare_scenario(
+        products=products, touched=touched, resync=resync, fan_out=fan_out
+    )
+    start = time.perf_counter()
+    api_calls = invoke_janitor(fake=fake, event=event)
+    wall_time = time.perf_counter() - start
+
+    fake, event = prepare_scenario(
+        products=products, touched=touched, resync=resync, fan_out=fan_out
+    )
+    tracemalloc.start()
+    invoke_janitor(fake=fake, event=event)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "wall_time_s": round(wall_time, 3),
+        "peak_memory_kib": round(peak_memory / 1024),
+        "total_api_calls": sum(api_calls.values()),
+        "api_calls": api_calls,
+    }
+
+
+def get_scenarios(sizes: list):
+    """Build the scenarios for the portfolio sizes.
+
+    Args:
+        sizes: Numbers of products within the portfolio
+
+    Returns:
+        Dictionary with scenario name and keyword arguments for run_scenario()
+    """
+    scenarios = {}
+    for size in sizes:
+        for touched in sorted({1, max(size // 10, 1), size}):
+            scenarios["{}-products-{}-touched".format(size, touched)] = {
+                "products": size,
+                "touched": touched,
+            }
+        scenarios["{}-products-resync".format(size)] = {
+            "products": size,
+            "touched": size,
+            "resync": True,
+        }
+        if size >= sync_catalog.SYNC_FANOUT_THRESHOLD:
+            scenarios["{}-products-fan-out".format(size)] = {
+                "products": size,
+                "touched": size,
+                "fan_out": True,
+            }
+    return scenarios
+
+
+def compare(name: str, result: dict, baseline: dict):
+    """Print the differences of a scenario to its baseline.
+
+    Args:
+        name: Name of the scenario
+        result: Result from run_scenario()
+        baseline: Stored result of the scenario
+
+    Returns:
+        regressions: List with descriptions of the regressions
+    """
+    regressions = []
+    operations = sorted(set(result["api_calls"]) | set(baseline["api_calls"]))
+    for operation in operations:
+        calls = result["api_calls"].get(operation, 0)
+        baseline_calls = baseline["api_calls"].get(operation, 0)
+        if calls != baseline_calls:
+            print("    {}: {} -> {}".format(operation, baseline_calls, calls))
+            if calls > baseline_calls:
+                regressions.append("{} {}".format(name, operation))
+    for metric in ["wall_time_s", "peak_memory_kib"]:
+        if result[metric] > baseline[metric] * TOLERANCE:
+            print("    {}: {} -> {}".format(metric, baseline[metric], result[metric]))
+            regressions.append("{} {}".format(name, metric))
+    return regressions
+
+
+def main():
+    """Run the benchmark and compare it with or save it as baseline."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument(
+        "--workers", type=int, default=1, help="SYNC_MAX_WORKERS of the janitor"
+    )
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save", action="store_true", help="Update the baselines")
+    parser.add_argument(
+        "--check", action="store_true", help="Exit with 1 on regressions"
+    )
+    args = parser.parse_args()
+
+    sync_catalog.PATH = PRODUCTS_PATH
+    sync_catalog.PATH_INI = CONFIG_PATH
+    sync_catalog.BUCKET = ARTIFACT_BUCKET
+    sync_catalog.S3_PATH = "template-store/"
+    sync_catalog.SANDBOX_ACCOUNT_ID = "123456789012"
+    sync_catalog.SYNC_MAX_WORKERS = args.workers
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+
+    regressions = []
+    try:
+        for name, scenario in get_scenarios(args.sizes).items():
+            result = run_scenario(**scenario)
+            print(
+                "{:<32} {:>8.3f}s {:>8} KiB {:>7} API calls".format(
+                    name,
+                    result["wall_time_s"],
+                    result["peak_memory_kib"],
+                    result["total_api_calls"],
+                )
+            )
+            if name in baselines:
+                regressions += compare(name, result, baselines[name])
+            baselines[name] = result
+    finally:
+        # Remove the templates, which the janitor extracted
+        for file_name in glob.glob("/tmp/{}{}*".format(PRODUCTS_PATH, TEMPLATE_PREFIX)):
+            os.remove(file_name)
+        if os.path.exists("/tmp/" + CONFIG_PATH):
+            os.remove("/tmp/" + CONFIG_PATH)
+
+    if args.save:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+    if regressions:
+        print("Regressions: {}".format(", ".join(regressions)))
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import os
+import sys
+
+# AWS limit for the unpacked size of a function including all of its layers
+UNPACKED_SIZE_LIMIT = 250 * 1024 * 1024
+
+
+def get_directory_size(path: str):
+    """Sum up the size of all files within a directory.
+
+    Args:
+        path: The directory
+
+    Returns:
+        size: Size in bytes
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            size += os.path.getsize(os.path.join(root, file_name))
+    return size
+
+
+def get_asset_size(assembly_directory: str, resource: dict):
+    """Get the unpacked size of the asset behind a resource of the cloud assembly.
+
+    Args:
+        assembly_directory: The cdk.out directory
+        resource: Resource of a synthesized template
+
+    Returns:
+        size: Size in bytes or None, if the resource has no staged asset
+    """
+    asset_path = resource.get("Metadata", {}).get("aws:asset:path")
+    if asset_path is None:
+        return None
+    asset_path = os.path.join(assembly_directory, asset_path)
+    if os.path.isdir(asset_path):
+        return get_directory_size(asset_path)
+    return os.path.getsize(asset_path)
+
+
+def report_layer_sizes(assembly):
+    """Print the unpacked size of every layer and of every function with its layers.
+
+    Functions above the unpacked size limit of Lambda are flagged. The report goes
+    to stderr, so it does not mix with the templates printed by cdk synth.
+
+    Args:
+        assembly: The CloudAssembly returned by app.synth()
+
+    Returns:
+        No return.
+    """
+    mebibyte = 1024 * 1024
+    for stack in assembly.stacks:
+        resources = stack.template.get("Resources", {})
+        layer_sizes = {
+            logical_id: get_asset_size(assembly.directory, resource)
+            for logical_id, resource in resources.items()
+            if resource["Type"] == "AWS::Lambda::LayerVersion"
+        }
+        if not layer_sizes:
+            continue
+        print("Unpacked Lambda sizes of {}:".format(stack.stack_name), file=sys.stderr)
+        for logical_id, size in sorted(layer_sizes.items()):
+            print(
+                "  layer    {:<60} {:>8}".format(
+                    logical_id,
+                    "unknown" if size is None else "{:.1f} MB".format(size / mebibyte),
+                ),
+                file=sys.stderr,
+            )
+        for logical_id, resource in sorted(resources.items()):
+            if resource["Type"] != "AWS::Lambda::Function":
+                continue
+            sizes = [get_asset_size(assembly.directory, resource)] + [
+                layer_sizes.get(layer.get("Ref"))
+                for layer in resource["Properties"].get("Layers", [])
+                if isinstance(layer, dict)
+            ]
+            size = sum(size for size in sizes if size is not None)
+            print(
+                "  function {:<60} {:>5.1f} MB{}".format(
+                    logical_id,
+                    size / mebibyte,
+                    "  EXCEEDS 250 MB" if size > UNPACKED_SIZE_LIMIT else "",
+                ),
+                file=sys.stderr,
+            )
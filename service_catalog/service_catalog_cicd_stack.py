@@ -1,5 +1,6 @@
 from aws_cdk import core
 from aws_cdk import aws_lambda as _lambda
+from aws_cdk import aws_lambda_event_sources as _lambda_event_sources
 from aws_cdk import aws_s3 as _s3
 from aws_cdk import aws_iam as _iam
 from aws_cdk import aws_codecommit as _code
@@ -7,10 +8,40 @@ from aws_cdk import aws_codepipeline as _codepipeline
 from aws_cdk import aws_codepipeline_actions as _codepipeline_actions
 from aws_cdk import aws_codebuild as _codebuild
 from aws_cdk import aws_servicecatalog as _servicecatalog
+from aws_cdk import aws_sqs as _sqs
 from aws_cdk import aws_ssm as _ssm
 
 from cdk_helper import Tags, Lambda
 
+# Layer contents are installed into the python3.7 site-packages of the layer
+LAYER_SITE_PACKAGES = "/asset-output/python/lib/python3.7/site-packages"
+
+# Control-plane layer: servicecatalog.py and its small dependencies
+CONTROL_PLANE_LAYER_BUNDLING = " && ".join(
+    [
+        "pip install --no-cache-dir -r requirements.txt -t {}".format(
+            LAYER_SITE_PACKAGES
+        ),
+        "cp -r python /asset-output/",
+        "find /asset-output/python -name __pycache__ -prune -exec rm -rf {} +",
+        "python -m compileall -q /asset-output/python",
+    ]
+)
+
+# Analytics layer: the control-plane layer plus pandas, numpy and pyarrow, without their
+# tests, with stripped shared objects and precompiled bytecode
+ANALYTICS_LAYER_BUNDLING = " && ".join(
+    [
+        "pip install --no-cache-dir -r requirements.txt -r requirements-analytics.txt -t {}".format(
+            LAYER_SITE_PACKAGES
+        ),
+        "cp -r python /asset-output/",
+        "find /asset-output/python -type d \\( -name tests -o -name __pycache__ \\) -prune -exec rm -rf {} +",
+        "find /asset-output/python -name '*.so' -exec strip --strip-unneeded {} +",
+        "python -m compileall -q /asset-output/python",
+    ]
+)
+
 
 class ServiceCatalogCICDStack(core.Stack):
     """hd-auto-service-catalog."""
@@ -144,6 +175,16 @@ class ServiceCatalogCICDStack(core.Stack):
             default="template-store/",
         )
 
+        # ===============================
+        # Role in the accounts the portfolios are shared with, to check artifact usage
+        artifact_usage_role = core.CfnParameter(
+            self,
+            id="ArtifactUsageRoleName-{}".format(branch),
+            description="Role in the shared accounts, which may search all provisioned products. Leave empty to never prune artifacts of shared portfolios",
+            type="String",
+            default="",
+        )
+
         # ##############################################################
         # Artifacts Bucket
         # ##############################################################
@@ -231,17 +272,38 @@ class ServiceCatalogCICDStack(core.Stack):
         # Lambda Layer
         # ##############################################################
 
-        source_code = _lambda.Code.from_asset("./src/lambda_layer/")
-
+        # Used by all Lambdas of the CICD pipeline
         layer = _lambda.LayerVersion(
             self,
             id="Python3_7_Layer-{}".format(branch),
-            code=source_code,
+            code=_lambda.Code.from_asset(
+                "./src/lambda_layer/",
+                bundling=core.BundlingOptions(
+                    image=_lambda.Runtime.PYTHON_3_7.bundling_docker_image,
+                    command=["bash", "-c", CONTROL_PLANE_LAYER_BUNDLING],
+                ),
+            ),
             compatible_runtimes=[_lambda.Runtime.PYTHON_3_7],
         )
 
         tagging_list.append(layer)
 
+        # Only exported for reporting Lambdas outside of the pipeline
+        analytics_layer = _lambda.LayerVersion(
+            self,
+            id="Python3_7_AnalyticsLayer-{}".format(branch),
+            code=_lambda.Code.from_asset(
+                "./src/lambda_layer/",
+                bundling=core.BundlingOptions(
+                    image=_lambda.Runtime.PYTHON_3_7.bundling_docker_image,
+                    command=["bash", "-c", ANALYTICS_LAYER_BUNDLING],
+                ),
+            ),
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_7],
+        )
+
+        tagging_list.append(analytics_layer)
+
         # ##############################################################
         # CodeBuild Project
         # ##############################################################
@@ -333,7 +395,7 @@ class ServiceCatalogCICDStack(core.Stack):
             amount_of_retries=0,
             rules_to_invoke=None,
             events_to_invoke=None,
-            lambda_layers_to_use=None,
+            lambda_layers_to_use=[layer],
             policy_statements=[remove_portfolio_policy, iam_policy],
             log_retention=None,
             environment_vars=[
@@ -437,6 +499,7 @@ class ServiceCatalogCICDStack(core.Stack):
                 "servicecatalog:UpdateProvisioningArtifact",
                 "servicecatalog:DeleteProvisioningArtifact",
                 "servicecatalog:ListProvisioningArtifacts",
+                "servicecatalog:SearchProvisionedProducts",
                 "servicecatalog:ListPortfolios",
                 "servicecatalog:SearchProductsAsAdmin",
                 "servicecatalog:AssociateProductWithPortfolio",
@@ -448,7 +511,10 @@ class ServiceCatalogCICDStack(core.Stack):
                 "servicecatalog:AcceptPortfolioShare",
                 "servicecatalog:CreateConstraint",
                 "servicecatalog:DeleteConstraint",
+                "servicecatalog:DescribeConstraint",
                 "servicecatalog:ListConstraintsForPortfolio",
+                "servicecatalog:ListPortfolioAccess",
+                "servicecatalog:DescribePortfolioShares",
             ],
             resources=["*"],
         )
@@ -463,6 +529,14 @@ class ServiceCatalogCICDStack(core.Stack):
             ],
         )
 
+        artifact_usage_policy = _iam.PolicyStatement(
+            effect=_iam.Effect.ALLOW,
+            actions=["sts:AssumeRole"],
+            resources=[
+                "arn:aws:iam::*:role/{}".format(artifact_usage_role.value_as_string)
+            ],
+        )
+
         codepipeline_policy = _iam.PolicyStatement(
             effect=_iam.Effect.ALLOW,
             actions=[
@@ -528,6 +602,7 @@ class ServiceCatalogCICDStack(core.Stack):
                 codebuild_policy,
                 codepipeline_policy,
                 service_catalog_policy,
+                s3_policy,
             ],
             log_retention=None,
             environment_vars=[
@@ -535,6 +610,9 @@ class ServiceCatalogCICDStack(core.Stack):
                     "Key": "REPOSITORY_NAME",
                     "Value": "{}".format(service_catalog_git.repository_name),
                 },
+                {"Key": "PRODUCTS_PATH", "Value": path_name.value_as_string},
+                {"Key": "PATH_INI", "Value": path_ini.value_as_string},
+                {"Key": "BUCKET", "Value": artifact_bucket.bucket_name},
             ],
         )
 
@@ -572,6 +650,46 @@ class ServiceCatalogCICDStack(core.Stack):
         # ==========================
         # Sync Service Catalog Lambda
 
+        # Work items, which failed three times, are recorded as failed sync results
+        sync_dead_letter_queue = _sqs.Queue(
+            self,
+            "ServiceCatalogSyncDeadLetterQueue-{}".format(branch),
+            queue_name="ServiceCatalogSyncDeadLetterQueue-{}".format(branch),
+            visibility_timeout=core.Duration.seconds(720),
+            retention_period=core.Duration.days(14),
+        )
+
+        # Work items of large syncs, processed by the sync workers. Receives, which
+        # are throttled by the reserved concurrency of the workers, count towards
+        # maxReceiveCount as well, which is therefore at least 5, as AWS recommends
+        sync_queue = _sqs.Queue(
+            self,
+            "ServiceCatalogSyncQueue-{}".format(branch),
+            queue_name="ServiceCatalogSyncQueue-{}".format(branch),
+            visibility_timeout=core.Duration.seconds(720),
+            dead_letter_queue=_sqs.DeadLetterQueue(
+                max_receive_count=5, queue=sync_dead_letter_queue
+            ),
+        )
+
+        sync_environment_vars = [
+            {
+                "Key": "LOCAL_ROLE_NAME_SC",
+                "Value": "{}".format(role_name.value_as_string),
+            },
+            {"Key": "SANDBOX_ACCOUNT_ID", "Value": "{}".format(sandbox_account),},
+            {
+                "Key": "REPOSITORY_NAME",
+                "Value": "{}".format(service_catalog_git.repository_name),
+            },
+            {"Key": "PATH_INI", "Value": "{}".format(path_ini.value_as_string)},
+            {"Key": "PATH", "Value": "{}".format(path_name.value_as_string)},
+            {"Key": "BUCKET", "Value": "{}".format(artifact_bucket.bucket_name)},
+            {"Key": "S3_PATH", "Value": "{}".format(template_store.value_as_string),},
+            {"Key": "SYNC_MAX_WORKERS", "Value": "4"},
+            {"Key": "CHECKPOINT_MARGIN_MS", "Value": "30000"},
+        ]
+
         service_catalog_synchronisation = Lambda.create_lambda(
             self,
             name="UpdateServiceCatalog-{}".format(branch),
@@ -594,27 +712,73 @@ class ServiceCatalogCICDStack(core.Stack):
                 codecommit_policy,
                 iam_policy,
                 s3_policy,
+                artifact_usage_policy,
             ],
             log_retention=None,
-            environment_vars=[
-                {
-                    "Key": "LOCAL_ROLE_NAME_SC",
-                    "Value": "{}".format(role_name.value_as_string),
-                },
-                {"Key": "SANDBOX_ACCOUNT_ID", "Value": "{}".format(sandbox_account),},
-                {
-                    "Key": "REPOSITORY_NAME",
-                    "Value": "{}".format(service_catalog_git.repository_name),
-                },
-                {"Key": "PATH_INI", "Value": "{}".format(path_ini.value_as_string)},
-                {"Key": "PATH", "Value": "{}".format(path_name.value_as_string)},
-                {"Key": "BUCKET", "Value": "{}".format(artifact_bucket.bucket_name)},
+            environment_vars=sync_environment_vars
+            + [
+                {"Key": "SYNC_QUEUE_URL", "Value": sync_queue.queue_url},
+                {"Key": "SYNC_FANOUT_THRESHOLD", "Value": "20"},
                 {
-                    "Key": "S3_PATH",
-                    "Value": "{}".format(template_store.value_as_string),
+                    "Key": "ARTIFACT_USAGE_ROLE_NAME",
+                    "Value": artifact_usage_role.value_as_string,
                 },
             ],
         )
+        sync_queue.grant_send_messages(
+            service_catalog_synchronisation.lambda_function_object
+        )
+
+        service_catalog_sync_worker = Lambda.create_lambda(
+            self,
+            name="UpdateServiceCatalogWorker-{}".format(branch),
+            function_name="UpdateServiceCatalogWorker-{}".format(branch),
+            handler="sync_catalog.process_work_items",
+            code_injection_method=_lambda.Code.asset(
+                path="./src/lambda/update_servicecatalog/"
+            ),
+            lambda_runtime=_lambda.Runtime.PYTHON_3_7,
+            amount_of_memory=512,
+            timeout=120,
+            amount_of_retries=0,
+            rules_to_invoke=None,
+            events_to_invoke=None,
+            lambda_layers_to_use=[layer],
+            policy_statements=[service_catalog_policy, iam_policy, s3_policy,],
+            log_retention=None,
+            environment_vars=sync_environment_vars,
+        )
+        sync_worker_function = service_catalog_sync_worker.lambda_function_object
+        sync_worker_function.add_event_source(
+            _lambda_event_sources.SqsEventSource(queue=sync_queue, batch_size=1)
+        )
+        # The Service Catalog quotas are shared by all workers of the account
+        sync_worker_function.node.default_child.reserved_concurrent_executions = 8
+
+        service_catalog_sync_dead_letters = Lambda.create_lambda(
+            self,
+            name="UpdateServiceCatalogDeadLetters-{}".format(branch),
+            function_name="UpdateServiceCatalogDeadLetters-{}".format(branch),
+            handler="sync_catalog.process_dead_letters",
+            code_injection_method=_lambda.Code.asset(
+                path="./src/lambda/update_servicecatalog/"
+            ),
+            lambda_runtime=_lambda.Runtime.PYTHON_3_7,
+            amount_of_memory=256,
+            timeout=60,
+            amount_of_retries=0,
+            rules_to_invoke=None,
+            events_to_invoke=None,
+            lambda_layers_to_use=[layer],
+            policy_statements=[s3_policy],
+            log_retention=None,
+            environment_vars=sync_environment_vars,
+        )
+        service_catalog_sync_dead_letters.lambda_function_object.add_event_source(
+            _lambda_event_sources.SqsEventSource(
+                queue=sync_dead_letter_queue, batch_size=10
+            )
+        )
 
         # ##############################################################
         # CodePipeline
@@ -651,6 +815,7 @@ class ServiceCatalogCICDStack(core.Stack):
                             user_parameters={
                                 "before_commit": "",
                                 "after_commit": "#{source.CommitId}",
+                                "portfolio_id": portfolio.ref,
                             },
                             variables_namespace="filtered_source",
                         )
@@ -670,16 +835,14 @@ class ServiceCatalogCICDStack(core.Stack):
                                     value="ServiceCatalog-CICD-{}".format(branch),
                                     type=_codebuild.BuildEnvironmentVariableType.PLAINTEXT,
                                 ),
-                                "FILES_ADDED": _codebuild.BuildEnvironmentVariable(
-                                    value="#{filtered_source.added_files}",
-                                    type=_codebuild.BuildEnvironmentVariableType.PLAINTEXT,
-                                ),
-                                "FILES_MODIFIED": _codebuild.BuildEnvironmentVariable(
-                                    value="#{filtered_source.modified_files}",
+                                "CHANGE_MANIFEST": _codebuild.BuildEnvironmentVariable(
+                                    value="s3://{}/#{{filtered_source.change_manifest}}".format(
+                                        artifact_bucket.bucket_name
+                                    ),
                                     type=_codebuild.BuildEnvironmentVariableType.PLAINTEXT,
                                 ),
-                                "FILES_DELETED": _codebuild.BuildEnvironmentVariable(
-                                    value="#{filtered_source.deleted_files}",
+                                "PRODUCTS_PATH": _codebuild.BuildEnvironmentVariable(
+                                    value=path_name.value_as_string,
                                     type=_codebuild.BuildEnvironmentVariableType.PLAINTEXT,
                                 ),
                                 "JOB_ID": _codebuild.BuildEnvironmentVariable(
@@ -720,11 +883,10 @@ class ServiceCatalogCICDStack(core.Stack):
                             lambda_=service_catalog_synchronisation.lambda_function_object,
                             inputs=[source_output],
                             user_parameters={
-                                "modified_files": "#{filtered_source.modified_files}",
-                                "added_files": "#{filtered_source.added_files}",
-                                "deleted_files": "#{filtered_source.deleted_files}",
+                                "change_manifest": "#{filtered_source.change_manifest}",
                                 "job_id": "#{filtered_source.job_id}",
                                 "commit_id": "#{filtered_source.commit_id}",
+                                "before_commit": "#{filtered_source.before_commit}",
                                 "portfolio_id": portfolio.ref,
                             },
                         )
@@ -760,5 +922,13 @@ class ServiceCatalogCICDStack(core.Stack):
                 branch
             ),
             description="Lambda Layer ARN",
+            string_value=analytics_layer.layer_version_arn,
+        )
+
+        _ssm.StringParameter(
+            self,
+            id="LambdaControlPlaneLayerExport-{}".format(branch),
+            parameter_name="/hd/mdp/{}/lambda/layer-servicecatalog".format(branch),
+            description="Lambda Layer ARN without pandas and numpy",
             string_value=layer.layer_version_arn,
         )
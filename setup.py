@@ -27,6 +27,7 @@ setuptools.setup(
         "aws_cdk.aws_cloudwatch_actions==1.51.0",
         "aws_cdk.aws_lambda_event_sources==1.51.0",
         "aws_cdk.aws_sns==1.51.0",
+        "aws_cdk.aws_sqs==1.51.0",
         "aws_cdk.aws_events_targets==1.51.0",
         "aws_cdk.aws_cloudformation==1.51.0",
         "aws_cdk.aws_events==1.51.0",
@@ -1,9 +1,18 @@
 import os
 import logging
 import json
-import boto3
+import hashlib
 
-from servicecatalog import put_job_success, put_job_failure
+from botocore.exceptions import ClientError
+from servicecatalog import (
+    api_metrics_handler,
+    get_last_synced_commit,
+    get_product_key,
+    is_product_template,
+    lazy_client,
+    put_job_success,
+    put_job_failure,
+)
 
 # Set loglevel
 log_level = os.environ.get("LOG_LEVEL", "INFO")
@@ -13,67 +22,88 @@ logger = logging.getLogger(__name__)
 # Define the environment variables for repository name
 REPOSITORY_NAME = os.getenv("REPOSITORY_NAME")
 
+# Artifact bucket and folder of the change manifests, see get_change_manifest_key()
+BUCKET = os.getenv("BUCKET")
+CHANGE_MANIFEST_PATH = os.getenv("CHANGE_MANIFEST_PATH", "change-manifests/")
+
+# Folder of the product templates and path of the config file
+PRODUCTS_PATH = os.getenv("PRODUCTS_PATH")
+PATH_INI = os.getenv("PATH_INI")
+
+# Only changes of the product templates and of the config are relevant
+DIFFERENCE_PATHS = [path.rstrip("/") for path in [PRODUCTS_PATH, PATH_INI] if path]
+
+# Bump, if the format of build_change_manifest() changes, so old manifests are not reused
+CHANGE_MANIFEST_VERSION = "2"
+
 # Set AWS service clients
-client_codecommit = boto3.client("codecommit")
-client_codepipeline = boto3.client("codepipeline")
-client_service_catalog = boto3.client("servicecatalog")
+client_codecommit = lazy_client("codecommit")
+client_codepipeline = lazy_client("codepipeline")
+client_s3 = lazy_client("s3")
+client_service_catalog = lazy_client("servicecatalog")
 
 
-def get_file_changes(repository_name, before_commit_specifier, after_commit_specifier):
+def get_file_changes(
+    repository_name, before_commit_specifier, after_commit_specifier, paths=None
+):
     """Get changes between two commits.
 
+    CodeCommit filters the differences by path, so only pages with relevant
+    changes are fetched. Changes matching several paths are yielded once. A path,
+    which only exists in one of the commits like a new config file, is only passed
+    for this commit, as GetDifferences fails with PathDoesNotExistException else.
+
     Args:
         repository_name: The repository name
         before_commit_specifier: previous commit specifier
         after_commit_specifier: target commit specifier
+        paths: Folders or files to get the changes for, defaults to all
 
     Returns:
-        differences: List with strings/paths of changed/deleted files
+        differences: Generator of CodeCommit differences of changed/deleted files
     """
-    response = None
-    try:
-        if not before_commit_specifier:
-            response = client_codecommit.get_differences(
-                repositoryName=repository_name,
-                afterCommitSpecifier=after_commit_specifier,
-            )
-        else:
-            response = client_codecommit.get_differences(
-                repositoryName=repository_name,
-                beforeCommitSpecifier=before_commit_specifier,
-                afterCommitSpecifier=after_commit_specifier,
-            )
-
-    except Exception as e:
-        logger.exception("Error getting CodeCommit differences: {}".format(e))
-        raise e
-
-    differences = []
-
-    if response is None:
-        return differences
-
-    differences += response["differences"]
-    while "nextToken" in response:
-        try:
-            if not before_commit_specifier:
-                response = client_codecommit.get_differences(
-                    repositoryName=repository_name,
-                    afterCommitSpecifier=after_commit_specifier,
-                    nextToken=response["nextToken"],
-                )
-            else:
-                response = client_codecommit.get_differences(
-                    repositoryName=repository_name,
-                    beforeCommitSpecifier=before_commit_specifier,
-                    afterCommitSpecifier=after_commit_specifier,
-                    nextToken=response["nextToken"],
+    paginator = client_codecommit.get_paginator("get_differences")
+    seen = set()
+    for path in paths or [None]:
+        request = {
+            "repositoryName": repository_name,
+            "afterCommitSpecifier": after_commit_specifier,
+        }
+        if before_commit_specifier:
+            request["beforeCommitSpecifier"] = before_commit_specifier
+        path_filters = [{}]
+        if path and before_commit_specifier:
+            path_filters = [
+                {"beforePath": path, "afterPath": path},
+                {"afterPath": path},
+                {"beforePath": path},
+            ]
+        elif path:
+            path_filters = [{"afterPath": path}]
+        for path_filter in path_filters:
+            try:
+                for page in paginator.paginate(**request, **path_filter):
+                    for difference in page.get("differences", []):
+                        key = (
+                            difference.get("beforeBlob", {}).get("path"),
+                            difference.get("afterBlob", {}).get("path"),
+                        )
+                        if key not in seen:
+                            seen.add(key)
+                            yield difference
+                break
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "PathDoesNotExistException":
+                    logger.exception(
+                        "Error getting CodeCommit differences: {}".format(e)
+                    )
+                    raise e
+                logger.info(
+                    "Path {} does not exist in both commits ... {}".format(path, e)
                 )
-            differences += response.get("differences", [])
-        except Exception as e:
-            logger.exception("Error getting CodeCommit differences: {}".format(e))
-            raise e
-    return differences
+            except Exception as e:
+                logger.exception("Error getting CodeCommit differences: {}".format(e))
+                raise e
 
 
 def get_previous_commit_id(repository_name, commit_id):
@@ -99,37 +129,118 @@ def get_previous_commit_id(repository_name, commit_id):
     return previous_commit_id
 
 
-def get_changes_concatenated(differences_items, change_type):
-    """Get changes concatenated into a comma separated string.
+def build_change_manifest(differences, before_commit: str, after_commit: str):
+    """Describe the changes between two commits for the following pipeline stages.
 
     Args:
-        differences_items: Commit Difference
-        change_type: type of change to filter [A,M,D]
+        differences: Iterable of CodeCommit differences
+        before_commit: previous commit id
+        after_commit: target commit id
 
     Returns:
-        No return.
+        manifest: Dictionary with the commits and one entry per change. ProductKey
+            is the normalized product name of product templates, otherwise None.
+            PreviousProductKey is set for renamed (R) product templates, so the
+            product can be renamed instead of deleted and created again
+    """
+    changes = []
+    for difference in differences:
+        before_blob = difference.get("beforeBlob", {})
+        after_blob = difference.get("afterBlob", {})
+        path = after_blob.get("path", before_blob.get("path"))
+        previous_path = before_blob.get("path")
+        changes.append(
+            {
+                "ChangeType": difference["changeType"],
+                "Path": path,
+                "BeforePath": before_blob.get("path"),
+                "AfterPath": after_blob.get("path"),
+                "BeforeBlobId": before_blob.get("blobId"),
+                "AfterBlobId": after_blob.get("blobId"),
+                "ProductKey": get_product_key(path)
+                if is_product_template(path, PRODUCTS_PATH)
+                else None,
+                "PreviousProductKey": get_product_key(previous_path)
+                if difference["changeType"] == "R"
+                and is_product_template(previous_path, PRODUCTS_PATH)
+                else None,
+            }
+        )
+    return {
+        "Repository": REPOSITORY_NAME,
+        "BeforeCommit": before_commit,
+        "AfterCommit": after_commit,
+        "Changes": changes,
+    }
+
+
+def get_change_manifest_key(before_commit: str, after_commit: str):
+    """Get the S3 key of the change manifest between two commits.
+
+    The diff between two commit ids never changes, so the manifest is addressed by
+    the commit pair. The digest covers everything else the manifest depends on,
+    i.e. the repository, the filtered paths and the manifest format.
+
+    Args:
+        before_commit: previous commit id
+        after_commit: target commit id
+
+    Returns:
+        manifest_key: S3 key of the manifest within the artifact bucket
+    """
+    digest = hashlib.sha256(
+        json.dumps(
+            [CHANGE_MANIFEST_VERSION, REPOSITORY_NAME, PRODUCTS_PATH, DIFFERENCE_PATHS,]
+        ).encode("utf-8")
+    ).hexdigest()[:16]
+    return "{}{}/{}/{}.json".format(
+        CHANGE_MANIFEST_PATH, digest, before_commit, after_commit
+    )
+
+
+def get_cached_change_manifest(manifest_key: str):
+    """Read the change manifest of a commit pair, which has been computed before.
+
+    Args:
+        manifest_key: S3 key from get_change_manifest_key()
+
+    Returns:
+        manifest: Dictionary from build_change_manifest() or None, if not cached
+    """
+    try:
+        response = client_s3.get_object(Bucket=BUCKET, Key=manifest_key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+            return None
+        logger.error("Error reading the cached change manifest: {}".format(e))
+        raise e
+    return json.loads(response["Body"].read())
+
+
+def put_change_manifest(manifest: dict, manifest_key: str):
+    """Store the change manifest of a commit pair in the artifact bucket.
+
+    Args:
+        manifest: Dictionary from build_change_manifest()
+        manifest_key: S3 key from get_change_manifest_key()
+
+    Returns:
+        manifest_key: S3 key of the manifest
     """
-    changes = ""
     try:
-        filtered_changes = [
-            diff for diff in differences_items if diff["changeType"] == change_type
-        ]
-        for diff in filtered_changes:
-            if "afterBlob" in diff:
-                path = diff["afterBlob"]["path"]
-            else:
-                path = diff["beforeBlob"]["path"]
-            change_type = diff["changeType"]
-            if changes == "":
-                changes = path
-            else:
-                changes = "{0},{1}".format(changes, path)
-        return changes
+        client_s3.put_object(
+            Bucket=BUCKET,
+            Key=manifest_key,
+            Body=json.dumps(manifest).encode("utf-8"),
+            ContentType="application/json",
+        )
     except Exception as e:
-        logger.exception(e)
+        logger.error("Error storing the change manifest: {}".format(e))
         raise e
+    return manifest_key
 
 
+@api_metrics_handler
 def get_changes(event, context, client=client_service_catalog):
     """Handle get changes request.
 
@@ -155,11 +266,18 @@ def get_changes(event, context, client=client_service_catalog):
         logger.info(user_parameters)
         before_commit = user_parameters["before_commit"]
         after_commit = user_parameters["after_commit"]
+        portfolio_id = user_parameters.get("portfolio_id")
     except Exception as e:
         logger.exception(e)
         raise e
 
     try:
+        # Diff against the last synced commit, so changes of superseded executions
+        # are synced as well. Fall back to the parent for the first sync.
+        if not before_commit and portfolio_id:
+            before_commit = get_last_synced_commit(
+                bucket=BUCKET, portfolio_id=portfolio_id
+            )
         # attempt to resolve preious commit id in case before_commit is not specified
         if not before_commit:
             before_commit = get_previous_commit_id(repository, after_commit)
@@ -167,26 +285,43 @@ def get_changes(event, context, client=client_service_catalog):
             "Target commit: {}. Before commit: {}".format(after_commit, before_commit)
         )
 
-        differences = get_file_changes(repository, before_commit, after_commit)
-
-        added = get_changes_concatenated(differences, "A")
-        if not added:
-            added = "NoChanges"
-        updated = get_changes_concatenated(differences, "M")
-        if not updated:
-            updated = "NoChanges"
-        deleted = get_changes_concatenated(differences, "D")
-        if not deleted:
-            deleted = "NoChanges"
-
-        logger.info("Files added: {}".format(added))
-        logger.info("Files updated: {}".format(updated))
-        logger.info("Files deleted: {}".format(deleted))
+        manifest_key = get_change_manifest_key(before_commit, after_commit)
+        manifest = get_cached_change_manifest(manifest_key)
+        if manifest is not None:
+            logger.info("Reusing the change manifest {} ...".format(manifest_key))
+        else:
+            manifest = build_change_manifest(
+                get_file_changes(
+                    repository, before_commit, after_commit, paths=DIFFERENCE_PATHS
+                ),
+                before_commit=before_commit,
+                after_commit=after_commit,
+            )
+            put_change_manifest(manifest, manifest_key=manifest_key)
+        for change_type in ["A", "M", "D"]:
+            logger.info(
+                "Files {}: {}".format(
+                    change_type,
+                    [
+                        change["Path"]
+                        for change in manifest["Changes"]
+                        if change["ChangeType"] == change_type
+                    ],
+                )
+            )
+        logger.info(
+            "Files R: {}".format(
+                [
+                    "{} -> {}".format(change["BeforePath"], change["AfterPath"])
+                    for change in manifest["Changes"]
+                    if change["ChangeType"] == "R"
+                ]
+            )
+        )
 
+        # Only a pointer, the manifest may exceed the size limit of output variables
         output_vars = {
-            "added_files": added,
-            "modified_files": updated,
-            "deleted_files": deleted,
+            "change_manifest": manifest_key,
             "job_id": job_id,
             "before_commit": before_commit,
             "after_commit": after_commit,
@@ -1,11 +1,13 @@
 import os
 import logging
-import boto3
 from botocore.exceptions import ClientError
 from servicecatalog import (
+    api_metrics_handler,
     get_user_params,
+    lazy_client,
     put_job_failure,
     put_job_success,
+    throttled_client,
 )
 
 # Set log level
@@ -18,9 +20,8 @@ SANDBOX_ACCOUNT_ID = os.getenv("SANDBOX_ACCOUNT_ID")
 
 # Set AWS service clients for this account
 # For the other accounts, the client will be generated later on within the relevant functions
-auto_servicecatalog_client = boto3.client("servicecatalog")
-auto_codepipeline_client = boto3.client("codepipeline")
-auto_codecommit_client = boto3.client("codecommit")
+auto_servicecatalog_client = throttled_client("servicecatalog")
+auto_codepipeline_client = lazy_client("codepipeline")
 
 # List of standard user roles for each account
 iam_role_list = [
@@ -57,6 +58,7 @@ def disassociate_principal_within_this_account(
             raise e
 
 
+@api_metrics_handler
 def principal_management(event, context):
     """Orchestrate all other functions.
 
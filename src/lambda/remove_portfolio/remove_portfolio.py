@@ -1,7 +1,7 @@
-import boto3
 import os
 import logging
 import cfnresponse  # --> https://stackoverflow.com/questions/49885243/aws-lambda-no-module-named-cfnresponse
+from servicecatalog import api_metrics_handler, escape_and_lower_characters, lazy_client
 
 log_level = os.environ.get("LOG_LEVEL", "DEBUG")
 logging.root.setLevel(logging.getLevelName(log_level))  # type: ignore
@@ -11,10 +11,7 @@ response_data = {}
 # Set global parameter
 SANDBOX_ACCOUNT_ID = os.getenv("SANDBOX_ACCOUNT_ID")
 
-auto_servicecatalog_client = boto3.client("servicecatalog")
-auto_s3_client = boto3.client("s3")
-auto_codepipeline_client = boto3.client("codepipeline")
-auto_codecommit_client = boto3.client("codecommit")
+auto_servicecatalog_client = lazy_client("servicecatalog")
 
 # List of standard user roles for each account
 iam_role_list = [
@@ -22,22 +19,6 @@ iam_role_list = [
 ]
 
 
-def escape_and_lower_characters(text: str):
-    """Format a string for easier comparision.
-
-    Args:
-        text: String with special characters to be escaped
-
-    Return:
-        text: the escaped string
-    """
-    chars = "\\`*_{}[]()>#+-.!$/"
-    for c in chars:
-        text = text.replace(c, "")
-    text = text.lower()
-    return text
-
-
 def list_products_for_portfolio(portfolio_id: str):
     """List a product with the Service Catalog Service.
 
@@ -80,9 +61,10 @@ def delete_product(
     Returns:
         No return.
     """
+    constraint_index = list_constraints_for_portfolio(portfolio_id=portfolio_id)
     for i in product_ids_list:
         try:
-            delete_constraint(product_id=i, portfolio_id=portfolio_id)
+            delete_constraint(constraint_ids=constraint_index.get(i, []))
         except Exception as e:
             logger.error(
                 """
@@ -115,41 +97,47 @@ def delete_product(
             )
 
 
-def delete_constraint(product_id: str, portfolio_id: str):
-    """Delete all product constraints.
+def list_constraints_for_portfolio(portfolio_id: str):
+    """List all constraints of the portfolio once, following every page.
 
     Args:
         portfolio_id: existing portfolio id within the servicecatalog
-        product_id: changing product id
 
     Returns:
-        No return
+        constraint_index: dictionary with product ids as keys and lists of constraint ids as values
     """
+    constraint_index = {}
     try:
-        logger.info("Deleting product constraints ...")
-        constraints_response = auto_servicecatalog_client.list_constraints_for_portfolio(
-            AcceptLanguage="en", PortfolioId=portfolio_id,
-        )
-        logger.info(
-            "Outdated product constraint {} ...".format(
-                constraints_response["ConstraintDetails"]
-            )
+        logger.info("Listing portfolio constraints ...")
+        paginator = auto_servicecatalog_client.get_paginator(
+            "list_constraints_for_portfolio"
         )
+        for page in paginator.paginate(AcceptLanguage="en", PortfolioId=portfolio_id):
+            for constraint in page["ConstraintDetails"]:
+                constraint_index.setdefault(constraint["ProductId"], []).append(
+                    constraint["ConstraintId"]
+                )
     except Exception as e:
         logger.error(
             "Error listing the outdated product from the portfolio ... {}".format(e)
         )
         raise e
-    for i in range(len(constraints_response["ConstraintDetails"])):
-        try:
-            response = auto_servicecatalog_client.delete_constraint(
-                Id=constraints_response["ConstraintDetails"][i]["ConstraintId"]
-            )
-            logger.info("Product constraint {} deleted ...".format(response))
-        except IndexError as e:
-            logger.error(
-                "Error listing portfolio constraint - no one exists... {}".format(e)
-            )
+    logger.info("Outdated product constraints {} ...".format(constraint_index))
+    return constraint_index
+
+
+def delete_constraint(constraint_ids: list):
+    """Delete all product constraints.
+
+    Args:
+        constraint_ids: ids of all constraints of the product
+
+    Returns:
+        No return
+    """
+    for constraint_id in constraint_ids:
+        response = auto_servicecatalog_client.delete_constraint(Id=constraint_id)
+        logger.info("Product constraint {} deleted ...".format(response))
 
 
 def disassociate_principal_within_this_account(
@@ -181,6 +169,7 @@ def disassociate_principal_within_this_account(
             raise e
 
 
+@api_metrics_handler
 def remove_portfolio(event, context):
     """Orchestrate all other functions.
 
@@ -1,15 +1,30 @@
 import configparser
+import hashlib
 import json
 import logging
 import os
+import threading
+import time
 import uuid
 import zipfile
-import boto3
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import yaml
 from botocore.exceptions import ClientError
 from servicecatalog import (
+    ACCOUNT_SUCCEEDED,
+    api_metrics_handler,
+    escape_and_lower_characters,
+    get_account_client,
     get_user_params,
+    is_product_template,
+    lazy_client,
     put_job_failure,
     put_job_success,
+    put_last_synced_commit,
+    run_for_accounts,
+    split_path,
+    throttled_client,
 )
 
 # Set log level
@@ -25,405 +40,2009 @@ PATH_INI = os.getenv("PATH_INI")
 PATH = os.getenv("PATH")
 BUCKET = os.getenv("BUCKET")
 S3_PATH = os.getenv("S3_PATH")
+SYNC_MAX_WORKERS = int(os.getenv("SYNC_MAX_WORKERS", "1"))
+STATE_CACHE_TTL = int(os.getenv("STATE_CACHE_TTL", "900"))
+ARTIFACT_RETENTION = int(os.getenv("ARTIFACT_RETENTION", "1"))
+CHECKPOINT_MARGIN_MS = int(os.getenv("CHECKPOINT_MARGIN_MS", "30000"))
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", "sync-checkpoints/")
+PRUNE_BATCH_SIZE = int(os.getenv("PRUNE_BATCH_SIZE", "5"))
+# Role within the accounts the portfolio is shared with, which may search their
+# provisioned products. Without it, artifacts of shared portfolios are never pruned
+ARTIFACT_USAGE_ROLE_NAME = os.getenv("ARTIFACT_USAGE_ROLE_NAME") or None
+ARTIFACT_USAGE_SESSION_NAME = "ArtifactUsage"
+SYNC_QUEUE_URL = os.getenv("SYNC_QUEUE_URL")
+SYNC_FANOUT_THRESHOLD = int(os.getenv("SYNC_FANOUT_THRESHOLD", "20"))
+SYNC_RESULTS_PATH = os.getenv("SYNC_RESULTS_PATH", "sync-results/")
+SYNC_POLL_INTERVAL = int(os.getenv("SYNC_POLL_INTERVAL", "5"))
+# Seconds after dispatch_plan(), after which missing results count as failed
+SYNC_RESULT_TIMEOUT = int(os.getenv("SYNC_RESULT_TIMEOUT", "1800"))
 
 # Set AWS service clients for this account
 # For the other accounts, the client will be generated later on within the relevant functions
-auto_servicecatalog_client = boto3.client("servicecatalog")
-auto_s3_client = boto3.client("s3")
-auto_codepipeline_client = boto3.client("codepipeline")
-auto_codecommit_client = boto3.client("codecommit")
+auto_servicecatalog_client = throttled_client("servicecatalog")
+auto_s3_client = lazy_client("s3")
+auto_codepipeline_client = lazy_client("codepipeline")
+# SQS_ENDPOINT_URL allows to run the fan-out against a local SQS stand-in
+auto_sqs_client = lazy_client("sqs", endpoint_url=os.getenv("SQS_ENDPOINT_URL"))
 
 # List of standard user roles for each account
 iam_role_list = [
     "CrossAccountAdmin",
 ]
 
+# Object tag within the template store, holding the hash of the synchronised template
+TEMPLATE_HASH_TAG = "template-hash"
+
+# Config fields, which end up in the provisioning artifact
+ARTIFACT_FIELDS = ["Name", "Version", "Diff_Description", "TemplateURL", "ProductType"]
+
+# Service Catalog state kept by warm Lambda containers, see get_cached_state()
+state_cache = {}
+state_cache_lock = threading.Lock()
+
 # Local role name: Launch Constraint
 parsed_string = json.dumps({"LocalRoleName": "{}".format(LOCAL_ROLE_NAME_SC)})
 
 
-def copy_tested_template(file_name: str, bucket: str, object_name: str):
-    """Copy the tested template to the template store in s3.
+def copy_tested_template(file_name: str, bucket: str, object_name: str):
+    """Copy the tested template to the template store in s3.
+
+    Args:
+        file_name: File to upload
+        bucket: Bucket to upload to
+        object_name: S3 object name. If not specified then file_name is used
+
+    Returns:
+        True or False
+    """
+    if object_name is None:
+        object_name = file_name
+
+    try:
+        logger.info("Copying template file with following parameters ... ")
+        logger.info(
+            "File name: {} ... String type ? {} ...".format(
+                file_name, isinstance(file_name, str)
+            )
+        )
+        logger.info(
+            "Bucket name: {} ... String type ?  {} ...".format(
+                bucket, isinstance(bucket, str)
+            )
+        )
+        logger.info(
+            "Object name: {} ... String type ?  {} ...".format(
+                object_name, isinstance(object_name, str)
+            )
+        )
+        auto_s3_client.upload_file(file_name, bucket, object_name)
+    except Exception as e:
+        logging.error(e)
+        return False
+    return True
+
+
+def load_change_manifest(manifest_key: str):
+    """Read the changed files from the change manifest of GetLastGitChanges.
+
+    Args:
+        manifest_key: S3 key of the manifest within the artifact bucket
+
+    Returns:
+        added_files: List of newly added files
+        modified_files: List of modified files
+        deleted_files: List of deleted files
+        renamed_files: List of [path before, path after] pairs of renamed files
+    """
+    try:
+        response = auto_s3_client.get_object(Bucket=BUCKET, Key=manifest_key)
+        manifest = json.loads(response["Body"].read())
+    except Exception as e:
+        logger.error("Error loading the change manifest ... {}".format(e))
+        raise e
+    files = {"A": [], "M": [], "D": [], "R": []}
+    for change in manifest["Changes"]:
+        if change["ChangeType"] == "R":
+            files["R"].append([change["BeforePath"], change["AfterPath"]])
+        elif change["ChangeType"] in files:
+            files[change["ChangeType"]].append(change["Path"])
+    return files["A"], files["M"], files["D"], files["R"]
+
+
+def download_config_file(event):
+    """Download and loads the the configuration file via config parser.
+
+    Args:
+        event: The CodePipeline event
+
+    Returns:
+        config: A meta data configuration object
+    """
+    try:
+        bucket = event["CodePipeline.job"]["data"]["inputArtifacts"][0]["location"][
+            "s3Location"
+        ]["bucketName"]
+        key = event["CodePipeline.job"]["data"]["inputArtifacts"][0]["location"][
+            "s3Location"
+        ]["objectKey"]
+        tmp_file = "/tmp/" + str(uuid.uuid4())
+        auto_s3_client.download_file(bucket, key, tmp_file)
+        with zipfile.ZipFile(tmp_file, "r") as zip:
+            zip.extractall("/tmp/")
+            logger.info("Extract Complete")
+
+        config = configparser.ConfigParser()
+        config.read("/tmp/" + PATH_INI)
+
+        logger.info("Loaded config file")
+        logger.info(config)
+    except Exception as e:
+        logger.error("Error downloading the config.ini ... {}".format(e))  #
+        raise e
+    return config
+
+
+class PortfolioInventory:
+    """Name-indexed view of all products associated with a portfolio.
+
+    Products are keyed by the name formatted via escape_and_lower_characters(),
+    so every lookup during a sync is a single dictionary access.
+    """
+
+    def __init__(self, portfolio_id: str):
+        """Init an empty inventory.
+
+        Args:
+            portfolio_id: Service Catalog portfolio id
+        """
+        self.portfolio_id = portfolio_id
+        self.products = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name: str):
+        """Check whether a product with this name is part of the portfolio."""
+        return escape_and_lower_characters(name) in self.products
+
+    def __len__(self):
+        """Return the number of products within the portfolio."""
+        return len(self.products)
+
+    def get_product_id(self, name: str):
+        """Look up a product id by product or file name.
+
+        Args:
+            name: Product name or short file name, formatted or not
+
+        Returns:
+            The product id or None, if the product does not exist
+        """
+        return self.products.get(escape_and_lower_characters(name))
+
+    def add_product(self, name: str, product_id: str, invalidate_cache: bool = True):
+        """Register a product within the inventory.
+
+        Args:
+            name: Product name or short file name
+            product_id: Service Catalog product id
+            invalidate_cache: Whether the product has been added to the portfolio,
+                False while the inventory is populated from the portfolio
+
+        Returns:
+            No return.
+        """
+        formatted_name = escape_and_lower_characters(name)
+        with self._lock:
+            if formatted_name in self.products:
+                logger.warning(
+                    "Product name {} is not unique within portfolio {} ... keeping {}".format(
+                        name, self.portfolio_id, self.products[formatted_name]
+                    )
+                )
+                return
+            self.products[formatted_name] = product_id
+        if invalidate_cache:
+            invalidate_cached_state(portfolio_id=self.portfolio_id)
+
+    def remove_product(self, name: str):
+        """Drop a product from the inventory.
+
+        Args:
+            name: Product name or short file name
+
+        Returns:
+            The product id of the removed product or None
+        """
+        with self._lock:
+            product_id = self.products.pop(escape_and_lower_characters(name), None)
+        invalidate_cached_state(portfolio_id=self.portfolio_id)
+        return product_id
+
+    def product_ids(self):
+        """Return all product ids within the portfolio."""
+        return list(self.products.values())
+
+    def product_names(self):
+        """Return all formatted product names within the portfolio."""
+        return list(self.products.keys())
+
+
+def list_products_for_portfolio(portfolio_id: str):
+    """List all products of a portfolio with the Service Catalog Service.
+
+    Args:
+        portfolio_id: Service Catalog portfolio id
+
+    Returns:
+        inventory: PortfolioInventory with all products of the portfolio
+    """
+    inventory = PortfolioInventory(portfolio_id=portfolio_id)
+    try:
+        paginator = auto_servicecatalog_client.get_paginator("search_products_as_admin")
+        for page in paginator.paginate(AcceptLanguage="en", PortfolioId=portfolio_id):
+            for product in page["ProductViewDetails"]:
+                inventory.add_product(
+                    name=product["ProductViewSummary"]["Name"],
+                    product_id=product["ProductViewSummary"]["ProductId"],
+                    invalidate_cache=False,
+                )
+    except Exception as e:
+        logger.error("Error searching products ... {}".format(e))
+        raise e
+    return inventory
+
+
+class ConstraintIndex:
+    """All constraints of a portfolio, grouped by product id."""
+
+    def __init__(self, portfolio_id: str):
+        """Init an empty index.
+
+        Args:
+            portfolio_id: Service Catalog portfolio id
+        """
+        self.portfolio_id = portfolio_id
+        self.constraints = {}
+        self._lock = threading.Lock()
+
+    def get_constraints(self, product_id: str, constraint_type: str = None):
+        """Get the constraints of a product.
+
+        Args:
+            product_id: Service Catalog product id
+            constraint_type: Optional filter like LAUNCH
+
+        Returns:
+            List with ConstraintDetails
+        """
+        with self._lock:
+            return [
+                constraint
+                for constraint in self.constraints.get(product_id, [])
+                if constraint_type is None or constraint["Type"] == constraint_type
+            ]
+
+    def add_constraint(self, constraint_detail: dict):
+        """Register a constraint within the index.
+
+        Args:
+            constraint_detail: ConstraintDetail as returned by Service Catalog
+
+        Returns:
+            No return.
+        """
+        with self._lock:
+            self.constraints.setdefault(constraint_detail["ProductId"], []).append(
+                constraint_detail
+            )
+        invalidate_cached_state(portfolio_id=self.portfolio_id)
+
+    def remove_constraint(self, product_id: str, constraint_id: str):
+        """Drop a constraint from the index.
+
+        Args:
+            product_id: Service Catalog product id
+            constraint_id: Service Catalog constraint id
+
+        Returns:
+            No return.
+        """
+        with self._lock:
+            self.constraints[product_id] = [
+                constraint
+                for constraint in self.constraints.get(product_id, [])
+                if constraint["ConstraintId"] != constraint_id
+            ]
+        invalidate_cached_state(portfolio_id=self.portfolio_id)
+
+
+def list_constraints_for_portfolio(portfolio_id: str, product_id: str = None):
+    """List all constraints of a portfolio with a single paginated crawl.
+
+    Args:
+        portfolio_id: Service Catalog portfolio id
+        product_id: Optional product id to list only the constraints of this product
+
+    Returns:
+        constraints: ConstraintIndex with all constraints of the portfolio
+    """
+    constraints = ConstraintIndex(portfolio_id=portfolio_id)
+    filters = {} if product_id is None else {"ProductId": product_id}
+    try:
+        paginator = auto_servicecatalog_client.get_paginator(
+            "list_constraints_for_portfolio"
+        )
+        for page in paginator.paginate(
+            AcceptLanguage="en", PortfolioId=portfolio_id, **filters
+        ):
+            for constraint_detail in page["ConstraintDetails"]:
+                constraints.constraints.setdefault(
+                    constraint_detail["ProductId"], []
+                ).append(constraint_detail)
+    except Exception as e:
+        logger.error("Error listing the constraints of the portfolio ... {}".format(e))
+        raise e
+    return constraints
+
+
+def get_cached_state(portfolio_id: str, commit_ids: list):
+    """Get the Service Catalog state, which a warm container cached after a sync.
+
+    Args:
+        portfolio_id: Service Catalog portfolio id
+        commit_ids: Commit ids, which might have been synchronised last, in order of preference
+
+    Returns:
+        state: Dictionary with the cached state or None
+    """
+    now = time.time()
+    with state_cache_lock:
+        expired = [key for key, entry in state_cache.items() if entry["expires"] < now]
+        for key in expired:
+            del state_cache[key]
+        for commit_id in commit_ids:
+            entry = state_cache.get((portfolio_id, commit_id))
+            if entry is not None:
+                logger.info(
+                    "Reusing cached state of portfolio {} at commit {} ...".format(
+                        portfolio_id, commit_id
+                    )
+                )
+                return entry["state"]
+    return None
+
+
+def put_cached_state(portfolio_id: str, commit_id: str, state: dict):
+    """Cache the Service Catalog state of a portfolio after a successful sync.
+
+    Args:
+        portfolio_id: Service Catalog portfolio id
+        commit_id: The commit, which has been synchronised
+        state: Dictionary with the current state
+
+    Returns:
+        No return.
+    """
+    invalidate_cached_state(portfolio_id=portfolio_id)
+    with state_cache_lock:
+        state_cache[(portfolio_id, commit_id)] = {
+            "expires": time.time() + STATE_CACHE_TTL,
+            "state": state,
+        }
+
+
+def invalidate_cached_state(portfolio_id: str):
+    """Drop all cached states of a portfolio. Called on every write to the portfolio.
+
+    Args:
+        portfolio_id: Service Catalog portfolio id
+
+    Returns:
+        No return.
+    """
+    with state_cache_lock:
+        for key in [key for key in state_cache if key[0] == portfolio_id]:
+            del state_cache[key]
+
+
+def load_portfolio_state(portfolio_id: str, commit_ids: list):
+    """Load the Service Catalog state from the warm cache or by listing the portfolio.
+
+    Args:
+        portfolio_id: Service Catalog portfolio id
+        commit_ids: Commit ids, which might have been synchronised last, in order of preference
+
+    Returns:
+        state: Dictionary with the PortfolioInventory as products and the ConstraintIndex as constraints
+    """
+    state = get_cached_state(portfolio_id=portfolio_id, commit_ids=commit_ids)
+    if state is None:
+        state = {
+            "products": list_products_for_portfolio(portfolio_id=portfolio_id),
+            "constraints": list_constraints_for_portfolio(portfolio_id=portfolio_id),
+        }
+    return state
+
+
+def format_string_and_filenames(path: str,):
+    """Use split_path() and escape_and_lower_characters() to format string accordingly.
+
+    Args:
+        path: Path of a deleted, modified or newly created file within the Git Repository
+
+    Returns:
+        formatted_string: string formatted
+        file_name: string formatted
+        short_file_name: string formatted
+    """
+    file_name, short_file_name = split_path(path)
+    formatted_string = escape_and_lower_characters(file_name)
+    short_file_name = escape_and_lower_characters(short_file_name)
+    return formatted_string, file_name, short_file_name
+
+
+class _TemplateLoader(yaml.SafeLoader):
+    """SafeLoader, which understands the CloudFormation short form functions like !Ref."""
+
+
+def _construct_intrinsic_function(loader, tag_suffix, node):
+    """Load a CloudFormation short form function as its long form mapping.
+
+    Args:
+        loader: The YAML loader
+        tag_suffix: The tag without the leading exclamation mark, e.g. Ref
+        node: The YAML node
+
+    Returns:
+        A dictionary like {"Ref": "MyBucket"}
+    """
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    return {tag_suffix: value}
+
+
+_TemplateLoader.add_multi_constructor("!", _construct_intrinsic_function)
+
+
+def get_template_hash(path: str, config_section):
+    """Calculate a semantic hash of a template and its provisioning artifact settings.
+
+    The template is parsed and serialised with sorted keys, so whitespace, comments
+    and key order do not change the hash.
+
+    Args:
+        path: Local path of the template
+        config_section: The template section from config.ini
+
+    Returns:
+        The SHA-256 hex digest or None, if the template cannot be parsed
+    """
+    try:
+        with open(path, "r") as template_file:
+            template = yaml.load(template_file, Loader=_TemplateLoader)  # nosec
+        artifact = {field: config_section.get(field) for field in ARTIFACT_FIELDS}
+        document = json.dumps(
+            {"Template": template, "Artifact": artifact},
+            sort_keys=True,
+            separators=(",", ":"),
+            default=str,
+        )
+    except Exception as e:
+        logger.warning("Cannot calculate hash of template {} ... {}".format(path, e))
+        return None
+    return hashlib.sha256(document.encode("utf-8")).hexdigest()
+
+
+def get_stored_template_hash(bucket: str, object_name: str):
+    """Read the hash of the last synchronised template from the template store.
+
+    Args:
+        bucket: The template store bucket
+        object_name: S3 object name of the template
+
+    Returns:
+        The stored hash or None, if the template or its tag does not exist
+    """
+    try:
+        response = auto_s3_client.get_object_tagging(Bucket=bucket, Key=object_name)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+            return None
+        logger.error("Error reading the template hash ... {}".format(e))
+        raise e
+    for tag in response["TagSet"]:
+        if tag["Key"] == TEMPLATE_HASH_TAG:
+            return tag["Value"]
+    return None
+
+
+def store_template_hash(bucket: str, object_name: str, template_hash: str):
+    """Tag the template within the template store with its hash.
+
+    Args:
+        bucket: The template store bucket
+        object_name: S3 object name of the template
+        template_hash: Hash from get_template_hash()
+
+    Returns:
+        No return.
+    """
+    try:
+        auto_s3_client.put_object_tagging(
+            Bucket=bucket,
+            Key=object_name,
+            Tagging={"TagSet": [{"Key": TEMPLATE_HASH_TAG, "Value": template_hash}]},
+        )
+    except Exception as e:
+        logger.error("Error storing the template hash ... {}".format(e))
+        raise e
+
+
+class PortfolioSyncError(Exception):
+    """Collect the failures of all products synchronised within one run."""
+
+    def __init__(self, failures: dict):
+        """Init the error with all per-product failures.
+
+        Args:
+            failures: Dictionary with the template path as key and the exception as value
+        """
+        self.failures = failures
+        super().__init__(
+            "; ".join(
+                "{}: {}".format(template, error) for template, error in failures.items()
+            )
+        )
+
+
+class SyncAction:
+    """A single product change, computed by plan_portfolio_sync()."""
+
+    CREATE = "create"
+    UPDATE = "update"
+    DELETE = "delete"
+
+    def __init__(
+        self,
+        operation: str,
+        template: str,
+        product_id: str = None,
+        template_hash: str = None,
+        constraints_to_delete: list = None,
+        create_launch_constraint: bool = False,
+        artifacts_to_delete: list = None,
+        template_uploaded: bool = False,
+        previous_template: str = None,
+    ):
+        """Init the action.
+
+        Args:
+            operation: One of SyncAction.CREATE, SyncAction.UPDATE or SyncAction.DELETE
+            template: Path of the template within the repository
+            product_id: Id of the existing product, None for new products
+            template_hash: Hash from get_template_hash() to be stored after the change
+            constraints_to_delete: Ids of the constraints to be deleted
+            create_launch_constraint: Whether the LAUNCH constraint has to be created
+            artifacts_to_delete: Ids of the provisioning artifacts to be pruned
+            template_uploaded: Whether the template is already in the template store
+            previous_template: Path before a rename, the product is renamed in place
+        """
+        self.operation = operation
+        self.template = template
+        (
+            self.formatted_string,
+            self.file_name,
+            self.product_key,
+        ) = format_string_and_filenames(path=template)
+        self.product_id = product_id
+        self.template_hash = template_hash
+        self.constraints_to_delete = constraints_to_delete or []
+        self.create_launch_constraint = create_launch_constraint
+        self.artifacts_to_delete = artifacts_to_delete or []
+        self.template_uploaded = template_uploaded
+        self.previous_template = previous_template
+        self.previous_product_key = None
+        if previous_template is not None:
+            _, _, self.previous_product_key = format_string_and_filenames(
+                path=previous_template
+            )
+
+    @property
+    def api_calls(self):
+        """Predict the number of API calls needed to apply the action."""
+        calls = len(self.constraints_to_delete) + int(self.create_launch_constraint)
+        if self.operation == SyncAction.DELETE:
+            # DeleteProduct
+            return calls + 1
+        if self.template_hash is not None:
+            # PutObjectTagging
+            calls += 1
+        if self.operation == SyncAction.CREATE:
+            # PutObject, CreateProduct, AssociateProductWithPortfolio
+            return calls + 3
+        if self.previous_template is not None:
+            # UpdateProduct
+            calls += 1
+        # PutObject, Create- and UpdateProvisioningArtifact, DeleteProvisioningArtifact
+        return calls + 3 + len(self.artifacts_to_delete)
+
+    def to_dict(self):
+        """Return the action as a JSON serialisable dictionary."""
+        return {
+            "Operation": self.operation,
+            "Template": self.template,
+            "ProductId": self.product_id,
+            "ConstraintsToDelete": self.constraints_to_delete,
+            "CreateLaunchConstraint": self.create_launch_constraint,
+            "ArtifactsToDelete": self.artifacts_to_delete,
+            "TemplateHash": self.template_hash,
+            "TemplateUploaded": self.template_uploaded,
+            "PreviousTemplate": self.previous_template,
+            "ApiCalls": self.api_calls,
+        }
+
+    @classmethod
+    def from_dict(cls, action: dict):
+        """Restore an action from to_dict().
+
+        Args:
+            action: Dictionary from to_dict()
+
+        Returns:
+            The SyncAction
+        """
+        return cls(
+            operation=action["Operation"],
+            template=action["Template"],
+            product_id=action["ProductId"],
+            template_hash=action["TemplateHash"],
+            constraints_to_delete=action["ConstraintsToDelete"],
+            create_launch_constraint=action["CreateLaunchConstraint"],
+            artifacts_to_delete=action["ArtifactsToDelete"],
+            template_uploaded=action.get("TemplateUploaded", False),
+            previous_template=action.get("PreviousTemplate"),
+        )
+
+
+class SyncPlan:
+    """All changes needed to bring a portfolio in line with the repository."""
+
+    def __init__(self, portfolio_id: str):
+        """Init an empty plan.
+
+        Args:
+            portfolio_id: Service Catalog portfolio id
+        """
+        self.portfolio_id = portfolio_id
+        self.actions = []
+        self.unchanged = []
+        self.completed = []
+        self.failures = {}
+        self.fanout_id = None
+        self.dispatched_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_complete(self):
+        """Check whether every action has been applied."""
+        return len(self.completed) == len(self.actions)
+
+    def get_pending_actions(self):
+        """Return the actions, which have not been applied yet."""
+        return [
+            action for action in self.actions if action.template not in self.completed
+        ]
+
+    def mark_completed(self, action: SyncAction, failures: dict):
+        """Record the outcome of an applied action.
+
+        Args:
+            action: The applied SyncAction
+            failures: Dictionary from apply_action()
+
+        Returns:
+            No return.
+        """
+        with self._lock:
+            self.completed.append(action.template)
+            self.failures.update(
+                {template: str(error) for template, error in failures.items()}
+            )
+
+    def to_dict(self):
+        """Return the plan including its progress as a JSON serialisable dictionary."""
+        return {
+            "PortfolioId": self.portfolio_id,
+            "Actions": [action.to_dict() for action in self.actions],
+            "Unchanged": self.unchanged,
+            "Completed": self.completed,
+            "Failures": self.failures,
+            "FanoutId": self.fanout_id,
+            "DispatchedAt": self.dispatched_at,
+        }
+
+    @classmethod
+    def from_dict(cls, plan: dict):
+        """Restore a plan from to_dict().
+
+        Args:
+            plan: Dictionary from to_dict()
+
+        Returns:
+            The SyncPlan
+        """
+        sync_plan = cls(portfolio_id=plan["PortfolioId"])
+        sync_plan.actions = [SyncAction.from_dict(action) for action in plan["Actions"]]
+        sync_plan.unchanged = plan["Unchanged"]
+        sync_plan.completed = plan["Completed"]
+        sync_plan.failures = plan["Failures"]
+        sync_plan.fanout_id = plan.get("FanoutId")
+        sync_plan.dispatched_at = plan.get("DispatchedAt")
+        return sync_plan
+
+    @property
+    def api_calls(self):
+        """Predict the number of API calls needed to apply the plan."""
+        return sum(action.api_calls for action in self.actions)
+
+    def get_actions(self, operation: str):
+        """Get all actions of an operation.
+
+        Args:
+            operation: One of SyncAction.CREATE, SyncAction.UPDATE or SyncAction.DELETE
+
+        Returns:
+            List with SyncActions
+        """
+        return [action for action in self.actions if action.operation == operation]
+
+    def summary(self):
+        """Return a short, JSON serialisable overview of the plan."""
+        return {
+            "Create": [a.product_key for a in self.get_actions(SyncAction.CREATE)],
+            "Update": [a.product_key for a in self.get_actions(SyncAction.UPDATE)],
+            "Delete": [a.product_key for a in self.get_actions(SyncAction.DELETE)],
+            "Rename": [
+                [a.previous_product_key, a.product_key]
+                for a in self.get_actions(SyncAction.UPDATE)
+                if a.previous_template is not None
+            ],
+            "Unchanged": self.unchanged,
+            "PredictedApiCalls": self.api_calls,
+        }
+
+
+def plan_launch_constraint(constraints: ConstraintIndex, product_id: str):
+    """Diff the desired LAUNCH constraint against the actual ones of a product.
+
+    Only constraints, which differ from the desired one, are marked for deletion. The
+    desired constraint is only marked for creation, if no matching one exists.
+
+    Args:
+        constraints: ConstraintIndex with all current constraints
+        product_id: existing product id within the servicecatalog
+
+    Returns:
+        constraints_to_delete: Ids of the constraints to be deleted
+        create_launch_constraint: Whether the desired constraint has to be created
+    """
+    desired_parameters = json.loads(parsed_string)
+    matching_constraint_id = None
+    constraints_to_delete = []
+    for constraint in constraints.get_constraints(
+        product_id=product_id, constraint_type="LAUNCH"
+    ):
+        if matching_constraint_id is None:
+            try:
+                response = auto_servicecatalog_client.describe_constraint(
+                    AcceptLanguage="en", Id=constraint["ConstraintId"]
+                )
+            except Exception as e:
+                logger.error("Error describing product constraint ... {}".format(e))
+                raise e
+            if json.loads(response["ConstraintParameters"]) == desired_parameters:
+                matching_constraint_id = constraint["ConstraintId"]
+                continue
+        constraints_to_delete.append(constraint["ConstraintId"])
+    return constraints_to_delete, matching_constraint_id is None
+
+
+def list_provisioning_artifacts(product_id: str):
+    """List the provisioning artifacts of a product.
+
+    Args:
+        product_id: existing product id within the servicecatalog
+
+    Returns:
+        List with ProvisioningArtifactDetails, newest first
+    """
+    try:
+        response = auto_servicecatalog_client.list_provisioning_artifacts(
+            AcceptLanguage="en", ProductId=product_id,
+        )
+    except Exception as e:
+        logger.error(
+            "Error while listing the existing product provisioning artifacts ... {}".format(
+                e
+            )
+        )
+        raise e
+    return sorted(
+        response["ProvisioningArtifactDetails"],
+        key=lambda artifact: artifact["CreatedTime"],
+        reverse=True,
+    )
+
+
+def list_shared_accounts(portfolio_id: str):
+    """List the accounts, which the portfolio is shared with.
+
+    Args:
+        portfolio_id: Service Catalog portfolio id
+
+    Returns:
+        List with account ids or None, if the portfolio is shared with an
+        organization or organizational unit, whose accounts are not listed
+    """
+    try:
+        for share_type in ["ORGANIZATION", "ORGANIZATIONAL_UNIT"]:
+            response = auto_servicecatalog_client.describe_portfolio_shares(
+                PortfolioId=portfolio_id, Type=share_type
+            )
+            if response.get("PortfolioShareDetails"):
+                logger.warning(
+                    "Portfolio {} is shared with an organization ... {}".format(
+                        portfolio_id, response["PortfolioShareDetails"]
+                    )
+                )
+                return None
+        account_ids = []
+        kwargs = {"AcceptLanguage": "en", "PortfolioId": portfolio_id, "PageSize": 20}
+        while True:
+            response = auto_servicecatalog_client.list_portfolio_access(**kwargs)
+            account_ids += response["AccountIds"]
+            if not response.get("NextPageToken"):
+                break
+            kwargs["PageToken"] = response["NextPageToken"]
+    except Exception as e:
+        logger.error("Error while listing the portfolio shares ... {}".format(e))
+        raise e
+    return account_ids
+
+
+def list_used_provisioning_artifacts(product_id: str, client=None):
+    """Collect the provisioning artifacts, which provisioned products are based on.
+
+    Args:
+        product_id: existing product id within the servicecatalog
+        client: Service Catalog client of the account, defaults to this account
+
+    Returns:
+        Set with provisioning artifact ids
+    """
+    client = client or auto_servicecatalog_client
+    used_artifact_ids = set()
+    kwargs = {
+        "AcceptLanguage": "en",
+        "AccessLevelFilter": {"Key": "Account", "Value": "self"},
+        "Filters": {"SearchQuery": ["productId:{}".format(product_id)]},
+        "PageSize": 100,
+    }
+    try:
+        while True:
+            response = client.search_provisioned_products(**kwargs)
+            for provisioned_product in response["ProvisionedProducts"]:
+                if "ProvisioningArtifactId" in provisioned_product:
+                    used_artifact_ids.add(provisioned_product["ProvisioningArtifactId"])
+            if not response.get("NextPageToken"):
+                break
+            kwargs["PageToken"] = response["NextPageToken"]
+    except Exception as e:
+        logger.error("Error while searching provisioned products ... {}".format(e))
+        raise e
+    return used_artifact_ids
+
+
+def list_artifact_usage(product_id: str, shared_accounts: list):
+    """Collect the provisioning artifacts in use within this and all shared accounts.
+
+    Args:
+        product_id: existing product id within the servicecatalog
+        shared_accounts: Account ids from list_shared_accounts()
+
+    Returns:
+        Set with provisioning artifact ids or None, if the usage within the shared
+        accounts cannot be established
+    """
+    if shared_accounts is None:
+        return None
+    used_artifact_ids = list_used_provisioning_artifacts(product_id=product_id)
+    if not shared_accounts:
+        return used_artifact_ids
+    if ARTIFACT_USAGE_ROLE_NAME is None:
+        logger.warning(
+            "ARTIFACT_USAGE_ROLE_NAME is not set ... cannot search {}".format(
+                shared_accounts
+            )
+        )
+        return None
+
+    def list_account_usage(role, account):
+        return list_used_provisioning_artifacts(
+            product_id=product_id,
+            client=get_account_client(
+                "servicecatalog",
+                role=role,
+                session_name=ARTIFACT_USAGE_SESSION_NAME,
+                account=account,
+            ),
+        )
+
+    report = run_for_accounts(
+        operation=list_account_usage,
+        assume_roles=[
+            "arn:aws:iam::{}:role/{}".format(account, ARTIFACT_USAGE_ROLE_NAME)
+            for account in shared_accounts
+        ],
+        accounts=shared_accounts,
+        max_failures=None,
+    )
+    for outcome in report.values():
+        if outcome["Status"] != ACCOUNT_SUCCEEDED:
+            return None
+        used_artifact_ids |= outcome["Result"]
+    return used_artifact_ids
+
+
+def plan_artifact_pruning(product_id: str, retention: int, shared_accounts: list):
+    """Select the provisioning artifacts exceeding the retention of a product.
+
+    The artifact created by the sync counts towards the retention. Artifacts used by
+    provisioned products in this or a shared account are never selected. Nothing is
+    selected, if the usage within the shared accounts cannot be established.
+
+    Args:
+        product_id: existing product id within the servicecatalog
+        retention: Number of newest versions to be kept, including the new one
+        shared_accounts: Account ids from list_shared_accounts()
+
+    Returns:
+        List with the ids of the artifacts to be deleted
+    """
+    artifacts = list_provisioning_artifacts(product_id=product_id)
+    # The new artifact counts towards the retention
+    kept_artifacts = max(retention, 1) - 1
+    outdated_artifacts = artifacts[kept_artifacts:]
+    if not outdated_artifacts:
+        return []
+    used_artifact_ids = list_artifact_usage(
+        product_id=product_id, shared_accounts=shared_accounts
+    )
+    if used_artifact_ids is None:
+        logger.warning(
+            "Keeping all provisioning artifacts of product {}, their usage is unknown ...".format(
+                product_id
+            )
+        )
+        return []
+    artifacts_to_delete = []
+    for artifact in outdated_artifacts:
+        if artifact["Id"] in used_artifact_ids:
+            logger.info(
+                "Keeping provisioning artifact {} of product {}, it is still in use ...".format(
+                    artifact["Id"], product_id
+                )
+            )
+        else:
+            artifacts_to_delete.append(artifact["Id"])
+    return artifacts_to_delete
+
+
+def plan_portfolio_sync(
+    config,
+    added_files: list,
+    modified_files: list,
+    deleted_files: list,
+    inventory: PortfolioInventory,
+    constraints: ConstraintIndex,
+    renamed_files: list = None,
+):
+    """Compare the desired state from the repository with the actual portfolio.
+
+    The desired state consists of the changed templates and their config.ini
+    sections. Only read calls are made, so the plan can be used for a dry run.
+    A renamed template keeps its product, which is updated and renamed in place
+    instead of being deleted and created again.
+
+    Args:
+        config: config object from download_config_file
+        added_files: List of newly added files
+        modified_files: List of modified files
+        deleted_files: List of deleted files
+        inventory: PortfolioInventory with all current products
+        constraints: ConstraintIndex with all current constraints
+        renamed_files: List of [path before, path after] pairs of renamed files
+
+    Returns:
+        plan: SyncPlan with the minimal set of actions
+    """
+    logger.info("This files has been added {}".format(added_files))
+    logger.info("This files has been updated {}".format(modified_files))
+    logger.info("This files has been deleted {}".format(deleted_files))
+    logger.info("This files has been renamed {}".format(renamed_files))
+    plan = SyncPlan(portfolio_id=inventory.portfolio_id)
+
+    # Listed with the first product, whose artifacts may be pruned
+    shared_accounts = []
+    shares_listed = False
+
+    # Template path before the rename by the short file name after the rename
+    previous_templates = {}
+    added_files, deleted_files = list(added_files), list(deleted_files)
+    for before_path, after_path in renamed_files or []:
+        if is_product_template(path=before_path, products_path=PATH):
+            # Moved out of the products or onto an existing product ... delete
+            if not is_product_template(
+                path=after_path, products_path=PATH
+            ) or inventory.get_product_id(
+                format_string_and_filenames(path=after_path)[2]
+            ):
+                deleted_files.append(before_path)
+            else:
+                _, _, short_file_name = format_string_and_filenames(path=after_path)
+                previous_templates[short_file_name] = before_path
+        added_files.append(after_path)
+
+    templates = OrderedDict()
+    for template in added_files + modified_files:
+        if not is_product_template(path=template, products_path=PATH):
+            continue
+        _, _, short_file_name = format_string_and_filenames(path=template)
+        if templates.get(short_file_name, template) != template:
+            logger.warning(
+                "Templates {} and {} belong to the same product ... using the latter".format(
+                    templates[short_file_name], template
+                )
+            )
+        templates[short_file_name] = template
+
+    for short_file_name, template in templates.items():
+        _, file_name, _ = format_string_and_filenames(path=template)
+        if not config.has_section(file_name):
+            raise KeyError("Section [{}] is missing in {}".format(file_name, PATH_INI))
+        product_id = inventory.get_product_id(short_file_name)
+        previous_template = None
+        if product_id is None and short_file_name in previous_templates:
+            _, _, previous_key = format_string_and_filenames(
+                path=previous_templates[short_file_name]
+            )
+            product_id = inventory.get_product_id(previous_key)
+            if product_id is not None:
+                previous_template = previous_templates[short_file_name]
+                logger.info(
+                    "Template {} has been renamed to {} ... keeping product {}".format(
+                        previous_template, template, product_id
+                    )
+                )
+        template_hash = get_template_hash(
+            path="/tmp/" + template, config_section=config[file_name]
+        )
+        if product_id is None:
+            plan.actions.append(
+                SyncAction(
+                    operation=SyncAction.CREATE,
+                    template=template,
+                    template_hash=template_hash,
+                    create_launch_constraint=True,
+                )
+            )
+        elif (
+            previous_template is None
+            and template_hash is not None
+            and template_hash == get_stored_template_hash(BUCKET, S3_PATH + file_name)
+        ):
+            logger.info(
+                "Template {} is unchanged since the last sync of product {} ...".format(
+                    template, product_id
+                )
+            )
+            plan.unchanged.append(short_file_name)
+        else:
+            constraints_to_delete, create_launch_constraint = plan_launch_constraint(
+                constraints=constraints, product_id=product_id
+            )
+            if not shares_listed:
+                shared_accounts = list_shared_accounts(inventory.portfolio_id)
+                shares_listed = True
+            artifacts_to_delete = plan_artifact_pruning(
+                product_id=product_id,
+                retention=config[file_name].getint(
+                    "Retention", fallback=ARTIFACT_RETENTION
+                ),
+                shared_accounts=shared_accounts,
+            )
+            plan.actions.append(
+                SyncAction(
+                    operation=SyncAction.UPDATE,
+                    template=template,
+                    product_id=product_id,
+                    template_hash=template_hash,
+                    constraints_to_delete=constraints_to_delete,
+                    create_launch_constraint=create_launch_constraint,
+                    artifacts_to_delete=artifacts_to_delete,
+                    previous_template=previous_template,
+                )
+            )
+
+    for deletion in deleted_files:
+        if not is_product_template(path=deletion, products_path=PATH):
+            continue
+        _, _, short_file_name = format_string_and_filenames(path=deletion)
+        product_id = inventory.get_product_id(short_file_name)
+        if product_id is None or short_file_name in templates:
+            continue
+        plan.actions.append(
+            SyncAction(
+                operation=SyncAction.DELETE,
+                template=deletion,
+                product_id=product_id,
+                constraints_to_delete=[
+                    constraint["ConstraintId"]
+                    for constraint in constraints.get_constraints(product_id=product_id)
+                ],
+            )
+        )
+    return plan
+
+
+def upload_template(action: SyncAction):
+    """Copy the template of an action to the template store.
+
+    Args:
+        action: SyncAction to create or update a product
+
+    Returns:
+        No return.
+    """
+    if action.template_uploaded:
+        return
+    try:
+        if not copy_tested_template(
+            file_name="/tmp/" + action.template,
+            bucket=BUCKET,
+            object_name=S3_PATH + action.file_name,
+        ):
+            raise RuntimeError("Upload of {} failed".format(action.template))
+        logger.info(
+            """Copied CF-template from {} to template store {} ...
+            """.format(
+                "/tmp/" + action.template, S3_PATH + action.file_name
+            )
+        )
+        action.template_uploaded = True
+    except Exception as e:
+        logger.error("Error copying CF-template(s) to template store ... {}".format(e))
+        raise e
+
+
+def delete_provisioning_artifact(product_id: str, artifact_id: str):
+    """Delete a single provisioning artifact, tolerating already deleted ones.
+
+    Args:
+        product_id: existing product id within the servicecatalog
+        artifact_id: the provisioning artifact to be deleted
+
+    Returns:
+        No return.
+    """
+    try:
+        auto_servicecatalog_client.delete_provisioning_artifact(
+            AcceptLanguage="en",
+            ProductId=product_id,
+            ProvisioningArtifactId=artifact_id,
+        )
+        logger.info("Deleted provisioning artifact {} ...".format(artifact_id))
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ResourceNotFoundException":
+            raise e
+        logger.info("Provisioning artifact {} does not exist ...".format(artifact_id))
+
+
+def delete_provisioning_artifacts(product_id: str, artifact_ids: list):
+    """Delete provisioning artifacts in concurrent batches of PRUNE_BATCH_SIZE.
+
+    Args:
+        product_id: existing product id within the servicecatalog
+        artifact_ids: the provisioning artifacts to be deleted
+
+    Returns:
+        No return.
+    """
+    if not artifact_ids:
+        return
+    try:
+        with ThreadPoolExecutor(max_workers=PRUNE_BATCH_SIZE) as executor:
+            for batch_start in range(0, len(artifact_ids), PRUNE_BATCH_SIZE):
+                batch = artifact_ids[batch_start:][:PRUNE_BATCH_SIZE]
+                list(
+                    executor.map(
+                        lambda artifact_id: delete_provisioning_artifact(
+                            product_id=product_id, artifact_id=artifact_id
+                        ),
+                        batch,
+                    )
+                )
+    except Exception as e:
+        logger.error(
+            "Error while deleting the existing product provisioning artifact ... {}".format(
+                e
+            )
+        )
+        raise e
+
+
+def apply_create(
+    action: SyncAction,
+    config,
+    portfolio_id: str,
+    inventory: PortfolioInventory,
+    constraints: ConstraintIndex,
+):
+    """Create a new product with its LAUNCH constraint.
+
+    If action.product_id is set, the product has already been created by an earlier,
+    interrupted attempt, see find_created_product(). It is then only associated with
+    the portfolio and gets its LAUNCH constraint, unless it already has one.
+
+    Args:
+        action: SyncAction with operation SyncAction.CREATE
+        config: config object from download_config_file
+        portfolio_id: Id of the portfolio
+        inventory: PortfolioInventory with all current products
+        constraints: ConstraintIndex with all current constraints
+
+    Returns:
+        No return.
+    """
+    section = config[action.file_name]
+    upload_template(action=action)
+    product_id = action.product_id
+    if product_id is None:
+        try:
+            logger.info("Creating new Product for the HDI Servicecatalog ...")
+            create_response = auto_servicecatalog_client.create_product(
+                AcceptLanguage="en",
+                Name=section["Name"],
+                Owner=section["Owner"],
+                Description=section["Description"],
+                SupportDescription=section["SupportDescription"],
+                SupportEmail=section["SupportEmail"],
+                SupportUrl=section["SupportUrl"],
+                ProductType=section["ProductType"],
+                Tags=[{"Key": section["Key_1"], "Value": section["Value_1"]}],
+                ProvisioningArtifactParameters={
+                    "Name": section["Version"],
+                    "Description": section["Diff_Description"],
+                    "Info": {"LoadTemplateFromURL": section["TemplateURL"]},
+                    "Type": section["ProductType"],
+                    "DisableTemplateValidation": True,
+                },
+            )
+            logger.info(create_response)
+            logger.info("Successfully created a new HDI Servicecatalog product ...")
+        except Exception as e:
+            logger.error("Error while creating a new product ... {}".format(e))
+            raise e
+        product_id = create_response["ProductViewDetail"]["ProductViewSummary"][
+            "ProductId"
+        ]
+    else:
+        logger.info("Resuming the creation of product {} ...".format(product_id))
+    try:
+        auto_servicecatalog_client.associate_product_with_portfolio(
+            AcceptLanguage="en", ProductId=product_id, PortfolioId=portfolio_id,
+        )
+    except Exception as e:
+        logger.error(
+            "Error while associating the new product with portfolio ... {}".format(e)
+        )
+        raise e
+    inventory.add_product(name=action.product_key, product_id=product_id)
+    if not constraints.get_constraints(product_id=product_id, constraint_type="LAUNCH"):
+        try:
+            create_constraint(
+                constraints=constraints,
+                portfolio_id=portfolio_id,
+                product_id=product_id,
+            )
+        except Exception as e:
+            logger.error(
+                "Error while creating new constraint for the new product {} within portfolio {} ... {}".format(
+                    product_id, portfolio_id, e,
+                )
+            )
+            raise e
+    if action.template_hash is not None:
+        store_template_hash(BUCKET, S3_PATH + action.file_name, action.template_hash)
+
+
+def apply_update(
+    action: SyncAction,
+    config,
+    portfolio_id: str,
+    inventory: PortfolioInventory,
+    constraints: ConstraintIndex,
+):
+    """Replace the provisioning artifact of an existing product.
+
+    A product, whose template has been renamed, gets the name and details from the
+    config.ini section of the new file name.
+
+    Args:
+        action: SyncAction with operation SyncAction.UPDATE
+        config: config object from download_config_file
+        portfolio_id: Id of the portfolio
+        inventory: PortfolioInventory with all current products
+        constraints: ConstraintIndex with all current constraints
+
+    Returns:
+        No return.
+    """
+    section = config[action.file_name]
+    product_id = action.product_id
+    upload_template(action=action)
+    logger.info("Updating existing product in the HDI Servicecatalog ...")
+    logger.info("ID of the product to be updated: {}".format(product_id))
+    try:
+        logger.info("Updating constraints ...")
+        for constraint_id in action.constraints_to_delete:
+            delete_constraint(
+                constraints=constraints,
+                product_id=product_id,
+                constraint_id=constraint_id,
+            )
+        if action.create_launch_constraint:
+            create_constraint(
+                constraints=constraints,
+                portfolio_id=portfolio_id,
+                product_id=product_id,
+            )
+    except Exception as e:
+        logger.error("Error while updating the product constraints ... {}".format(e))
+        raise e
+    logger.info("Successfully updated product constraint ...")
+    try:
+        create_provisioning_artifact_response = auto_servicecatalog_client.create_provisioning_artifact(
+            AcceptLanguage="en",
+            ProductId=product_id,
+            Parameters={
+                "Name": section["Name"],
+                "Description": section["Diff_Description"],
+                "Info": {"LoadTemplateFromURL": section["TemplateURL"]},
+                "Type": section["ProductType"],
+                "DisableTemplateValidation": True,
+            },
+        )
+    except Exception as e:
+        logger.error(
+            "Error while creating the new product provisioning artifact ... {}".format(
+                e
+            )
+        )
+        raise e
+    try:
+        logger.info("Updating provisioning artifact ...")
+        auto_servicecatalog_client.update_provisioning_artifact(
+            AcceptLanguage="en",
+            ProductId=product_id,
+            ProvisioningArtifactId=create_provisioning_artifact_response[
+                "ProvisioningArtifactDetail"
+            ]["Id"],
+            Name=section["Version"],
+            Description=section["Diff_Description"],
+            Active=True,
+            Guidance="DEFAULT",
+        )
+    except Exception as e:
+        logger.error(
+            "Error while updating the new product provisioning artifact ... {}".format(
+                e
+            )
+        )
+        raise e
+    if action.previous_template is not None:
+        try:
+            logger.info(
+                "Renaming product {} to {} ...".format(product_id, section["Name"])
+            )
+            auto_servicecatalog_client.update_product(
+                AcceptLanguage="en",
+                Id=product_id,
+                Name=section["Name"],
+                Owner=section["Owner"],
+                Description=section["Description"],
+                SupportDescription=section["SupportDescription"],
+                SupportEmail=section["SupportEmail"],
+                SupportUrl=section["SupportUrl"],
+            )
+        except Exception as e:
+            logger.error("Error while renaming the product ... {}".format(e))
+            raise e
+        inventory.remove_product(name=action.previous_product_key)
+        inventory.add_product(name=action.product_key, product_id=product_id)
+    delete_provisioning_artifacts(
+        product_id=product_id, artifact_ids=action.artifacts_to_delete
+    )
+    if action.template_hash is not None:
+        store_template_hash(BUCKET, S3_PATH + action.file_name, action.template_hash)
+
+
+def apply_delete(
+    action: SyncAction,
+    config,
+    portfolio_id: str,
+    inventory: PortfolioInventory,
+    constraints: ConstraintIndex,
+):
+    """Delete a product, whose template has been deleted from the repository.
+
+    Args:
+        action: SyncAction with operation SyncAction.DELETE
+        config: config object from download_config_file
+        portfolio_id: Id of the portfolio
+        inventory: PortfolioInventory with all current products
+        constraints: ConstraintIndex with all current constraints
+
+    Returns:
+        No return.
+    """
+    try:
+        for constraint_id in action.constraints_to_delete:
+            delete_constraint(
+                constraints=constraints,
+                product_id=action.product_id,
+                constraint_id=constraint_id,
+            )
+    except Exception as e:
+        logger.error(
+            """
+            Error while deleting constraints for product {} ... {}
+            """.format(
+                action.product_id, e
+            )
+        )
+        raise e
+    try:
+        auto_servicecatalog_client.delete_product(
+            AcceptLanguage="en", Id=action.product_id
+        )
+    except Exception as e:
+        logger.error(
+            "Error while deleting the outdated product from the portfolio ... {}".format(
+                e
+            )
+        )
+        raise e
+    inventory.remove_product(action.product_key)
+
+
+# Executors for the operations of a SyncAction
+apply_functions = {
+    SyncAction.CREATE: apply_create,
+    SyncAction.UPDATE: apply_update,
+    SyncAction.DELETE: apply_delete,
+}
+
+
+def apply_action(
+    action: SyncAction,
+    config,
+    portfolio_id: str,
+    inventory: PortfolioInventory,
+    constraints: ConstraintIndex,
+):
+    """Apply a single action and return its failure, if any.
+
+    Args:
+        action: The SyncAction to be applied
+        config: config object from download_config_file
+        portfolio_id: Id of the portfolio
+        inventory: PortfolioInventory with all current products
+        constraints: ConstraintIndex with all current constraints
+
+    Returns:
+        failures: Dictionary with the failed template path and its exception
+    """
+    logger.info("Applying {} of {} ...".format(action.operation, action.template))
+    try:
+        apply_functions[action.operation](
+            action=action,
+            config=config,
+            portfolio_id=portfolio_id,
+            inventory=inventory,
+            constraints=constraints,
+        )
+    except Exception as e:
+        logger.error("Error while synchronising {} ... {}".format(action.template, e))
+        return {action.template: e}
+    return {}
+
+
+def apply_plan(
+    plan: SyncPlan,
+    config,
+    inventory: PortfolioInventory,
+    constraints: ConstraintIndex,
+    max_workers: int = SYNC_MAX_WORKERS,
+    should_stop=None,
+):
+    """Apply all pending actions of a plan. Each product has at most one action.
+
+    With max_workers above 1, the products are synchronised concurrently while the
+    calls for a single product stay in order. Once should_stop() returns True, no
+    further actions are started and the plan stays incomplete. At least one action
+    is started per call, so every call makes progress.
+
+    Args:
+        plan: SyncPlan from plan_portfolio_sync() or load_checkpoint()
+        config: config object from download_config_file
+        inventory: PortfolioInventory with all current products
+        constraints: ConstraintIndex with all current constraints
+        max_workers: Maximum number of products synchronised at the same time
+        should_stop: Optional callable, which signals to stop starting new actions
+
+    Returns:
+        No return.
+
+    Raises:
+        PortfolioSyncError: The plan is complete, but products could not be synchronised
+    """
+    kwargs = {
+        "config": config,
+        "portfolio_id": plan.portfolio_id,
+        "inventory": inventory,
+        "constraints": constraints,
+    }
+    pending_actions = plan.get_pending_actions()
+
+    def run(action):
+        plan.mark_completed(action, apply_action(action=action, **kwargs))
+
+    def stop(started: int):
+        if started > 0 and should_stop is not None and should_stop():
+            logger.info(
+                "Stopping after {} of {} pending actions ...".format(
+                    started, len(pending_actions)
+                )
+            )
+            return True
+        return False
+
+    if max_workers <= 1 or len(pending_actions) <= 1:
+        for started, action in enumerate(pending_actions):
+            if stop(started):
+                break
+            run(action)
+    else:
+        logger.info(
+            "Synchronising {} products with {} workers ...".format(
+                len(pending_actions), max_workers
+            )
+        )
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            in_flight = set()
+            for started, action in enumerate(pending_actions):
+                while len(in_flight) >= max_workers:
+                    _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                if stop(started):
+                    break
+                in_flight.add(executor.submit(run, action))
+            wait(in_flight)
+    if plan.is_complete and plan.failures:
+        raise PortfolioSyncError(plan.failures)
+
+
+def get_result_key(fanout_id: str, template: str):
+    """Build the S3 object key, under which a worker stores the result of an action.
+
+    Args:
+        fanout_id: Id of the fan-out from dispatch_plan()
+        template: Path of the template within the repository
+
+    Returns:
+        result_key: S3 object key within the artifact bucket
+    """
+    return "{}{}/{}.json".format(
+        SYNC_RESULTS_PATH, fanout_id, hashlib.sha256(template.encode()).hexdigest()
+    )
+
+
+def get_started_key(result_key: str):
+    """Build the S3 object key, which marks a work item as started.
+
+    Args:
+        result_key: S3 object key from get_result_key()
+
+    Returns:
+        started_key: S3 object key within the artifact bucket
+    """
+    return "{}.started".format(os.path.splitext(result_key)[0])
+
+
+def dispatch_plan(plan: SyncPlan, config):
+    """Publish every pending action of a plan as work item to the sync queue.
+
+    The templates are uploaded to the template store beforehand, as the workers have
+    no access to the source artifact. Actions, whose template cannot be uploaded,
+    are recorded as failed right away. The config.ini section is passed with raw
+    values, see load_work_item_config().
+
+    Args:
+        plan: SyncPlan from plan_portfolio_sync()
+        config: config object from download_config_file
+
+    Returns:
+        No return.
+    """
+    plan.fanout_id = str(uuid.uuid4())
+    plan.dispatched_at = time.time()
+    entries = []
+    for action in plan.get_pending_actions():
+        if action.operation != SyncAction.DELETE:
+            try:
+                upload_template(action=action)
+            except Exception as e:
+                plan.mark_completed(action, {action.template: e})
+                continue
+        work_item = {
+            "PortfolioId": plan.portfolio_id,
+            "Action": action.to_dict(),
+            "Config": dict(config.items(action.file_name, raw=True))
+            if config.has_section(action.file_name)
+            else {},
+            "ResultKey": get_result_key(plan.fanout_id, action.template),
+        }
+        entries.append({"Id": str(len(entries)), "MessageBody": json.dumps(work_item)})
+    try:
+        # SendMessageBatch accepts at most 10 messages
+        for index in range(0, len(entries), 10):
+            batch = entries[index:][:10]
+            response = auto_sqs_client.send_message_batch(
+                QueueUrl=SYNC_QUEUE_URL, Entries=batch
+            )
+            if response.get("Failed"):
+                raise RuntimeError(
+                    "Could not publish work items {}".format(response["Failed"])
+                )
+        logger.info(
+            "Published {} work items for fan-out {} ...".format(
+                len(entries), plan.fanout_id
+            )
+        )
+    except Exception as e:
+        logger.error("Error while publishing the sync work items ... {}".format(e))
+        raise e
+
+
+def get_sync_result(result_key: str):
+    """Read the result of an action, which has been applied by a worker.
+
+    Args:
+        result_key: S3 object key from get_result_key()
+
+    Returns:
+        result: Dictionary with Template and Error or None, if there is no result yet
+    """
+    try:
+        response = auto_s3_client.get_object(Bucket=BUCKET, Key=result_key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        logger.error("Error while reading the sync result ... {}".format(e))
+        raise e
+    return json.loads(response["Body"].read())
+
+
+def gather_results(plan: SyncPlan, should_stop=None):
+    """Collect the results of all dispatched actions.
+
+    Polls the results of the workers every SYNC_POLL_INTERVAL seconds, until every
+    action has completed or should_stop() returns True. Actions without a result
+    SYNC_RESULT_TIMEOUT seconds after the dispatch are recorded as failed.
+
+    Args:
+        plan: SyncPlan dispatched by dispatch_plan()
+        should_stop: Optional callable, which signals to stop waiting
+
+    Returns:
+        No return.
+    """
+    pending_actions = {
+        get_result_key(plan.fanout_id, action.template): action
+        for action in plan.get_pending_actions()
+    }
+    prefix = "{}{}/".format(SYNC_RESULTS_PATH, plan.fanout_id)
+    paginator = auto_s3_client.get_paginator("list_objects_v2")
+    # Plans checkpointed before the dispatch time was recorded
+    if plan.dispatched_at is None:
+        plan.dispatched_at = time.time()
+    deadline = plan.dispatched_at + SYNC_RESULT_TIMEOUT
+    while pending_actions:
+        for page in paginator.paginate(Bucket=BUCKET, Prefix=prefix):
+            for s3_object in page.get("Contents", []):
+                action = pending_actions.pop(s3_object["Key"], None)
+                if action is None:
+                    continue
+                result = get_sync_result(result_key=s3_object["Key"])
+                plan.mark_completed(
+                    action,
+                    {action.template: result["Error"]} if result["Error"] else {},
+                )
+        logger.info(
+            "Waiting for {} of {} actions ...".format(
+                len(pending_actions), len(plan.actions)
+            )
+        )
+        if pending_actions and time.time() >= deadline:
+            for action in pending_actions.values():
+                plan.mark_completed(
+                    action,
+                    {
+                        action.template: TimeoutError(
+                            "No result of the sync worker within {} seconds".format(
+                                SYNC_RESULT_TIMEOUT
+                            )
+                        )
+                    },
+                )
+            break
+        if not pending_actions or (should_stop is not None and should_stop()):
+            break
+        time.sleep(max(min(SYNC_POLL_INTERVAL, deadline - time.time()), 0))
+
+
+def fan_out_plan(plan: SyncPlan, config, should_stop=None):
+    """Apply a plan through the worker Lambdas behind the sync queue.
+
+    The plan is dispatched only once. Resumed plans, which have been checkpointed
+    while waiting, only gather the outstanding results.
 
     Args:
-        file_name: File to upload
-        bucket: Bucket to upload to
-        object_name: S3 object name. If not specified then file_name is used
+        plan: SyncPlan from plan_portfolio_sync() or load_checkpoint()
+        config: config object from download_config_file
+        should_stop: Optional callable, which signals to stop waiting
 
     Returns:
-        True or False
+        No return.
+
+    Raises:
+        PortfolioSyncError: The plan is complete, but products could not be synchronised
     """
-    if object_name is None:
-        object_name = file_name
+    if plan.fanout_id is None:
+        dispatch_plan(plan=plan, config=config)
+    gather_results(plan=plan, should_stop=should_stop)
+    if plan.is_complete and plan.failures:
+        raise PortfolioSyncError(plan.failures)
 
-    try:
-        logger.info("Copying template file with following parameters ... ")
-        logger.info(
-            "File name: {} ... String type ? {} ...".format(
-                file_name, isinstance(file_name, str)
-            )
-        )
-        logger.info(
-            "Bucket name: {} ... String type ?  {} ...".format(
-                bucket, isinstance(bucket, str)
-            )
-        )
-        logger.info(
-            "Object name: {} ... String type ?  {} ...".format(
-                object_name, isinstance(object_name, str)
-            )
-        )
-        auto_s3_client.upload_file(file_name, bucket, object_name)
-    except Exception as e:
-        logging.error(e)
-        return False
-    return True
 
+def load_work_item_config(work_item: dict):
+    """Restore the config.ini section of a work item from dispatch_plan().
 
-def download_config_file(event):
-    """Download and loads the the configuration file via config parser.
+    ConfigParser stores the option names in lower case, so the section is read into
+    a new ConfigParser, which looks up options like section["Name"] the same way.
 
     Args:
-        event: The CodePipeline event
+        work_item: Work item from dispatch_plan()
 
     Returns:
-        config: A meta data configuration object
+        config: config object with the section of the work item
     """
-    try:
-        bucket = event["CodePipeline.job"]["data"]["inputArtifacts"][0]["location"][
-            "s3Location"
-        ]["bucketName"]
-        key = event["CodePipeline.job"]["data"]["inputArtifacts"][0]["location"][
-            "s3Location"
-        ]["objectKey"]
-        tmp_file = "/tmp/" + str(uuid.uuid4())
-        auto_s3_client.download_file(bucket, key, tmp_file)
-        with zipfile.ZipFile(tmp_file, "r") as zip:
-            zip.extractall("/tmp/")
-            logger.info("Extract Complete")
+    _, file_name, _ = format_string_and_filenames(path=work_item["Action"]["Template"])
+    config = configparser.ConfigParser()
+    config.read_dict({file_name: work_item["Config"]})
+    return config
 
-        config = configparser.ConfigParser()
-        config.read("/tmp/" + PATH_INI)
 
-        logger.info("Loaded config file")
-        logger.info(config)
+def store_sync_result(result_key: str, template: str, error: str = None):
+    """Store the result of a work item for gather_results().
+
+    Args:
+        result_key: S3 object key from get_result_key()
+        template: Path of the template within the repository
+        error: Error message, None on success
+
+    Returns:
+        No return.
+    """
+    try:
+        auto_s3_client.put_object(
+            Bucket=BUCKET,
+            Key=result_key,
+            Body=json.dumps({"Template": template, "Error": error}).encode("utf-8"),
+        )
     except Exception as e:
-        logger.error("Error downloading the config.ini ... {}".format(e))  #
+        logger.error("Error while storing the sync result ... {}".format(e))
         raise e
-    return config
 
 
-def list_products_for_portfolio(portfolio_id: str):
-    """List a product with the Service Catalog Service.
+def find_created_product(action: SyncAction, config):
+    """Look up the product of a create, which has been interrupted by a worker crash.
+
+    The search is not limited to the portfolio, as the worker may have crashed before
+    the product has been associated with it.
 
     Args:
-        Service Catalog portfolio id
+        action: SyncAction with operation SyncAction.CREATE
+        config: config object from load_work_item_config()
 
     Returns:
-        list_product_ids: list with Service Catalog products ids
-        list_formatted_product_names: list with formatted Service Catalog products names
+        The product id or None, if the product has not been created
     """
-    list_product_ids = []
-    list_product_names = []
-    list_formatted_product_names = []
-
+    product_name = config[action.file_name]["Name"]
     try:
-        product_response = auto_servicecatalog_client.search_products_as_admin(
-            AcceptLanguage="en", PortfolioId=portfolio_id
-        )
+        paginator = auto_servicecatalog_client.get_paginator("search_products_as_admin")
+        for page in paginator.paginate(
+            AcceptLanguage="en", Filters={"FullTextSearch": [product_name]}
+        ):
+            for product in page["ProductViewDetails"]:
+                summary = product["ProductViewSummary"]
+                if escape_and_lower_characters(summary["Name"]) == action.product_key:
+                    return summary["ProductId"]
     except Exception as e:
-        logger.error("Error searching products ... {}".format(e))
+        logger.error("Error searching product {} ... {}".format(product_name, e))
         raise e
-    for product in product_response["ProductViewDetails"]:
-        list_product_ids.append(product["ProductViewSummary"]["ProductId"])
-        list_product_names.append(product["ProductViewSummary"]["Name"])
-    for product_name in list_product_names:
-        product_name = escape_and_lower_characters(product_name)
-        list_formatted_product_names.append(product_name)
-    return list_product_ids, list_formatted_product_names
+    return None
 
 
-def escape_and_lower_characters(text: str):
-    """Format a string for easier comparision.
+@api_metrics_handler
+def process_work_items(event, context):
+    """Apply the sync actions, which service_catalog_janitor published to the sync queue.
+
+    The result is stored in the artifact bucket for gather_results(). Work items with an
+    existing result are skipped, as SQS may deliver a message more than once. Creates
+    are marked as started beforehand, so a redelivery after a worker crash resumes
+    with the product created by the crashed worker instead of creating it twice.
 
     Args:
-        text: String with special characters to be escaped
+        event: SQS event with work items from dispatch_plan()
+        context: Context of the lambda function
 
-    Return:
-        text: the escaped string
+    Returns:
+        No return.
     """
-    chars = "\\`*_{}[]()>#+-.!$/"
-    for c in chars:
-        text = text.replace(c, "")
-    text = text.lower()
-    return text
+    for record in event["Records"]:
+        work_item = json.loads(record["body"])
+        if get_sync_result(result_key=work_item["ResultKey"]) is not None:
+            logger.info(
+                "Skipping {} ... already applied".format(work_item["ResultKey"])
+            )
+            continue
+        action = SyncAction.from_dict(work_item["Action"])
+        portfolio_id = work_item["PortfolioId"]
+        config = load_work_item_config(work_item)
+        constraints = ConstraintIndex(portfolio_id=portfolio_id)
+        if action.operation == SyncAction.CREATE:
+            started_key = get_started_key(result_key=work_item["ResultKey"])
+            if get_sync_result(result_key=started_key) is None:
+                store_sync_result(result_key=started_key, template=action.template)
+            else:
+                action.product_id = find_created_product(action=action, config=config)
+                if action.product_id is not None:
+                    constraints = list_constraints_for_portfolio(
+                        portfolio_id=portfolio_id, product_id=action.product_id
+                    )
+        failures = apply_action(
+            action=action,
+            config=config,
+            portfolio_id=portfolio_id,
+            inventory=PortfolioInventory(portfolio_id=portfolio_id),
+            constraints=constraints,
+        )
+        store_sync_result(
+            result_key=work_item["ResultKey"],
+            template=action.template,
+            error=str(failures[action.template]) if failures else None,
+        )
+
 
+@api_metrics_handler
+def process_dead_letters(event, context):
+    """Record the work items, which the sync workers failed to process, as failed.
 
-def split_path(path: str):
-    """Format a path for easier comparision.
+    SQS moves a work item to the dead-letter queue after several failed receives, so
+    gather_results() gets its result without waiting for SYNC_RESULT_TIMEOUT.
 
     Args:
-        path: A systems path like src/conf/file.txt
+        event: SQS event of the dead-letter queue with work items from dispatch_plan()
+        context: Context of the lambda function
 
     Returns:
-        file_name: The file name
-        short_file_name: The file name without a suffix
+        No return.
     """
-    file_name = os.path.split(path)[-1]
-    short_file_name = file_name.split(".")[0]
-    return file_name, short_file_name
+    for record in event["Records"]:
+        work_item = json.loads(record["body"])
+        if get_sync_result(result_key=work_item["ResultKey"]) is not None:
+            continue
+        logger.error(
+            "Work item {} has been moved to the dead-letter queue ...".format(
+                work_item["ResultKey"]
+            )
+        )
+        store_sync_result(
+            result_key=work_item["ResultKey"],
+            template=work_item["Action"]["Template"],
+            error="The sync worker failed repeatedly ... moved to the dead-letter queue",
+        )
 
 
-def format_string_and_filenames(path: str,):
-    """Use split_path() and escape_and_lower_characters() to format string accordingly.
+def save_checkpoint(plan: SyncPlan, checkpoint_key: str = None):
+    """Store an incomplete plan in the artifact bucket.
 
     Args:
-        path: Path of a deleted, modified or newly created file within the Git Repository
+        plan: The incomplete SyncPlan
+        checkpoint_key: Key of an existing checkpoint to overwrite
 
     Returns:
-        formatted_string: string formatted
-        file_name: string formatted
-        short_file_name: string formatted
+        checkpoint_key: S3 object key of the checkpoint, used as continuation token
     """
-    file_name, short_file_name = split_path(path)
-    formatted_string = escape_and_lower_characters(file_name)
-    short_file_name = escape_and_lower_characters(short_file_name)
-    return formatted_string, file_name, short_file_name
+    if not checkpoint_key:
+        checkpoint_key = "{}{}.json".format(CHECKPOINT_PATH, uuid.uuid4())
+    try:
+        auto_s3_client.put_object(
+            Bucket=BUCKET,
+            Key=checkpoint_key,
+            Body=json.dumps(plan.to_dict()).encode("utf-8"),
+        )
+        logger.info(
+            "Checkpointed {} of {} actions to {} ...".format(
+                len(plan.completed), len(plan.actions), checkpoint_key
+            )
+        )
+    except Exception as e:
+        logger.error("Error while saving the sync checkpoint ... {}".format(e))
+        raise e
+    return checkpoint_key
 
 
-def update_portfolio(
-    config,
-    added_files: str,
-    portfolio_id: str,
-    modified_files: str,
-    product_ids: list,
-    product_names: list,
-):
-    """Orchestrate function to update the Servicecatalog. This function distinguishes new products and updates.
+def load_checkpoint(checkpoint_key: str):
+    """Load an incomplete plan from the artifact bucket.
 
     Args:
-        modified_files: List with modified files
-        added_files: List with newly added files
-        config: config object from download_config_file
-        portfolio_id: Id of the portfolio,
-        product_ids: List with all current product_ids
-        product_names: List with all current product_names
+        checkpoint_key: S3 object key from save_checkpoint()
 
     Returns:
-        No return.
+        plan: The SyncPlan including its progress
     """
-    logger.info("New CodePipeline execution detected ...")
-    logger.info("This files has been added {}".format(added_files.split(",")))
-    logger.info("This files has been updated {}".format(modified_files.split(",")))
+    try:
+        response = auto_s3_client.get_object(Bucket=BUCKET, Key=checkpoint_key)
+        plan = SyncPlan.from_dict(json.loads(response["Body"].read()))
+        logger.info(
+            "Resuming {} of {} actions from {} ...".format(
+                len(plan.get_pending_actions()), len(plan.actions), checkpoint_key
+            )
+        )
+    except Exception as e:
+        logger.error("Error while loading the sync checkpoint ... {}".format(e))
+        raise e
+    return plan
 
-    modifications = added_files.split(",") + modified_files.split(",")
-    for template in modifications:
-        if template.find(PATH) is not -1:
-            logger.info("This file have relevant changes {}".format(template))
-            try:
-                copy_tested_template(
-                    file_name="/tmp/" + template,
-                    bucket=BUCKET,
-                    object_name=S3_PATH + template.split("/")[2],
-                )
-                logger.info(
-                    """Copied CF-template from {} to template store {} ...
-                    """.format(
-                        "/tmp/" + template, S3_PATH + template.split("/")[2]
-                    )
-                )
-            except Exception as e:
-                logger.error(
-                    "Error copying CF-template(s) to template store ... {}".format(e)
-                )
-                raise e
-            try:
-                (
-                    formatted_string,
-                    file_name,
-                    short_file_name,
-                ) = format_string_and_filenames(path=template)
-                logger.info(
-                    """Filename: {}. String from for comparison: {}. String for lookup: {}
-                    """.format(
-                        file_name, formatted_string, short_file_name
-                    )
-                )
-            except Exception as e:
-                logger.error(
-                    "Error while formatting string for comparision ... {}".format(e)
-                )
-                raise e
-            if short_file_name in product_names:
-                index = product_names.index(short_file_name)
-                logger.info("Updating existing product in the HDI Servicecatalog ...")
-                logger.info(
-                    "ID of the product to be updated: {}".format(product_ids[index])
-                )
-                try:
-                    list_provisioning_artifact = auto_servicecatalog_client.list_provisioning_artifacts(
-                        AcceptLanguage="en", ProductId=product_ids[index],
-                    )
-                except Exception as e:
-                    logger.error(
-                        "Error while listing the existing product provisioning artifacts ... {}".format(
-                            e
-                        )
-                    )
-                    raise e
-                try:
-                    logger.info("Updating constraints ...")
-                    delete_constraint(
-                        product_id=product_ids[index], portfolio_id=portfolio_id
-                    )
-                except IndexError:
-                    try:
-                        create_constraint(
-                            product_id=product_ids[index], portfolio_id=portfolio_id
-                        )
-                    except Exception as e:
-                        logger.error(
-                            "Error while creating new product constraints ... {}".format(
-                                e
-                            )
-                        )
-                        raise e
-                try:
-                    create_constraint(
-                        product_id=product_ids[index], portfolio_id=portfolio_id
-                    )
-                except Exception as e:
-                    logger.error(
-                        "Error while creating new product constraints ... {}".format(e)
-                    )
-                    raise e
-                logger.info("Successfully updated product constraint ...")
-                try:
-                    create_provisioning_artifact_response = auto_servicecatalog_client.create_provisioning_artifact(
-                        AcceptLanguage="en",
-                        ProductId=product_ids[index],
-                        Parameters={
-                            "Name": config[file_name]["Name"],
-                            "Description": config[file_name]["Diff_Description"],
-                            "Info": {
-                                "LoadTemplateFromURL": config[file_name]["TemplateURL"],
-                            },
-                            "Type": config[file_name]["ProductType"],
-                            "DisableTemplateValidation": True,
-                        },
-                    )
-                except Exception as e:
-                    logger.error(
-                        "Error while creating the new product provisioning artifact ... {}".format(
-                            e
-                        )
-                    )
-                    raise e
-                try:
-                    logger.info("Updating provisioning artifact ...")
-                    auto_servicecatalog_client.update_provisioning_artifact(
-                        AcceptLanguage="en",
-                        ProductId=product_ids[index],
-                        ProvisioningArtifactId=create_provisioning_artifact_response[
-                            "ProvisioningArtifactDetail"
-                        ]["Id"],
-                        Name=config[file_name]["Version"],
-                        Description=config[file_name]["Diff_Description"],
-                        Active=True,
-                        Guidance="DEFAULT",
-                    )
-                except Exception as e:
-                    logger.error(
-                        "Error while updating the new product provisioning artifact ... {}".format(
-                            e
-                        )
-                    )
-                    raise e
-                try:
-                    auto_servicecatalog_client.delete_provisioning_artifact(
-                        AcceptLanguage="en",
-                        ProductId=product_ids[index],
-                        ProvisioningArtifactId=list_provisioning_artifact[
-                            "ProvisioningArtifactDetails"
-                        ][0]["Id"],
-                    )
-                except Exception as e:
-                    logger.error(
-                        "Error while deleting the existing product provisioning artifact ... {}".format(
-                            e
-                        )
-                    )
-                    raise e
-            else:
-                try:
-                    logger.info("Creating new Product for the HDI Servicecatalog ...")
-                    create_response = auto_servicecatalog_client.create_product(
-                        AcceptLanguage="en",
-                        Name=config[file_name]["Name"],
-                        Owner=config[file_name]["Owner"],
-                        Description=config[file_name]["Description"],
-                        SupportDescription=config[file_name]["SupportDescription"],
-                        SupportEmail=config[file_name]["SupportEmail"],
-                        SupportUrl=config[file_name]["SupportUrl"],
-                        ProductType=config[file_name]["ProductType"],
-                        Tags=[
-                            {
-                                "Key": config[file_name]["Key_1"],
-                                "Value": config[file_name]["Value_1"],
-                            }
-                        ],
-                        ProvisioningArtifactParameters={
-                            "Name": config[file_name]["Version"],
-                            "Description": config[file_name]["Diff_Description"],
-                            "Info": {
-                                "LoadTemplateFromURL": config[file_name]["TemplateURL"],
-                            },
-                            "Type": config[file_name]["ProductType"],
-                            "DisableTemplateValidation": True,
-                        },
-                    )
-                    logger.info(create_response)
-                    logger.info(
-                        "Successfully created a new HDI Servicecatalog product ..."
-                    )
-                except Exception as e:
-                    logger.error("Error while creating a new product ... {}".format(e))
-                    raise e
-                try:
-                    auto_servicecatalog_client.associate_product_with_portfolio(
-                        AcceptLanguage="en",
-                        ProductId=create_response["ProductViewDetail"][
-                            "ProductViewSummary"
-                        ]["ProductId"],
-                        PortfolioId=portfolio_id,
-                    )
-                except Exception as e:
-                    logger.error(
-                        "Error while associating the new product with portfolio ... {}".format(
-                            e
-                        )
-                    )
-                    raise e
-                try:
-                    create_constraint(
-                        portfolio_id=portfolio_id,
-                        product_id=create_response["ProductViewDetail"][
-                            "ProductViewSummary"
-                        ]["ProductId"],
-                    )
-                except Exception as e:
-                    logger.error(
-                        "Error while creating new constraint for the new product {} within portfolio {} ... {}".format(
-                            create_response["ProductViewDetail"]["ProductViewSummary"][
-                                "ProductId"
-                            ],
-                            portfolio_id,
-                            e,
-                        )
-                    )
-                    raise e
-        else:
-            logger.info("No relevant new files detected ...")
+
+def delete_checkpoint(checkpoint_key: str):
+    """Delete the checkpoint of a completed plan.
+
+    Args:
+        checkpoint_key: S3 object key from save_checkpoint()
+
+    Returns:
+        No return.
+    """
+    try:
+        auto_s3_client.delete_object(Bucket=BUCKET, Key=checkpoint_key)
+    except Exception as e:
+        logger.warning("Error while deleting the sync checkpoint ... {}".format(e))
 
 
 def associate_principal_within_this_account(
@@ -458,123 +2077,37 @@ def associate_principal_within_this_account(
             raise e
 
 
-def delete_product(
-    product_ids_list: list,
-    product_names_list: list,
-    deleted_files: list,
-    portfolio_id: str,
-    config,
+def delete_constraint(
+    constraints: ConstraintIndex, product_id: str, constraint_id: str
 ):
-    """Delete products from the portfolio, which are not mentioned in config.ini.
-
-    Args:
-        product_ids_list: Ids of all product within the portfolio
-        product_names_list: Names of all product within the portfolio
-        deleted_files: list with deleted files from the repository
-        portfolio_id: The portfolio id
-        config: The parsed config file
-
-    Returns:
-        No return.
-    """
-    sections_list = config.sections()
-    formatted_sections_list = []
-    formatted_products_list = []
-    formatted_deletions_list = []
-
-    for section in sections_list:
-        short_section = section.split(".")[0]
-        formatted_sections_list.append(escape_and_lower_characters(short_section))
-
-    for product in product_names_list:
-        formatted_products_list.append(escape_and_lower_characters(product))
-
-    for deletion in deleted_files:
-        formatted_deletions_list.append(escape_and_lower_characters(deletion))
-
-    logger.info(
-        """
-        The Following products are listed in config.ini {}.
-        And these are the products within HDI Servicecatalog: {}
-        """.format(
-            sections_list, product_names_list
-        )
-    )
-    logger.info(
-        """String comparison on sections {} and products {}
-        """.format(
-            formatted_sections_list, formatted_products_list
-        )
-    )
-    for i in formatted_products_list:
-        if i in formatted_deletions_list:
-            # if i not in formatted_sections_list:
-            index = formatted_products_list.index(i)
-            try:
-                delete_constraint(
-                    product_id=product_ids_list[index], portfolio_id=portfolio_id
-                )
-            except Exception as e:
-                logger.error(
-                    """
-                Error while deleting constraints for product {} ... {}
-                """.format(
-                        product_ids_list[index], e
-                    )
-                )
-                raise e
-            try:
-                auto_servicecatalog_client.delete_product(
-                    AcceptLanguage="en", Id=product_ids_list[index]
-                )
-            except Exception as e:
-                logger.error(
-                    "Error while deleting the outdated product from the portfolio ... {}".format(
-                        e
-                    )
-                )
-                raise e
-        else:
-            pass
-
-
-def delete_constraint(product_id: str, portfolio_id: str):
-    """Delete all product constraints.
+    """Delete a single product constraint.
 
     Args:
-        portfolio_id: existing portfolio id within the servicecatalog
+        constraints: ConstraintIndex with all current constraints
         product_id: changing product id
+        constraint_id: the constraint to be deleted
 
     Returns:
         No return
     """
     try:
-        logger.info("Deleting product constraints ...")
-        constraints_response = auto_servicecatalog_client.list_constraints_for_portfolio(
-            AcceptLanguage="en", ProductId=product_id, PortfolioId=portfolio_id,
-        )
-        logger.info("Outdated product constraint {} ...".format(constraints_response))
-    except Exception as e:
-        logger.error(
-            "Error listing the outdated product from the portfolio ... {}".format(e)
-        )
-        raise e
-    try:
-        logger.info(constraints_response["ConstraintDetails"][0]["ConstraintId"])
-        response = auto_servicecatalog_client.delete_constraint(
-            Id=constraints_response["ConstraintDetails"][0]["ConstraintId"]
-        )
-        logger.info("Product constraint {} deleted ...".format(response))
-    except IndexError as e:
-        logger.error(
-            "Error listing portfolio constraint - no one exists... {}".format(e)
+        logger.info("Deleting product constraint {} ...".format(constraint_id))
+        auto_servicecatalog_client.delete_constraint(
+            AcceptLanguage="en", Id=constraint_id
         )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ResourceNotFoundException":
+            logger.error("Error deleting product constraint ... {}".format(e))
+            raise e
+        logger.info("Product constraint {} does not exist ...".format(constraint_id))
+    constraints.remove_constraint(product_id=product_id, constraint_id=constraint_id)
 
 
-def create_constraint(portfolio_id: str, product_id: str):
+def create_constraint(constraints: ConstraintIndex, portfolio_id: str, product_id: str):
     """Create product constraints.
 
     Args:
+        constraints: ConstraintIndex with all current constraints
         portfolio_id: existing portfolio id within the servicecatalog
         product_id: existing product id within the servicecatalog
 
@@ -583,7 +2116,7 @@ def create_constraint(portfolio_id: str, product_id: str):
     """
     logger.info("Creating constraint on portfolio {} ...".format(portfolio_id))
     try:
-        auto_servicecatalog_client.create_constraint(
+        response = auto_servicecatalog_client.create_constraint(
             PortfolioId=portfolio_id,
             ProductId=product_id,
             Parameters=parsed_string,
@@ -593,8 +2126,12 @@ def create_constraint(portfolio_id: str, product_id: str):
     except Exception as e:
         logger.error("Error while creating launch constraints ... {}".format(e))
         raise e
+    constraint_detail = dict(response["ConstraintDetail"])
+    constraint_detail.setdefault("ProductId", product_id)
+    constraints.add_constraint(constraint_detail)
 
 
+@api_metrics_handler
 def service_catalog_janitor(event, context):
     """Orchestrate all other functions.
 
@@ -616,9 +2153,7 @@ def service_catalog_janitor(event, context):
     logger.info(params)
 
     portfolio_id = params["portfolio_id"]
-    updated_files = params["modified_files"]
-    new_files = params["added_files"]
-    outdated_files = params["deleted_files"]
+    continuation_token = job_data.get("continuationToken")
 
     try:
         config = download_config_file(event)
@@ -633,23 +2168,88 @@ def service_catalog_janitor(event, context):
         )
         raise e
     try:
-        list_product_ids, list_product_names = list_products_for_portfolio(
-            portfolio_id=portfolio_id
+        state = load_portfolio_state(
+            portfolio_id=portfolio_id,
+            commit_ids=[params.get("commit_id"), params.get("before_commit")],
+        )
+        inventory = state["products"]
+        constraints = state["constraints"]
+        logger.info("Currently known product ids: {}".format(inventory.product_ids()))
+        logger.info(
+            "Currently known product names: {}".format(inventory.product_names())
         )
-        logger.info("Currently known product ids: {}".format(list_product_ids))
-        logger.info("Currently known product names: {}".format(list_product_names))
     except Exception as e:
         logger.error("Error while listing all products ... {}".format(e))
         raise e
     try:
-        update_portfolio(
-            config=config,
-            portfolio_id=portfolio_id,
-            modified_files=updated_files,
-            added_files=new_files,
-            product_ids=list_product_ids,
-            product_names=list_product_names,
+        if continuation_token:
+            plan = load_checkpoint(checkpoint_key=continuation_token)
+        else:
+            if "change_manifest" in params:
+                (
+                    new_files,
+                    updated_files,
+                    outdated_files,
+                    renamed_files,
+                ) = load_change_manifest(manifest_key=params["change_manifest"])
+            else:
+                # Comma separated files of pipelines deployed before the manifest
+                new_files, updated_files, outdated_files = [
+                    params[name].split(",")
+                    for name in ["added_files", "modified_files", "deleted_files"]
+                ]
+                renamed_files = []
+            plan = plan_portfolio_sync(
+                config=config,
+                added_files=new_files,
+                modified_files=updated_files,
+                deleted_files=outdated_files,
+                inventory=inventory,
+                constraints=constraints,
+                renamed_files=renamed_files,
+            )
+        logger.info("Sync plan: {}".format([a.to_dict() for a in plan.actions]))
+        logger.info("Sync plan summary: {}".format(plan.summary()))
+    except Exception as e:
+        put_job_failure(
+            codepipeline_client=auto_codepipeline_client,
+            job=job_id,
+            message="Error while planning the Service Catalog sync ... {}".format(e),
+        )
+        raise e
+    if str(params.get("dry_run", "false")).lower() == "true":
+        put_job_success(
+            codepipeline_client=auto_codepipeline_client,
+            job=job_id,
+            message="Dry run of the HDI Servicecatalog sync ...",
+            output_variables={
+                "plan": json.dumps(plan.summary()),
+                "predicted_api_calls": str(plan.api_calls),
+            },
+        )
+        return
+    fan_out = plan.fanout_id is not None or (
+        SYNC_QUEUE_URL is not None
+        and len(plan.get_pending_actions()) >= SYNC_FANOUT_THRESHOLD
+    )
+
+    def should_stop():
+        return (
+            context is not None
+            and context.get_remaining_time_in_millis() < CHECKPOINT_MARGIN_MS
         )
+
+    try:
+        if fan_out:
+            fan_out_plan(plan=plan, config=config, should_stop=should_stop)
+        else:
+            apply_plan(
+                plan=plan,
+                config=config,
+                inventory=inventory,
+                constraints=constraints,
+                should_stop=should_stop,
+            )
         logger.info("Updated HDI Service Catalog ...")
     except Exception as e:
         put_job_failure(
@@ -657,27 +2257,37 @@ def service_catalog_janitor(event, context):
             job=job_id,
             message="Error while updating Service Catalog portfolio ... {}".format(e),
         )
+        if continuation_token:
+            delete_checkpoint(checkpoint_key=continuation_token)
         raise e
-    if len(outdated_files.split(",")) != 0:
+    finally:
+        logger.info(
+            "Service Catalog throttling: {}".format(auto_servicecatalog_client.stats)
+        )
+    if not plan.is_complete:
         try:
-            logger.info("Checking for product deletion requests ...")
-            delete_product(
-                product_ids_list=list_product_ids,
-                product_names_list=list_product_names,
-                portfolio_id=portfolio_id,
-                deleted_files=outdated_files.split(","),
-                config=config,
+            checkpoint_key = save_checkpoint(
+                plan=plan, checkpoint_key=continuation_token
             )
-            logger.info("Finished product deletion requests ...")
         except Exception as e:
             put_job_failure(
                 codepipeline_client=auto_codepipeline_client,
                 job=job_id,
-                message="Error while deleting outdated HDI Service Catalog products ... {}".format(
+                message="Error while checkpointing the Service Catalog sync ... {}".format(
                     e
                 ),
             )
             raise e
+        put_job_success(
+            codepipeline_client=auto_codepipeline_client,
+            job=job_id,
+            message="Continuing the HDI Servicecatalog sync in a new invocation ...",
+            output_variables=None,
+            continuation_token=checkpoint_key,
+        )
+        return
+    if continuation_token:
+        delete_checkpoint(checkpoint_key=continuation_token)
     try:
         logger.info(
             "Assigning principals to portfolio {} in this account ...".format(
@@ -696,9 +2306,24 @@ def service_catalog_janitor(event, context):
             message="Error while associating IAM roles in this account... {}".format(e),
         )
         raise e
+    if fan_out or not params.get("commit_id"):
+        # The workers changed the portfolio behind the back of this container, or
+        # there is no commit to cache the state for
+        invalidate_cached_state(portfolio_id=portfolio_id)
+    else:
+        put_cached_state(
+            portfolio_id=portfolio_id, commit_id=params["commit_id"], state=state
+        )
+    # The next pipeline execution diffs against this commit
+    if params.get("commit_id"):
+        put_last_synced_commit(
+            bucket=BUCKET, portfolio_id=portfolio_id, commit_id=params["commit_id"]
+        )
+    # Counts only, the changed files are listed in the change manifest
     output_vars = {
-        "new_products": new_files,
-        "updated_products": updated_files,
+        "new_products": str(len(plan.get_actions(SyncAction.CREATE))),
+        "updated_products": str(len(plan.get_actions(SyncAction.UPDATE))),
+        "deleted_products": str(len(plan.get_actions(SyncAction.DELETE))),
     }
     put_job_success(
         codepipeline_client=auto_codepipeline_client,
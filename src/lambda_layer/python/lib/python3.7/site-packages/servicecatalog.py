@@ -1,8 +1,20 @@
+import csv
+import functools
+import io
+import itertools
 import logging
+import math
 import os
+import random
+import threading
+import time
 import boto3
 import json
-from botocore.exceptions import ClientError
+import xml.sax.saxutils
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
 
 import datetime
 from dateutil.relativedelta import relativedelta
@@ -12,108 +24,1598 @@ log_level = os.environ.get("LOG_LEVEL", "INFO")
 logging.root.setLevel(logging.getLevelName(log_level))  # type: ignore
 logger = logging.getLogger(__name__)
 
+# Error codes, which signal a throttled API call
+THROTTLING_ERROR_CODES = [
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "SlowDown",
+]
 
-def send_notification(subject_phrase, topic_arn, presigned_url, expiration):
+# Sustained requests per second and burst size per API family, see get_api_family()
+API_FAMILY_RATES = {
+    "read": (float(os.environ.get("API_READ_RATE", "10")), 20),
+    "write": (float(os.environ.get("API_WRITE_RATE", "4")), 4),
+}
+
+# CloudWatch namespace of the API call metrics, see emit_api_metrics()
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "ServiceCatalogCICD")
+
+# Embedded metric format allows at most 100 values per metric and document
+EMF_MAX_VALUES = 100
+
+# API call metrics of the current invocation, keyed by service and operation
+api_metrics = {}
+api_metrics_lock = threading.Lock()
+
+# Connections per client, enough for the concurrent syncs and artifact pruning
+CLIENT_POOL_SIZE = int(os.environ.get("CLIENT_POOL_SIZE", "20"))
+
+# Clients of this account shared within the container, see get_client()
+clients = {}
+clients_lock = threading.Lock()
+
+# Cost Explorer dimensions of the cost report and their column names
+REPORT_GROUP_BY = ["SERVICE"]
+REPORT_COLUMN_NAMES = {"SERVICE": "Service_AWS", "LINKED_ACCOUNT": "Account_AWS"}
+
+# S3 cache of the daily costs, see get_cached_cost_rows()
+COST_CACHE_BUCKET = os.environ.get("COST_CACHE_BUCKET")
+COST_CACHE_PATH = os.environ.get("COST_CACHE_PATH", "cost-cache/")
+
+# Cost Explorer still adjusts the costs of the last days, those are not cached
+COST_CACHE_SETTLE_DAYS = int(os.environ.get("COST_CACHE_SETTLE_DAYS", "3"))
+
+# Rolling baseline and anomaly thresholds of the cost analysis, see analyze_costs()
+COST_BASELINE_DAYS = int(os.environ.get("COST_BASELINE_DAYS", "28"))
+COST_ANOMALY_THRESHOLD = float(os.environ.get("COST_ANOMALY_THRESHOLD", "3"))
+COST_ANOMALY_MIN_AMOUNT = float(os.environ.get("COST_ANOMALY_MIN_AMOUNT", "1"))
+
+# Keeps series with constant costs from scoring every cent as an anomaly
+COST_ANOMALY_MIN_DEVIATION = 0.01
+
+# Days of the run rate of the month-end forecast and series listed in notifications
+COST_RUN_RATE_DAYS = 7
+COST_FORECAST_TOP = 10
+
+# Key prefix, content types and URL expiration of delivered reports, see deliver_report()
+REPORT_PATH = os.environ.get("REPORT_PATH", "cost-reports/")
+REPORT_CONTENT_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "parquet": "application/octet-stream",
+}
+REPORT_URL_EXPIRATION = int(os.environ.get("REPORT_URL_EXPIRATION", "86400"))
+
+# Reports above this size are uploaded in parts of this size, at least 5 MiB
+REPORT_MULTIPART_THRESHOLD = max(
+    int(os.environ.get("REPORT_MULTIPART_THRESHOLD", str(8 * 1024 * 1024))),
+    5 * 1024 * 1024,
+)
+
+# Rows per row group of Parquet reports
+PARQUET_ROW_GROUP_SIZE = int(os.environ.get("PARQUET_ROW_GROUP_SIZE", "10000"))
+
+# Static parts of a workbook with a single worksheet, see write_xlsx_report()
+XLSX_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        "</Types>"
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        "</Relationships>"
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+        ' xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="CostReport" sheetId="1" r:id="rId1"/></sheets>'
+        "</workbook>"
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        "</Relationships>"
+    ),
+}
+XLSX_SHEET_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    "<sheetData>"
+)
+XLSX_SHEET_FOOTER = "</sheetData></worksheet>"
+
+# Folder of the last synced commit per portfolio within the artifact bucket
+SYNCED_COMMITS_PATH = os.environ.get("SYNCED_COMMITS_PATH", "synced-commits/")
+
+# Sessions of assumed roles per role ARN and session name, see get_account_session()
+account_sessions = {}
+account_session_locks = {}
+account_sessions_lock = threading.Lock()
+
+# Assumed role credentials are renewed this many seconds before they expire
+CREDENTIALS_REFRESH_MARGIN = int(os.environ.get("CREDENTIALS_REFRESH_MARGIN", "300"))
+
+# One session name for all teardown operations, so each account is assumed once
+DELETE_SESSION_NAME = "DeletePrincipalManagement"
+
+# Accounts processed at once by run_for_accounts()
+ACCOUNT_MAX_WORKERS = int(os.environ.get("ACCOUNT_MAX_WORKERS", "10"))
+
+# Outcomes of an account in the report of run_for_accounts()
+ACCOUNT_SUCCEEDED = "Succeeded"
+ACCOUNT_FAILED = "Failed"
+ACCOUNT_SKIPPED = "Skipped"
+
+# Token buckets shared by all clients of a Lambda container
+token_buckets = {}
+token_buckets_lock = threading.Lock()
+
+
+class TokenBucket:
+    """Token bucket rate limiter, safe to share between threads."""
+
+    def __init__(self, rate: float, capacity: int):
+        """Init a full bucket.
+
+        Args:
+            rate: Tokens added per second
+            capacity: Maximum number of tokens, i.e. the burst size
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token and block until one is available.
+
+        Returns:
+            waited: Seconds spent waiting for the token
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def reserve(self):
+        """Take a token without blocking, even if the bucket runs into debt.
+
+        Returns:
+            delay: Seconds until the rate covers the token
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+
+def get_api_family(operation_name: str):
+    """Map an API operation to its rate limit family.
+
+    Args:
+        operation_name: The API operation like SearchProductsAsAdmin
+
+    Returns:
+        read or write
+    """
+    if operation_name.startswith(("Describe", "List", "Search", "Get", "Scan")):
+        return "read"
+    return "write"
+
+
+def get_token_bucket(service_name: str, family: str):
+    """Get the token bucket of an API family, shared within the container.
+
+    Args:
+        service_name: The service id like service-catalog
+        family: The API family from get_api_family()
+
+    Returns:
+        The TokenBucket
+    """
+    with token_buckets_lock:
+        key = (service_name, family)
+        if key not in token_buckets:
+            rate, capacity = API_FAMILY_RATES[family]
+            token_buckets[key] = TokenBucket(rate=rate, capacity=capacity)
+        return token_buckets[key]
+
+
+class ThrottledClient:
+    """Wrap a boto3 client with the shared rate limiter and throttling-aware retries.
+
+    The wrapper hooks into the botocore events of the client, so paginators and
+    waiters are limited and retried as well. All other attributes are passed
+    through to the client.
+    """
+
+    def __init__(
+        self,
+        client,
+        max_attempts: int = 8,
+        base_delay: float = 0.5,
+        max_delay: float = 20.0,
+    ):
+        """Init the wrapper and register the event handlers.
+
+        Args:
+            client: A boto3 client, ideally created with botocore retries disabled
+            max_attempts: Maximum number of attempts of a throttled call
+            base_delay: Base of the exponential backoff in seconds
+            max_delay: Upper bound of a single backoff in seconds
+        """
+        self._client = client
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttles = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+        self._service = client.meta.service_model.service_id.hyphenize()
+        client.meta.events.register(
+            "before-call.{}".format(self._service), self._acquire_token
+        )
+        client.meta.events.register(
+            "needs-retry.{}".format(self._service), self._needs_retry
+        )
+
+    def __getattr__(self, name):
+        """Pass through everything else to the wrapped client."""
+        return getattr(self._client, name)
+
+    @property
+    def stats(self):
+        """Return the counters of throttled and retried calls."""
+        return {"throttles": self.throttles, "retries": self.retries}
+
+    def _acquire_token(self, model, **kwargs):
+        """Take a token of the API family before each call."""
+        get_token_bucket(self._service, get_api_family(model.name)).acquire()
+
+    def _needs_retry(self, response, operation, attempts, caught_exception, **kwargs):
+        """Return the backoff in seconds for throttled or dropped calls, otherwise None.
+
+        botocore sleeps for the returned delay before the retry. The retry takes its
+        token of the API family right away, so the delay covers both the backoff and
+        the wait for the token.
+        """
+        if response is None:
+            if not isinstance(caught_exception, (ConnectionError, HTTPClientError)):
+                return None
+        elif response[1].get("Error", {}).get("Code") not in THROTTLING_ERROR_CODES:
+            return None
+        with self._lock:
+            if response is not None:
+                self.throttles += 1
+            if attempts >= self.max_attempts:
+                logger.error(
+                    "{} still failing after {} attempts ...".format(
+                        operation.name, attempts
+                    )
+                )
+                return None
+            self.retries += 1
+        # Exponential backoff with full jitter
+        delay = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        )
+        delay = max(
+            delay,
+            get_token_bucket(self._service, get_api_family(operation.name)).reserve(),
+        )
+        logger.info(
+            "{} failed, retrying in {:.2f}s ({}/{}) ...".format(
+                operation.name, delay, attempts, self.max_attempts
+            )
+        )
+        return delay
+
+
+def get_client_config(**config_kwargs):
+    """Build the client config with a larger connection pool and TCP keep-alive.
+
+    Args:
+        **config_kwargs: Overrides for botocore.config.Config
+
+    Returns:
+        The botocore Config
+    """
+    config = Config(
+        max_pool_connections=CLIENT_POOL_SIZE, connect_timeout=5, read_timeout=60,
+    )
+    try:
+        # TCP keep-alive needs botocore 1.27.84 or newer
+        config = config.merge(Config(tcp_keepalive=True))
+    except TypeError:
+        logger.debug("TCP keep-alive is not supported by this botocore version")
+    return config.merge(Config(**config_kwargs))
+
+
+def create_client(service_name: str, endpoint_url: str = None, **config_kwargs):
+    """Create a client of this account from the shared, instrumented boto3 session.
+
+    Args:
+        service_name: The boto3 service name like servicecatalog
+        endpoint_url: Optional endpoint, e.g. of a local stand-in
+        **config_kwargs: Overrides for botocore.config.Config
+
+    Returns:
+        The boto3 client
+    """
+    # Creating clients from one session is not thread-safe
+    with clients_lock:
+        return boto3.DEFAULT_SESSION.client(
+            service_name,
+            endpoint_url=endpoint_url,
+            config=get_client_config(**config_kwargs),
+        )
+
+
+def get_client(service_name: str, endpoint_url: str = None):
+    """Get the client of a service, shared by all modules of the container.
+
+    Args:
+        service_name: The boto3 service name like servicecatalog
+        endpoint_url: Optional endpoint, e.g. of a local stand-in
+
+    Returns:
+        The boto3 client
+    """
+    key = (service_name, endpoint_url)
+    if key not in clients:
+        client = create_client(service_name, endpoint_url=endpoint_url)
+        with clients_lock:
+            clients.setdefault(key, client)
+    return clients[key]
+
+
+class LazyClient:
+    """Create a client on its first use, so unused clients do not slow down cold starts.
+
+    All attributes are passed through to the client.
+    """
+
+    def __init__(self, factory):
+        """Init the proxy.
+
+        Args:
+            factory: Callable without arguments, which creates the client
+        """
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        """Create the client if needed and pass through the attribute."""
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+        return getattr(self._instance, name)
+
+
+def lazy_client(service_name: str, endpoint_url: str = None):
+    """Get the shared client of a service, created on first use.
+
+    Args:
+        service_name: The boto3 service name like servicecatalog
+        endpoint_url: Optional endpoint, e.g. of a local stand-in
+
+    Returns:
+        The LazyClient
+    """
+    return LazyClient(
+        functools.partial(get_client, service_name, endpoint_url=endpoint_url)
+    )
+
+
+def throttled_client(service_name: str, **kwargs):
+    """Create a boto3 client on first use, which is rate limited and retries throttled calls.
+
+    Args:
+        service_name: The boto3 service name like servicecatalog
+        **kwargs: Passed through to ThrottledClient
+
+    Returns:
+        The LazyClient of the ThrottledClient
+    """
+
+    def factory():
+        # A single attempt, so only ThrottledClient retries
+        client = create_client(
+            service_name, retries={"total_max_attempts": 1, "mode": "standard"}
+        )
+        return ThrottledClient(client, **kwargs)
+
+    return LazyClient(factory)
+
+
+def _start_api_call(model, context, **kwargs):
+    """Remember the operation and start of an API call within its request context."""
+    context["api_metrics_call"] = (
+        model.service_model.service_id.hyphenize(),
+        model.name,
+        time.monotonic(),
+    )
+
+
+def _record_api_call(context, parsed=None, exception=None, **kwargs):
+    """Record latency, retries and error code of a finished API call."""
+    if "api_metrics_call" not in context:
+        return
+    service, operation, start = context.pop("api_metrics_call")
+    latency = (time.monotonic() - start) * 1000
+    error_code = None
+    retries = 0
+    if parsed is not None:
+        error_code = parsed.get("Error", {}).get("Code")
+        retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+    elif exception is not None:
+        error_code = type(exception).__name__
+    with api_metrics_lock:
+        metrics = api_metrics.setdefault(
+            (service, operation), {"Latency": [], "Retries": 0, "ErrorCodes": {}}
+        )
+        metrics["Latency"].append(round(latency, 2))
+        metrics["Retries"] += retries
+        if error_code:
+            metrics["ErrorCodes"][error_code] = (
+                metrics["ErrorCodes"].get(error_code, 0) + 1
+            )
+
+
+def instrument_session(session=None):
+    """Record metrics of every API call made by clients of a boto3 session.
+
+    Clients copy the event handlers of their session, so the session has to be
+    instrumented before the clients are created. The latency covers the whole
+    call, including retries.
+
+    Args:
+        session: A boto3 session, defaults to the session behind boto3.client()
+
+    Returns:
+        No return.
+    """
+    if session is None:
+        if boto3.DEFAULT_SESSION is None:
+            boto3.setup_default_session()
+        session = boto3.DEFAULT_SESSION
+    session.events.register(
+        "before-call", _start_api_call, unique_id="api-metrics-before-call"
+    )
+    session.events.register(
+        "after-call", _record_api_call, unique_id="api-metrics-after-call"
+    )
+    session.events.register(
+        "after-call-error", _record_api_call, unique_id="api-metrics-after-call-error"
+    )
+
+
+def emit_api_metrics(handler_name: str):
+    """Print the recorded API call metrics in CloudWatch embedded metric format.
+
+    One document is printed per service and operation. Operations with more than
+    EMF_MAX_VALUES calls continue their latencies in further documents. The
+    metrics are reset afterwards.
+
+    Args:
+        handler_name: Name of the Lambda handler, used as dimension
+
+    Returns:
+        No return.
+    """
+    with api_metrics_lock:
+        recorded_metrics = dict(api_metrics)
+        api_metrics.clear()
+    timestamp = int(time.time() * 1000)
+    for (service, operation), metrics in sorted(recorded_metrics.items()):
+        latencies = metrics["Latency"]
+        for index in range(0, len(latencies), EMF_MAX_VALUES):
+            document = {
+                "Handler": handler_name,
+                "Service": service,
+                "Operation": operation,
+                "Latency": latencies[index:][:EMF_MAX_VALUES],
+            }
+            metric_definitions = [{"Name": "Latency", "Unit": "Milliseconds"}]
+            if index == 0:
+                document.update(
+                    {
+                        "Calls": len(latencies),
+                        "Retries": metrics["Retries"],
+                        "Errors": sum(metrics["ErrorCodes"].values()),
+                        "ErrorCodes": metrics["ErrorCodes"],
+                    }
+                )
+                metric_definitions += [
+                    {"Name": "Calls", "Unit": "Count"},
+                    {"Name": "Retries", "Unit": "Count"},
+                    {"Name": "Errors", "Unit": "Count"},
+                ]
+            document["_aws"] = {
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": METRICS_NAMESPACE,
+                        "Dimensions": [["Handler", "Service", "Operation"]],
+                        "Metrics": metric_definitions,
+                    }
+                ],
+            }
+            # Embedded metrics have to be a log line of their own, without prefix
+            print(json.dumps(document))
+
+
+def api_metrics_handler(handler):
+    """Decorate a Lambda handler to emit the metrics of its API calls.
+
+    Args:
+        handler: The Lambda handler
+
+    Returns:
+        The decorated Lambda handler
+    """
+
+    @functools.wraps(handler)
+    def wrapper(event, context, *args, **kwargs):
+        # Warm containers still hold metrics of earlier invocations
+        with api_metrics_lock:
+            api_metrics.clear()
+        try:
+            return handler(event, context, *args, **kwargs)
+        finally:
+            emit_api_metrics(handler_name=handler.__name__)
+
+    return wrapper
+
+
+# Instrument every client created through boto3.client() by the importing modules
+instrument_session()
+
+
+def send_notification(
+    subject_phrase, topic_arn, presigned_url=None, expiration=None, message=None
+):
     """Send the resigned_url as a notification to a SNS topic.
 
     Args:
-        subject_phrase: Email subject
-        topic_arn: The SNS topic ARN
-        presigned_url: The presigend URl
-        expiration: The time until expiration of presigned url
+        subject_phrase: Email subject
+        topic_arn: The SNS topic ARN
+        presigned_url: The presigend URl
+        expiration: The time until expiration of presigned url
+        message: Message to send instead of the presigned URL
+
+    Returns:
+        No returns.
+    """
+    sns_client = get_client("sns")
+    if message is None:
+        message = """
+            This is a notification about your daily AWS spending.
+            You can download them within the next {} hours from here: {}
+            """.format(
+            expiration / 3600, presigned_url
+        )
+    try:
+        sns_client.publish(
+            Subject=subject_phrase, TargetArn=topic_arn, Message=message,
+        )
+    except Exception as e:
+        raise e
+
+
+def create_presigned_url(bucket, object_key, expiration_time):
+    """Generate a presigned URL to share a S3 object.
+
+    Args:
+        bucket: The destination S3 bucket.
+        object_key: The object key within S3.
+        expiration_time: The expiration time for the URL in seconds.
+
+    Returns:
+        presigned_url: The presigned URL.
+    """
+    s3_client = get_client("s3")
+    try:
+        presigned_url = s3_client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket, "Key": object_key},
+            ExpiresIn=expiration_time,
+        )
+    except Exception as e:
+        raise e
+    return presigned_url
+
+
+def upload_file(file_name, bucket, object_key):
+    """Upload the excel file to s3.
+
+    Args:
+        file_name: The name of file to be uploaded or a readable binary file object,
+            like the buffer returned by generate_excel()
+        bucket: The S3 Bucket to save file
+        object_key: The S3 object key
+
+    Returns:
+        No return.
+    """
+    s3_client = get_client("s3")
+    try:
+        if hasattr(file_name, "read"):
+            s3_client.upload_fileobj(Fileobj=file_name, Bucket=bucket, Key=object_key)
+        else:
+            s3_client.upload_file(Filename=file_name, Bucket=bucket, Key=object_key)
+    except Exception as e:
+        raise e
+
+
+class S3UploadStream(io.BufferedIOBase):
+    """Write-only file object, which uploads to S3 while it is written.
+
+    Small objects are sent with a single put_object on close. Once more than
+    REPORT_MULTIPART_THRESHOLD bytes are written, the stream switches to a
+    multipart upload and only holds the current part in memory.
+    """
+
+    def __init__(self, bucket: str, object_key: str, content_type: str = None):
+        """Init the stream.
+
+        Args:
+            bucket: The destination S3 bucket
+            object_key: The object key within S3
+            content_type: Content type of the object
+        """
+        super().__init__()
+        self.bucket = bucket
+        self.object_key = object_key
+        self.extra_args = {"ContentType": content_type} if content_type else {}
+        self.s3_client = get_client("s3")
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        self.parts = []
+
+    def writable(self):
+        """Return True, the stream is write-only."""
+        return True
+
+    def tell(self):
+        """Return the number of bytes written so far."""
+        return self.position
+
+    def write(self, data):
+        """Append data and upload every full part.
+
+        Args:
+            data: Bytes-like object
+
+        Returns:
+            size: Number of bytes written
+        """
+        if self.closed:
+            raise ValueError("write to closed S3UploadStream")
+        self.buffer.extend(data)
+        self.position += len(data)
+        while len(self.buffer) >= REPORT_MULTIPART_THRESHOLD:
+            self.upload_part(bytes(self.buffer[:REPORT_MULTIPART_THRESHOLD]))
+            del self.buffer[:REPORT_MULTIPART_THRESHOLD]
+        return len(data)
+
+    def upload_part(self, body: bytes):
+        """Upload the next part, the multipart upload is started on the first one.
+
+        Args:
+            body: Content of the part
+
+        Returns:
+            No return.
+        """
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.object_key, **self.extra_args
+            )["UploadId"]
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.object_key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        """Upload the rest and complete the object.
+
+        Returns:
+            No return.
+        """
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                self.s3_client.put_object(
+                    Bucket=self.bucket,
+                    Key=self.object_key,
+                    Body=bytes(self.buffer),
+                    **self.extra_args
+                )
+            else:
+                if self.buffer:
+                    self.upload_part(bytes(self.buffer))
+                self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.object_key,
+                    UploadId=self.upload_id,
+                    MultipartUpload={"Parts": self.parts},
+                )
+        except Exception as e:
+            self.abort()
+            raise e
+        self.buffer = bytearray()
+        super().close()
+
+    def abort(self):
+        """Drop the object and the parts uploaded so far.
+
+        Returns:
+            No return.
+        """
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.object_key, UploadId=self.upload_id
+            )
+            self.upload_id = None
+        self.buffer = bytearray()
+        super().close()
+
+
+def get_cost_rows(
+    start: str, end: str, group_by: list = None, metric: str = "BlendedCost"
+):
+    """Yield the daily costs from Cost Explorer page by page.
+
+    Cost Explorer splits large responses, e.g. many days or two group dimensions,
+    into pages. Only one page is held in memory at a time.
+
+    Args:
+        start: First day of the report, e.g. "2020-07-01"
+        end: Day after the last day of the report
+        group_by: Cost Explorer dimensions to group by, at most two
+        metric: The cost metric, e.g. "BlendedCost" or "UnblendedCost"
+
+    Returns:
+        rows: Generator of [day, *group keys, amount]
+    """
+    ce_client = get_client("ce")
+    request = {
+        "TimePeriod": {"Start": start, "End": end},
+        "Granularity": "DAILY",
+        "Metrics": [metric],
+        "GroupBy": [
+            {"Type": "DIMENSION", "Key": key} for key in group_by or REPORT_GROUP_BY
+        ],
+    }
+    while True:
+        response = ce_client.get_cost_and_usage(**request)
+        for result in response["ResultsByTime"]:
+            for group in result["Groups"]:
+                yield [result["TimePeriod"]["Start"]] + group["Keys"] + [
+                    float(group["Metrics"][metric]["Amount"])
+                ]
+        if not response.get("NextPageToken"):
+            break
+        request["NextPageToken"] = response["NextPageToken"]
+
+
+def write_csv_report(rows, columns: list, fileobj):
+    """Stream report rows as CSV into a binary file object.
+
+    Args:
+        rows: Iterable of report rows
+        columns: Column names of the header row
+        fileobj: Writable binary file object
+
+    Returns:
+        No return.
+    """
+    text = io.TextIOWrapper(fileobj, encoding="utf-8", newline="")
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+    text.flush()
+    # Keep fileobj open for the caller
+    text.detach()
+
+
+def get_xlsx_cell(value):
+    """Render a value as an inline cell of a worksheet.
+
+    Args:
+        value: A bool, a number or a string
+
+    Returns:
+        cell: The <c> element, empty for NaN and infinite numbers
+    """
+    if isinstance(value, bool):
+        return '<c t="b"><v>{:d}</v></c>'.format(value)
+    if isinstance(value, (int, float)):
+        if isinstance(value, float) and not math.isfinite(value):
+            return "<c/>"
+        return "<c><v>{!r}</v></c>".format(value)
+    return '<c t="inlineStr"><is><t>{}</t></is></c>'.format(
+        xml.sax.saxutils.escape(str(value))
+    )
+
+
+def write_xlsx_report(rows, columns: list, fileobj):
+    """Stream report rows into a write-only Excel workbook.
+
+    The worksheet uses inline strings instead of a shared string table, so rows
+    are compressed into the archive as they arrive.
+
+    Args:
+        rows: Iterable of report rows
+        columns: Column names of the header row
+        fileobj: Writable binary file object
+
+    Returns:
+        No return.
+    """
+    with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED) as workbook:
+        for name, content in XLSX_PARTS.items():
+            workbook.writestr(name, content)
+        with workbook.open("xl/worksheets/sheet1.xml", "w") as sheet:
+            sheet.write(XLSX_SHEET_HEADER.encode("utf-8"))
+            for row in itertools.chain([columns], rows):
+                sheet.write(
+                    "<row>{}</row>".format(
+                        "".join(get_xlsx_cell(value) for value in row)
+                    ).encode("utf-8")
+                )
+            sheet.write(XLSX_SHEET_FOOTER.encode("utf-8"))
+
+
+def import_pyarrow():
+    """Import pyarrow and its Parquet module on first use.
+
+    pyarrow only ships with the analytics layer and is slow to import.
+
+    Returns:
+        pyarrow: The pyarrow module
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet  # noqa: F401
+    except ImportError as e:
+        logger.error("Parquet needs the analytics layer: {}".format(e))
+        raise e
+    return pyarrow
+
+
+def import_numpy():
+    """Import numpy on first use, it only ships with the analytics layer.
+
+    Returns:
+        numpy: The numpy module
+    """
+    try:
+        import numpy
+    except ImportError as e:
+        logger.error("Cost analysis needs the analytics layer: {}".format(e))
+        raise e
+    return numpy
+
+
+def write_parquet_report(rows, columns: list, fileobj):
+    """Stream report rows into a Parquet file, one row group at a time.
+
+    Needs pyarrow, which only ships with the analytics layer.
+
+    Args:
+        rows: Iterable of report rows
+        columns: Column names, the last one holds the amount
+        fileobj: Writable binary file object
+
+    Returns:
+        No return.
+    """
+    pyarrow = import_pyarrow()
+    schema = pyarrow.schema(
+        [pyarrow.field(column, pyarrow.string()) for column in columns[:-1]]
+        + [pyarrow.field(columns[-1], pyarrow.float64())]
+    )
+    with pyarrow.parquet.ParquetWriter(fileobj, schema) as writer:
+        batch = list(itertools.islice(rows, PARQUET_ROW_GROUP_SIZE))
+        while batch:
+            writer.write_table(
+                pyarrow.Table.from_arrays(
+                    [pyarrow.array(column) for column in zip(*batch)], schema=schema
+                )
+            )
+            batch = list(itertools.islice(rows, PARQUET_ROW_GROUP_SIZE))
+
+
+def get_report_columns(group_by: list):
+    """Get the column names of a cost report.
+
+    Args:
+        group_by: Cost Explorer dimensions of the report
+
+    Returns:
+        columns: Date, one column per dimension and the amount
+    """
+    return (
+        ["Date"]
+        + [REPORT_COLUMN_NAMES.get(key, key.title()) for key in group_by]
+        + ["Amount_$"]
+    )
+
+
+def get_cost_partition_key(day: str, group_by: list, metric: str):
+    """Get the S3 key of the cached costs of one day.
+
+    Args:
+        day: The day, e.g. "2020-07-01"
+        group_by: Cost Explorer dimensions of the costs
+        metric: The cost metric
+
+    Returns:
+        key: S3 key of the Parquet partition
+    """
+    return "{}metric={}/group_by={}/day={}.parquet".format(
+        COST_CACHE_PATH, metric, "+".join(group_by), day
+    )
+
+
+def get_cached_days(group_by: list, metric: str):
+    """List the days with cached costs.
+
+    Args:
+        group_by: Cost Explorer dimensions of the costs
+        metric: The cost metric
+
+    Returns:
+        days: Set of cached days
+    """
+    prefix = get_cost_partition_key("", group_by, metric)[: -len(".parquet")]
+    paginator = get_client("s3").get_paginator("list_objects_v2")
+    days = set()
+    for page in paginator.paginate(Bucket=COST_CACHE_BUCKET, Prefix=prefix):
+        for item in page.get("Contents", []):
+            days.add(item["Key"].rsplit("=", 1)[-1].replace(".parquet", ""))
+    return days
+
+
+def read_cost_partition(key: str):
+    """Read the cached costs of one day.
+
+    Args:
+        key: S3 key of the Parquet partition
+
+    Returns:
+        rows: List of [day, *group keys, amount]
+    """
+    pyarrow = import_pyarrow()
+    response = get_client("s3").get_object(Bucket=COST_CACHE_BUCKET, Key=key)
+    table = pyarrow.parquet.read_table(pyarrow.BufferReader(response["Body"].read()))
+    return [list(row) for row in zip(*table.to_pydict().values())]
+
+
+def write_cost_partition(key: str, rows: list, columns: list):
+    """Cache the costs of one day.
+
+    Args:
+        key: S3 key of the Parquet partition
+        rows: List of [day, *group keys, amount]
+        columns: Column names of the partition
+
+    Returns:
+        No return.
+    """
+    buffer = io.BytesIO()
+    write_parquet_report(rows=iter(rows), columns=columns, fileobj=buffer)
+    get_client("s3").put_object(
+        Bucket=COST_CACHE_BUCKET, Key=key, Body=buffer.getvalue()
+    )
+
+
+def get_cached_cost_rows(
+    start: str, end: str, group_by: list = None, metric: str = "BlendedCost"
+):
+    """Yield the daily costs from the S3 cache and Cost Explorer.
+
+    Only runs of days without a partition are requested from Cost Explorer.
+    Their costs are cached, once the day is older than COST_CACHE_SETTLE_DAYS,
+    because Cost Explorer still adjusts the costs of the last days.
+
+    Args:
+        start: First day of the report, e.g. "2020-07-01"
+        end: Day after the last day of the report
+        group_by: Cost Explorer dimensions to group by, at most two
+        metric: The cost metric
+
+    Returns:
+        rows: Generator of [day, *group keys, amount], ordered by day
+    """
+    group_by = group_by or REPORT_GROUP_BY
+    columns = get_report_columns(group_by)
+    cached_days = get_cached_days(group_by=group_by, metric=metric)
+    settled = (
+        datetime.date.today() + relativedelta(days=-COST_CACHE_SETTLE_DAYS)
+    ).strftime("%Y-%m-%d")
+    first_day = datetime.datetime.strptime(start, "%Y-%m-%d").date()
+    last_day = datetime.datetime.strptime(end, "%Y-%m-%d").date()
+    days = [
+        (first_day + relativedelta(days=offset)).strftime("%Y-%m-%d")
+        for offset in range((last_day - first_day).days)
+    ]
+    for is_cached, run in itertools.groupby(days, key=lambda day: day in cached_days):
+        run = list(run)
+        if is_cached:
+            for day in run:
+                yield from read_cost_partition(
+                    get_cost_partition_key(day, group_by, metric)
+                )
+            continue
+        logger.info("Cost Explorer: {} to {}".format(run[0], run[-1]))
+        run_end = (
+            datetime.datetime.strptime(run[-1], "%Y-%m-%d").date()
+            + relativedelta(days=1)
+        ).strftime("%Y-%m-%d")
+        rows_by_day = itertools.groupby(
+            get_cost_rows(start=run[0], end=run_end, group_by=group_by, metric=metric),
+            key=lambda row: row[0],
+        )
+        fetched_days = set()
+        for day, rows in rows_by_day:
+            rows = list(rows)
+            fetched_days.add(day)
+            if day < settled:
+                write_cost_partition(
+                    get_cost_partition_key(day, group_by, metric), rows, columns
+                )
+            yield from rows
+        # Days without costs are cached as well, so they are not requested again
+        for day in run:
+            if day not in fetched_days and day < settled:
+                write_cost_partition(
+                    get_cost_partition_key(day, group_by, metric), [], columns
+                )
+
+
+def aggregate_cost_rows(rows, granularity: str):
+    """Sum up daily costs per week or month.
+
+    Args:
+        rows: Iterable of [day, *group keys, amount], ordered by day
+        granularity: "DAILY", "WEEKLY" or "MONTHLY"
+
+    Returns:
+        rows: Generator of [first day of the period, *group keys, amount]
+    """
+    if granularity == "DAILY":
+        yield from rows
+        return
+    for period, period_rows in itertools.groupby(
+        rows, key=lambda row: get_period_start(row[0], granularity)
+    ):
+        amounts = {}
+        for row in period_rows:
+            keys = tuple(row[1:-1])
+            amounts[keys] = amounts.get(keys, 0.0) + row[-1]
+        for keys, amount in amounts.items():
+            yield [period] + list(keys) + [round(amount, 10)]
+
+
+def get_period_start(day: str, granularity: str):
+    """Get the first day of the week or month of a day.
+
+    Args:
+        day: The day, e.g. "2020-07-01"
+        granularity: "WEEKLY" or "MONTHLY"
+
+    Returns:
+        day: Monday of the week or first day of the month
+    """
+    date = datetime.datetime.strptime(day, "%Y-%m-%d").date()
+    if granularity == "WEEKLY":
+        return (date + relativedelta(days=-date.weekday())).strftime("%Y-%m-%d")
+    return date.replace(day=1).strftime("%Y-%m-%d")
+
+
+def generate_excel(
+    report_format: str = "xlsx",
+    start: str = None,
+    end: str = None,
+    group_by: list = None,
+    fileobj=None,
+    granularity: str = "DAILY",
+):
+    """Generate a cost report from Cost Explorer responses.
+
+    The rows are streamed from Cost Explorer into the report, neither pandas nor
+    a file in /tmp is needed. With COST_CACHE_BUCKET, only days missing in the
+    cache are requested from Cost Explorer.
+
+    Args:
+        report_format: One of "xlsx", "csv" or "parquet"
+        start: First day of the report, defaults to one period before end
+        end: Day after the last day of the report, defaults to yesterday
+        group_by: Cost Explorer dimensions to group by, defaults to SERVICE
+        fileobj: Writable binary file object, defaults to a new in-memory buffer
+        granularity: "DAILY", "WEEKLY" or "MONTHLY" sums of the daily costs
+
+    Returns:
+        fileobj: The file object with the report, rewound if it is a new buffer
+
+    Raises:
+        ValueError: If the report format or granularity is unknown
+    """
+    if granularity not in REPORT_PERIODS:
+        raise ValueError(
+            "Unknown granularity {}, use one of {}".format(
+                granularity, ", ".join(REPORT_PERIODS)
+            )
+        )
+    if report_format not in REPORT_WRITERS:
+        raise ValueError(
+            "Unknown report format {}, use one of {}".format(
+                report_format, ", ".join(REPORT_WRITERS)
+            )
+        )
+    end = end or (datetime.date.today() + relativedelta(days=-1)).strftime("%Y-%m-%d")
+    start = start or (
+        datetime.datetime.strptime(end, "%Y-%m-%d").date() - REPORT_PERIODS[granularity]
+    ).strftime("%Y-%m-%d")
+    group_by = group_by or REPORT_GROUP_BY
+    logger.info("Start: {} | End: {}".format(start, end))
+    rows = (get_cached_cost_rows if COST_CACHE_BUCKET else get_cost_rows)(
+        start=start, end=end, group_by=group_by
+    )
+    buffer = fileobj or io.BytesIO()
+    try:
+        REPORT_WRITERS[report_format](
+            rows=aggregate_cost_rows(rows, granularity),
+            columns=get_report_columns(group_by),
+            fileobj=buffer,
+        )
+    except Exception as e:
+        logger.error(
+            "Generating the {} cost report failed: {}".format(report_format, e)
+        )
+        raise e
+    if fileobj is None:
+        buffer.seek(0)
+    return buffer
+
+
+# Default report window by granularity, see generate_excel()
+REPORT_PERIODS = {
+    "DAILY": relativedelta(days=1),
+    "WEEKLY": relativedelta(weeks=1),
+    "MONTHLY": relativedelta(months=1),
+}
+
+# Report writers by format, see generate_excel()
+REPORT_WRITERS = {
+    "xlsx": write_xlsx_report,
+    "csv": write_csv_report,
+    "parquet": write_parquet_report,
+}
+
+
+def deliver_report(
+    bucket: str,
+    object_key: str = None,
+    report_format: str = "xlsx",
+    expiration_time: int = None,
+    **report_kwargs
+):
+    """Stream a cost report to S3 and share it.
+
+    The report is uploaded while it is generated, see S3UploadStream, so
+    nothing is written to /tmp.
+
+    Args:
+        bucket: The destination S3 bucket
+        object_key: The object key, defaults to REPORT_PATH/<end>-costreport.<format>
+        report_format: One of "xlsx", "csv" or "parquet"
+        expiration_time: Expiration of the URL in seconds, defaults to REPORT_URL_EXPIRATION
+        **report_kwargs: Further arguments of generate_excel()
+
+    Returns:
+        presigned_url: The presigned URL of the report
+    """
+    object_key = object_key or "{}{}-costreport.{}".format(
+        REPORT_PATH,
+        report_kwargs.get("end")
+        or (datetime.date.today() + relativedelta(days=-1)).strftime("%Y-%m-%d"),
+        report_format,
+    )
+    stream = S3UploadStream(
+        bucket=bucket,
+        object_key=object_key,
+        content_type=REPORT_CONTENT_TYPES.get(report_format),
+    )
+    try:
+        generate_excel(report_format=report_format, fileobj=stream, **report_kwargs)
+    except Exception as e:
+        stream.abort()
+        raise e
+    stream.close()
+    logger.info("Uploaded s3://{}/{}".format(bucket, object_key))
+    return create_presigned_url(
+        bucket=bucket,
+        object_key=object_key,
+        expiration_time=expiration_time or REPORT_URL_EXPIRATION,
+    )
+
+
+def get_cost_matrix(rows, start: str, end: str):
+    """Arrange daily cost rows as one series per group.
+
+    Args:
+        rows: Iterable of [day, *group keys, amount]
+        start: First day of the series
+        end: Day after the last day of the series
+
+    Returns:
+        series_keys: List of group keys per series
+        costs: Array of shape (series, days), days without costs are 0
+    """
+    numpy = import_numpy()
+    first_day = datetime.datetime.strptime(start, "%Y-%m-%d").date()
+    days = (datetime.datetime.strptime(end, "%Y-%m-%d").date() - first_day).days
+    series_index = {}
+    series, offsets, amounts = [], [], []
+    for row in rows:
+        keys = tuple(row[1:-1])
+        series.append(series_index.setdefault(keys, len(series_index)))
+        offsets.append(
+            (datetime.datetime.strptime(row[0], "%Y-%m-%d").date() - first_day).days
+        )
+        amounts.append(row[-1])
+    costs = numpy.zeros((len(series_index), days))
+    if amounts:
+        numpy.add.at(costs, (series, offsets), amounts)
+    return list(series_index), costs
+
+
+def score_costs(costs, baseline_days: int):
+    """Score every day against the rolling baseline of the days before.
+
+    All series are scored at once with cumulative sums, so the cost does not
+    depend on the window size.
+
+    Args:
+        costs: Array of shape (series, days)
+        baseline_days: Days of the rolling baseline
+
+    Returns:
+        baselines: Mean of the preceding baseline_days, shape (series, days - baseline_days)
+        z_scores: Deviation from the baseline in standard deviations, same shape
+    """
+    numpy = import_numpy()
+    days = costs.shape[1]
+    scored_days = days - baseline_days
+    padding = ((0, 0), (1, 0))
+    sums = numpy.cumsum(numpy.pad(costs, padding), axis=1)
+    squares = numpy.cumsum(numpy.pad(costs ** 2, padding), axis=1)
+    baselines = (sums[:, baseline_days:days] - sums[:, :scored_days]) / baseline_days
+    variances = (
+        squares[:, baseline_days:days] - squares[:, :scored_days]
+    ) / baseline_days - baselines ** 2
+    deviations = numpy.sqrt(numpy.maximum(variances, 0))
+    z_scores = (costs[:, baseline_days:] - baselines) / numpy.maximum(
+        deviations, COST_ANOMALY_MIN_DEVIATION
+    )
+    return baselines, z_scores
+
+
+def forecast_month_end(
+    costs, day_of_month: int, days_in_month: int, run_rate_days: int
+):
+    """Forecast the costs of the month from the costs up to the last day.
+
+    Args:
+        costs: Array of shape (series, days), the last day is the latest one
+        day_of_month: Day of month of the latest day
+        days_in_month: Number of days of the month
+        run_rate_days: Days of the average daily run rate
 
     Returns:
-        No returns.
+        forecasts: Month-end costs per series
     """
-    sns_client = boto3.client("sns")
-    try:
-        sns_client.publish(
-            Subject=subject_phrase,
-            TargetArn=topic_arn,
-            Message="""
-            This is a notification about your daily AWS spending.
-            You can download them within the next {} hours from here: {}
-            """.format(
-                expiration / 3600, presigned_url
-            ),
+    month_to_date = costs[:, -day_of_month:].sum(axis=1)
+    run_rate = costs[:, -run_rate_days:].mean(axis=1)
+    return month_to_date + run_rate * (days_in_month - day_of_month)
+
+
+def analyze_costs(
+    day: str = None,
+    group_by: list = None,
+    baseline_days: int = None,
+    threshold: float = None,
+):
+    """Find cost anomalies of a day and forecast the month-end costs.
+
+    Args:
+        day: The analyzed day, defaults to the day before yesterday
+        group_by: Cost Explorer dimensions of the series, defaults to SERVICE
+        baseline_days: Days of the rolling baseline, defaults to COST_BASELINE_DAYS
+        threshold: Z-score of an anomaly, defaults to COST_ANOMALY_THRESHOLD
+
+    Returns:
+        anomalies: List of dicts with Keys, Amount, Baseline and ZScore, highest first
+        forecasts: List of dicts with Keys and Forecast, highest first
+
+    Raises:
+        ValueError: If the baseline is shorter than one day
+    """
+    if baseline_days is None:
+        baseline_days = COST_BASELINE_DAYS
+    if threshold is None:
+        threshold = COST_ANOMALY_THRESHOLD
+    if baseline_days < 1:
+        raise ValueError(
+            "The baseline needs at least one day, got {}".format(baseline_days)
         )
-    except Exception as e:
-        raise e
+    group_by = group_by or REPORT_GROUP_BY
+    last_day = (
+        datetime.datetime.strptime(day, "%Y-%m-%d").date()
+        if day
+        else datetime.date.today() + relativedelta(days=-2)
+    )
+    first_day = min(
+        last_day + relativedelta(days=-baseline_days), last_day.replace(day=1)
+    )
+    start = first_day.strftime("%Y-%m-%d")
+    end = (last_day + relativedelta(days=1)).strftime("%Y-%m-%d")
+    rows = (get_cached_cost_rows if COST_CACHE_BUCKET else get_cost_rows)(
+        start=start, end=end, group_by=group_by
+    )
+    series_keys, costs = get_cost_matrix(rows, start=start, end=end)
+    if not series_keys:
+        return [], []
+    baselines, z_scores = score_costs(costs, baseline_days=baseline_days)
+    numpy = import_numpy()
+    latest = costs[:, -1]
+    anomalous = (z_scores[:, -1] >= threshold) & (
+        latest - baselines[:, -1] >= COST_ANOMALY_MIN_AMOUNT
+    )
+    anomalies = [
+        {
+            "Keys": list(series_keys[index]),
+            "Amount": round(float(latest[index]), 2),
+            "Baseline": round(float(baselines[index, -1]), 2),
+            "ZScore": round(float(z_scores[index, -1]), 1),
+        }
+        for index in numpy.flatnonzero(anomalous)
+    ]
+    forecast = forecast_month_end(
+        costs,
+        day_of_month=last_day.day,
+        days_in_month=(last_day.replace(day=1) + relativedelta(months=1, days=-1)).day,
+        run_rate_days=min(baseline_days, COST_RUN_RATE_DAYS),
+    )
+    forecasts = [
+        {"Keys": list(series_keys[index]), "Forecast": round(float(forecast[index]), 2)}
+        for index in numpy.argsort(-forecast)
+    ]
+    logger.info(
+        "{} anomalies within {} cost series on {}".format(
+            len(anomalies), len(series_keys), last_day
+        )
+    )
+    return sorted(anomalies, key=lambda anomaly: -anomaly["ZScore"]), forecasts
 
 
-def create_presigned_url(bucket, object_key, expiration_time):
-    """Generate a presigned URL to share a S3 object.
+def notify_cost_anomalies(topic_arn: str, day: str = None, group_by: list = None):
+    """Send cost anomalies and the month-end forecast to a SNS topic.
+
+    Nothing is sent, if there is no anomaly.
 
     Args:
-        bucket: The destination S3 bucket.
-        object_key: The object key within S3.
-        expiration_time: The expiration time for the URL in seconds.
+        topic_arn: The SNS topic ARN
+        day: The analyzed day, defaults to the day before yesterday
+        group_by: Cost Explorer dimensions of the series, defaults to SERVICE
 
     Returns:
-        presigned_url: The presigned URL.
+        anomalies: List of dicts with Keys, Amount, Baseline and ZScore
     """
-    s3_client = boto3.client("s3")
-    try:
-        presigned_url = s3_client.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": bucket, "Key": object_key},
-            ExpiresIn=expiration_time,
+    anomalies, forecasts = analyze_costs(day=day, group_by=group_by)
+    if not anomalies:
+        return anomalies
+    lines = ["Unusual AWS spending:"]
+    for anomaly in anomalies:
+        lines.append(
+            "  {}: {:.2f} USD instead of {:.2f} USD (z-score {})".format(
+                " / ".join(anomaly["Keys"]),
+                anomaly["Amount"],
+                anomaly["Baseline"],
+                anomaly["ZScore"],
+            )
         )
-    except Exception as e:
-        raise e
-    return presigned_url
+    lines.append(
+        "Forecast of this month: {:.2f} USD".format(
+            sum(forecast["Forecast"] for forecast in forecasts)
+        )
+    )
+    for forecast in forecasts[:COST_FORECAST_TOP]:
+        lines.append(
+            "  {}: {:.2f} USD".format(
+                " / ".join(forecast["Keys"]), forecast["Forecast"]
+            )
+        )
+    send_notification(
+        subject_phrase="AWS spending anomalies",
+        topic_arn=topic_arn,
+        message="\n".join(lines),
+    )
+    return anomalies
 
 
-def upload_file(file_name, bucket, object_key):
-    """Upload the excel file to s3.
+def escape_and_lower_characters(text: str):
+    """Format a string for easier comparision.
 
     Args:
-        file_name: The name of file to be uploaded
-        bucket: The S3 Bucket to save file
-        object_key: The S3 object key
+        text: String with special characters to be escaped
+
+    Return:
+        text: the escaped string
+    """
+    chars = "\\`*_{}[]()>#+-.!$/"
+    for c in chars:
+        text = text.replace(c, "")
+    text = text.lower()
+    return text
+
+
+def split_path(path: str):
+    """Format a path for easier comparision.
+
+    Args:
+        path: A systems path like src/conf/file.txt
 
     Returns:
-        No return.
+        file_name: The file name
+        short_file_name: The file name without a suffix
+    """
+    file_name = os.path.split(path)[-1]
+    short_file_name = file_name.split(".")[0]
+    return file_name, short_file_name
+
+
+def get_product_key(path: str):
+    """Get the product name a template path is synced to.
+
+    Args:
+        path: Path of the template within the repository
+
+    Returns:
+        product_key: The file name without suffix, escaped and lower case
+    """
+    _, short_file_name = split_path(path)
+    return escape_and_lower_characters(short_file_name)
+
+
+def is_product_template(path: str, products_path: str):
+    """Check whether a path belongs to a product template.
+
+    Args:
+        path: Path within the repository
+        products_path: Folder of the product templates
+
+    Returns:
+        True, if the path contains the products folder
+    """
+    return (
+        path is not None
+        and products_path is not None
+        and path.find(products_path) != -1
+    )
+
+
+def get_synced_commit_key(portfolio_id: str):
+    """Get the S3 key of the last commit synced to a portfolio.
+
+    Args:
+        portfolio_id: The Service Catalog portfolio id
+
+    Returns:
+        key: S3 key within the artifact bucket
+    """
+    return "{}{}.json".format(SYNCED_COMMITS_PATH, portfolio_id)
+
+
+def get_last_synced_commit(bucket: str, portfolio_id: str):
+    """Get the last commit, which has been synced to a portfolio completely.
+
+    Args:
+        bucket: The artifact bucket
+        portfolio_id: The Service Catalog portfolio id
+
+    Returns:
+        commit_id: The commit id or None, if the portfolio has never been synced
     """
-    s3_client = boto3.client("s3")
     try:
-        s3_client.upload_file(Filename=file_name, Bucket=bucket, Key=object_key)
-    except Exception as e:
+        response = get_client("s3").get_object(
+            Bucket=bucket, Key=get_synced_commit_key(portfolio_id)
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+            return None
+        logger.error("Error reading the last synced commit ... {}".format(e))
         raise e
+    return json.loads(response["Body"].read())["CommitId"]
+
+
+def put_last_synced_commit(bucket: str, portfolio_id: str, commit_id: str):
+    """Remember the commit, which has been synced to a portfolio completely.
 
+    Args:
+        bucket: The artifact bucket
+        portfolio_id: The Service Catalog portfolio id
+        commit_id: The synced commit id
 
-def generate_excel():
-    """Generate an Excel file from Cost Explorer response."""
-    ce_client = boto3.client("ce")
-    today = datetime.date.today()
-    yesterday = today + relativedelta(days=-1)
-    day_before_yesterday = yesterday + relativedelta(days=-1)
-    yesterday = yesterday.strftime("%Y-%m-%d")
-    day_before_yesterday = day_before_yesterday.strftime("%Y-%m-%d")
-    logger.info("Start: {} | End: {}".format(yesterday, day_before_yesterday))
+    Returns:
+        No return.
+    """
     try:
-        response = ce_client.get_cost_and_usage(
-            TimePeriod={"Start": day_before_yesterday, "End": yesterday},
-            Granularity="DAILY",
-            Metrics=["BlendedCost"],
-            GroupBy=[{"Type": "DIMENSION", "Key": "SERVICE"}],
-        )
-        file_name = "/tmp/{}-costreport.xlsx".format(yesterday)
-        services = []
-        costs = []
-        results = response["ResultsByTime"][0]["Groups"]
-        for i in results:
-            services.append(i["Keys"][0])
-            costs.append(i["Metrics"]["BlendedCost"]["Amount"])
-        data_tuples = list(zip(services, costs))
-        df = pd.DataFrame(data_tuples, columns=["Service_AWS", "Amount_$"])
-        df.to_excel("{}".format(file_name), index=False)
+        get_client("s3").put_object(
+            Bucket=bucket,
+            Key=get_synced_commit_key(portfolio_id),
+            Body=json.dumps(
+                {
+                    "CommitId": commit_id,
+                    "SyncedAt": datetime.datetime.utcnow().isoformat() + "Z",
+                }
+            ).encode("utf-8"),
+            ContentType="application/json",
+        )
     except Exception as e:
+        logger.error("Error storing the last synced commit ... {}".format(e))
         raise e
-    return file_name
 
 
-def put_job_success(codepipeline_client, job: str, message: str, output_variables):
+def put_job_success(
+    codepipeline_client,
+    job: str,
+    message: str,
+    output_variables,
+    continuation_token: str = None,
+):
     """Notify CodePipeline of a successful job.
 
     Args:
@@ -121,13 +1623,20 @@ def put_job_success(codepipeline_client, job: str, message: str, output_variable
         job: The CodePipeline job ID
         output_variables: A dictonary for CodePiepline enviroment variables
         message: A string for logging purposes
+        continuation_token: Lets CodePipeline invoke the action again with this token, instead of completing it
     Returns:
         No return.
     """
     try:
-        codepipeline_client.put_job_success_result(
-            jobId=job, outputVariables=output_variables
-        )
+        if continuation_token:
+            # CodePipeline rejects output variables together with a continuation token
+            codepipeline_client.put_job_success_result(
+                jobId=job, continuationToken=continuation_token
+            )
+        else:
+            codepipeline_client.put_job_success_result(
+                jobId=job, outputVariables=output_variables
+            )
         logger.info("Putting job success: {}".format(message))
     except Exception as e:
         logger.error("Error:returning success signal to CodePipeline ... {}".format(e))
@@ -155,33 +1664,254 @@ def put_job_failure(codepipeline_client, job: str, message: str):
         raise e
 
 
-def sts_assume_role(role: str, session_name: str, account: str):
+def _assume_role(role: str, session_name: str, account: str):
     """Assume a IAM role in this or a foreign account.
 
     Args:
-        role: The name of the IAM role
+        role: The ARN of the IAM role
         session_name: An arbitrary session name
         account: The account name or id. Just for logging purposes
 
     Returns:
-        access_key: A temporary access key provided by Security Token Service (STS)
-        secret_key: A temporary secret key key provided by Security Token Service (STS)
-        session_token: A temporary session token provided by Security Token Service (STS)
+        credentials: The temporary credentials of STS, including their Expiration
     """
     try:
-        sts_connection = boto3.client("sts")
+        sts_connection = get_client("sts")
         sts_response = sts_connection.assume_role(
             RoleArn=role, RoleSessionName=session_name,
         )
-        access_key = sts_response["Credentials"]["AccessKeyId"]
-        secret_key = sts_response["Credentials"]["SecretAccessKey"]
-        session_token = sts_response["Credentials"]["SessionToken"]
     except Exception as e:
         logger.error(
             "Error while assuming role in other account {} ... {}".format(account, e)
         )
         raise e
-    return access_key, secret_key, session_token
+    return sts_response["Credentials"]
+
+
+def credentials_expire(credentials: dict):
+    """Check whether temporary credentials expire within the refresh margin.
+
+    Args:
+        credentials: The temporary credentials of STS
+
+    Returns:
+        True, if the credentials have to be renewed
+    """
+    remaining = credentials["Expiration"] - datetime.datetime.now(datetime.timezone.utc)
+    return remaining < datetime.timedelta(seconds=CREDENTIALS_REFRESH_MARGIN)
+
+
+def get_account_session(role: str, session_name: str, account: str):
+    """Get the cached session of an assumed role, renewed shortly before it expires.
+
+    Roles are assumed once per role and session name, no matter how many
+    operations use them. Different roles are assumed concurrently.
+
+    Args:
+        role: The ARN of the IAM role
+        session_name: An arbitrary session name
+        account: The account name or id. Just for logging purposes
+
+    Returns:
+        session: Dict with the STS credentials, the boto3 session and its clients
+    """
+    key = (role, session_name)
+    with account_sessions_lock:
+        lock = account_session_locks.setdefault(key, threading.Lock())
+    with lock:
+        session = account_sessions.get(key)
+        if session is None or credentials_expire(session["credentials"]):
+            logger.info("Assuming role {} for account {}".format(role, account))
+            credentials = _assume_role(
+                role=role, session_name=session_name, account=account
+            )
+            boto3_session = boto3.session.Session(
+                aws_access_key_id=credentials["AccessKeyId"],
+                aws_secret_access_key=credentials["SecretAccessKey"],
+                aws_session_token=credentials["SessionToken"],
+            )
+            instrument_session(boto3_session)
+            session = account_sessions[key] = {
+                "credentials": credentials,
+                "session": boto3_session,
+                "clients": {},
+                "lock": lock,
+            }
+    return session
+
+
+def get_account_client(service_name: str, role: str, session_name: str, account: str):
+    """Get a client of an assumed role, shared until its credentials are renewed.
+
+    Args:
+        service_name: The boto3 service name like iam
+        role: The ARN of the IAM role
+        session_name: An arbitrary session name
+        account: The account name or id. Just for logging purposes
+
+    Returns:
+        The boto3 client
+    """
+    session = get_account_session(role=role, session_name=session_name, account=account)
+    # Creating clients from one session is not thread-safe
+    with session["lock"]:
+        if service_name not in session["clients"]:
+            session["clients"][service_name] = session["session"].client(
+                service_name, config=get_client_config()
+            )
+    return session["clients"][service_name]
+
+
+def sts_assume_role(role: str, session_name: str, account: str):
+    """Assume a IAM role in this or a foreign account.
+
+    The credentials are cached, see get_account_session().
+
+    Args:
+        role: The name of the IAM role
+        session_name: An arbitrary session name
+        account: The account name or id. Just for logging purposes
+
+    Returns:
+        access_key: A temporary access key provided by Security Token Service (STS)
+        secret_key: A temporary secret key key provided by Security Token Service (STS)
+        session_token: A temporary session token provided by Security Token Service (STS)
+    """
+    credentials = get_account_session(
+        role=role, session_name=session_name, account=account
+    )["credentials"]
+    return (
+        credentials["AccessKeyId"],
+        credentials["SecretAccessKey"],
+        credentials["SessionToken"],
+    )
+
+
+class AccountOperationError(Exception):
+    """Collect the failures of an operation run across accounts."""
+
+    def __init__(self, report: dict):
+        """Init the error with the report of all accounts.
+
+        Args:
+            report: Dictionary with the account as key and its outcome as value, see run_for_accounts()
+        """
+        self.report = report
+        self.failures = {
+            account: outcome["Error"]
+            for account, outcome in report.items()
+            if outcome["Status"] == ACCOUNT_FAILED
+        }
+        super().__init__(
+            "; ".join(
+                "{}: {}".format(account, error)
+                for account, error in self.failures.items()
+            )
+        )
+
+
+def run_for_accounts(
+    operation,
+    assume_roles: list,
+    accounts: list,
+    max_failures: int = 0,
+    max_workers: int = None,
+):
+    """Run an operation in all accounts at once.
+
+    Once more than max_failures accounts failed, accounts not started yet are
+    skipped. Accounts already running are completed.
+
+    Args:
+        operation: Callable with the keyword arguments role and account
+        assume_roles: list of roles in foreign accounts to be assumed
+        accounts: list of foreign account ids
+        max_failures: Failed accounts tolerated, None tolerates all
+        max_workers: Accounts processed at once, defaults to ACCOUNT_MAX_WORKERS
+
+    Returns:
+        report: Dictionary with the account as key and a dict with Status and
+            Result or Error as value
+
+    Raises:
+        AccountOperationError: If more than max_failures accounts failed
+    """
+    report = {}
+    stop = threading.Event()
+
+    def run(role, account):
+        if stop.is_set():
+            return {"Status": ACCOUNT_SKIPPED}
+        try:
+            return {
+                "Status": ACCOUNT_SUCCEEDED,
+                "Result": operation(role=role, account=account),
+            }
+        except Exception as e:
+            logger.error("Error in account {} ... {}".format(account, e))
+            return {"Status": ACCOUNT_FAILED, "Error": e}
+
+    with ThreadPoolExecutor(max_workers=max_workers or ACCOUNT_MAX_WORKERS) as executor:
+        futures = {
+            executor.submit(run, role, account): account
+            for role, account in zip(assume_roles, accounts)
+        }
+        failed = 0
+        for future in as_completed(futures):
+            report[futures[future]] = future.result()
+            if report[futures[future]]["Status"] == ACCOUNT_FAILED:
+                failed += 1
+                if max_failures is not None and failed > max_failures:
+                    stop.set()
+    logger.info(
+        "{} of {} accounts succeeded".format(
+            sum(outcome["Status"] == ACCOUNT_SUCCEEDED for outcome in report.values()),
+            len(report),
+        )
+    )
+    if max_failures is not None and failed > max_failures:
+        raise AccountOperationError(report)
+    return report
+
+
+def delete_external_role(
+    role: str,
+    account: str,
+    commit_id: str,
+    policy_name: str,
+    role_name: str,
+    role_session_name: str,
+):
+    """Delete the IAM role with role policy within one foreign account.
+
+    Args:
+        role: The role to be assumed in the foreign account
+        account: The foreign account id
+        commit_id: id of the current commit from CodeCommit,
+        policy_name: Name of the policy
+        role_name: Name of the role
+        role_session_name: Name of the STS session
+
+    Returns:
+        No return.
+    """
+    client = get_account_client(
+        "iam", role=role, session_name=role_session_name, account=account
+    )
+    logging.info("Deleting IAM Role ...")
+    try:
+        client.delete_role_policy(
+            RoleName=role_name + commit_id, PolicyName=policy_name,
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchEntity":
+            raise e
+    try:
+        client.delete_role(RoleName=role_name + commit_id,)
+    except Exception as e:
+        logger.info("Error deleting IAM role {} ... {}".format(role_name, e))
+        raise e
+    logging.info("IAM Role {} successfully deleted.".format(role_name + commit_id))
 
 
 def delete_external_roles(
@@ -191,6 +1921,7 @@ def delete_external_roles(
     policy_name: str,
     role_name: str,
     role_session_name: str,
+    max_failures: int = 0,
 ):
     """Delete IAM roles with role policy within foreign accounts.
 
@@ -201,37 +1932,70 @@ def delete_external_roles(
         assume_roles: list of roles in foreign accounts to be assumed,
         accounts: list of foreign account ids,
         commit_id: id of the current commit from CodeCommit,
+        max_failures: Failed accounts tolerated, see run_for_accounts()
+
+    Returns:
+        report: The outcome per account, see run_for_accounts()
     """
-    for role, account in zip(assume_roles, accounts):
-        acc_key, sec_key, sess_token = sts_assume_role(
-            role=role, session_name=role_session_name, account=account
-        )
-        client = boto3.client(
-            "iam",
-            aws_access_key_id=acc_key,
-            aws_secret_access_key=sec_key,
-            aws_session_token=sess_token,
-        )
-        logging.info("Deleting IAM Role ...")
+    return run_for_accounts(
+        functools.partial(
+            delete_external_role,
+            commit_id=commit_id,
+            policy_name=policy_name,
+            role_name=role_name,
+            role_session_name=role_session_name,
+        ),
+        assume_roles=assume_roles,
+        accounts=accounts,
+        max_failures=max_failures,
+    )
+
+
+def delete_principals_management_lambda(
+    role: str, account: str, assign_lambda_name: str, unassign_lambda_name: str,
+):
+    """Delete principal assign and unassign lambdas in one foreign account.
+
+    Lambdas, which do not exist, are regarded as deleted already.
+
+    Args:
+        role: The role to be assumed in the foreign account
+        account: The foreign account id
+        assign_lambda_name: The name of Lambda for principal management
+        unassign_lambda_name: The name of Lambda for principal management
+
+    Returns:
+        No returns
+    """
+    client = get_account_client(
+        "lambda", role=role, session_name=DELETE_SESSION_NAME, account=account,
+    )
+    for _lambda in [assign_lambda_name, unassign_lambda_name]:
+        function_name = _lambda + "-" + account
         try:
-            client.delete_role_policy(
-                RoleName=role_name + commit_id, PolicyName=policy_name,
+            list_response = client.get_function(FunctionName=function_name)
+            logging.info(
+                "Deleting Lambda function {} ... ".format(
+                    list_response["Configuration"]["FunctionName"]
+                )
+            )
+            client.delete_function(
+                FunctionName=list_response["Configuration"]["FunctionName"]
             )
         except ClientError as e:
-            if e.response["Error"]["Code"] == "NoSuchEntity":
-                try:
-                    client.delete_role(RoleName=role_name + commit_id,)
-                except Exception as e:
-                    logger.info(
-                        "Error deleting IAM role {} ... {}".format(role_name, e)
-                    )
-                    raise e
-        try:
-            client.delete_role(RoleName=role_name + commit_id,)
+            if e.response["Error"]["Code"] != "ResourceNotFoundException":
+                logger.error(
+                    "Error deleting Lambda function {} ... {}".format(function_name, e)
+                )
+                raise e
+            logger.info(
+                "Lambda function {} is deleted already ...".format(function_name)
+            )
         except Exception as e:
-            logger.info("Error deleting IAM role {} ... {}".format(role_name, e))
+            logger.error(
+                "Error deleting Lambda function {} ... {}".format(function_name, e)
+            )
             raise e
-        logging.info("IAM Role {} successfully deleted.".format(role_name + commit_id))
 
 
 def delete_principals_management_lambdas(
@@ -239,6 +2003,7 @@ def delete_principals_management_lambdas(
     unassign_lambda_name: str,
     assume_role: list,
     accounts: list,
+    max_failures: int = 0,
 ):
     """Delete principal assign and unassign lambdas in foreign account.
 
@@ -247,50 +2012,21 @@ def delete_principals_management_lambdas(
         unassign_lambda_name: The name of Lambda for principal management
         assume_role: list with roles to assume in foreign accounts
         accounts: list with ids of foreign accounts
+        max_failures: Failed accounts tolerated, see run_for_accounts()
 
     Returns:
-        No returns
+        report: The outcome per account, see run_for_accounts()
     """
-    lambda_list = [assign_lambda_name, unassign_lambda_name]
-
-    for role, account in zip(assume_role, accounts):
-        acc_key, sec_key, sess_token = sts_assume_role(
-            role=role, session_name="DeletePrincipalManagement", account=account
-        )
-        client = boto3.client(
-            "lambda",
-            aws_access_key_id=acc_key,
-            aws_secret_access_key=sec_key,
-            aws_session_token=sess_token,
-        )
-        for _lambda in lambda_list:
-            try:
-                list_response = client.get_function(
-                    FunctionName=_lambda + "-" + account
-                )
-            except Exception as e:
-                logger.error(
-                    "Error Lambda function PrincipalManagement-{} not found ... {}".format(
-                        account, e
-                    )
-                )
-                raise e
-            try:
-                logging.info(
-                    "Deleting Lambda function {} ... ".format(
-                        list_response["Configuration"]["FunctionName"]
-                    )
-                )
-                client.delete_function(
-                    FunctionName=list_response["Configuration"]["FunctionName"]
-                )
-            except Exception as e:
-                logger.error(
-                    "Error deleting Lambda function PrincipalManagement-{} ... {}".format(
-                        account, e
-                    )
-                )
-                raise e
+    return run_for_accounts(
+        functools.partial(
+            delete_principals_management_lambda,
+            assign_lambda_name=assign_lambda_name,
+            unassign_lambda_name=unassign_lambda_name,
+        ),
+        assume_roles=assume_role,
+        accounts=accounts,
+        max_failures=max_failures,
+    )
 
 
 def get_user_params(job_data):
@@ -322,9 +2058,13 @@ def delete_deployment(
     assume_role_list: list,
     account_list: list,
     unassign_lambda: str,
+    ignore_failures: bool = False,
 ):
     """Suborder handler, orchestrating all other functions.
 
+    All accounts are torn down at once. Lambdas, which are gone already, are
+    no failure.
+
     Args:
         assign_lambda: Name of the assign Lambda
         unassign_lambda: Name of the unassign Lambda
@@ -333,40 +2073,21 @@ def delete_deployment(
         local_policy_name: Name of the local policy
         local_role_name: Name of the local IAM Role
         commit_id: the current CodeCommit commit ID
+        ignore_failures: Only log failed accounts instead of raising an AccountOperationError
 
     Returns:
         No returns
     """
     logger.info("Destroying Deployment Environment ...")
-    try:
-        logger.info("Deleting externally Lambdas foreign accounts ...")
-        delete_principals_management_lambdas(
-            assign_lambda_name=assign_lambda,
-            unassign_lambda_name=unassign_lambda,
-            accounts=account_list,
-            assume_role=assume_role_list,
-        )
-    except ClientError as e:
-        if e.response["Error"]["Code"] == "ResourceNotFoundException":
-            logger.error(
-                "Error while deleting Lambdas in foreign accounts ... {}".format(e)
-            )
-        try:
-            logger.info("Deleting IAM Roles in foreign accounts")
-            delete_external_roles(
-                assume_roles=assume_role_list,
-                accounts=account_list,
-                commit_id=commit_id,
-                policy_name=local_policy_name,
-                role_name=local_role_name,
-                role_session_name="deletePrincipalManagement",
-            )
-        except Exception as e:
-            logger.error(
-                "Error while deleting IAM Roles in foreign accounts ... {}".format(e)
-            )
-            raise e
-        logger.info("Finished Destroying Deployment Environment ...")
+    logger.info("Deleting externally Lambdas foreign accounts ...")
+    # The roles are deleted in every account, even if its Lambdas are gone already
+    lambdas_report = delete_principals_management_lambdas(
+        assign_lambda_name=assign_lambda,
+        unassign_lambda_name=unassign_lambda,
+        accounts=account_list,
+        assume_role=assume_role_list,
+        max_failures=None,
+    )
     try:
         logger.info("Deleting IAM Roles in foreign accounts")
         delete_external_roles(
@@ -375,11 +2096,23 @@ def delete_deployment(
             commit_id=commit_id,
             policy_name=local_policy_name,
             role_name=local_role_name,
-            role_session_name="deletePrincipalManagement",
+            role_session_name=DELETE_SESSION_NAME,
+            max_failures=None if ignore_failures else 0,
         )
     except Exception as e:
         logger.error(
             "Error while deleting IAM Roles in foreign accounts ... {}".format(e)
         )
         raise e
+    lambda_errors = {
+        account: outcome
+        for account, outcome in lambdas_report.items()
+        if outcome["Status"] == ACCOUNT_FAILED
+    }
+    if lambda_errors and not ignore_failures:
+        error = AccountOperationError(lambda_errors)
+        logger.error(
+            "Error while deleting Lambdas in foreign accounts ... {}".format(error)
+        )
+        raise error
     logger.info("Finished Destroying Deployment Environment ...")
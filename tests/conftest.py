@@ -0,0 +1,18 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The Lambdas import the layer module and are imported like their handlers do
+sys.path[:0] = [
+    os.path.join(
+        ROOT, "src", "lambda_layer", "python", "lib", "python3.7", "site-packages"
+    ),
+    os.path.join(ROOT, "src", "lambda", "update_servicecatalog"),
+    os.path.join(ROOT, "src", "lambda", "git_metadata"),
+]
+
+# The clients are created on import, but every call is answered by a stub
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
@@ -0,0 +1,54 @@
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+import git_metadata
+
+
+@pytest.fixture
+def codecommit(monkeypatch):
+    """Answer the CodeCommit calls of git_metadata from a stub."""
+    client = boto3.client("codecommit")
+    monkeypatch.setattr(git_metadata, "client_codecommit", client)
+    with Stubber(client) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+
+def test_get_file_changes_of_path_missing_in_before_commit(codecommit):
+    path = "service_catalog/config_dev.ini"
+    codecommit.add_client_error(
+        "get_differences",
+        service_error_code="PathDoesNotExistException",
+        expected_params={
+            "repositoryName": "repo",
+            "beforeCommitSpecifier": "before",
+            "afterCommitSpecifier": "after",
+            "beforePath": path,
+            "afterPath": path,
+        },
+    )
+    difference = {"afterBlob": {"path": path}, "changeType": "A"}
+    codecommit.add_response(
+        "get_differences",
+        {"differences": [difference]},
+        expected_params={
+            "repositoryName": "repo",
+            "beforeCommitSpecifier": "before",
+            "afterCommitSpecifier": "after",
+            "afterPath": path,
+        },
+    )
+
+    differences = git_metadata.get_file_changes("repo", "before", "after", [path])
+
+    assert list(differences) == [difference]
+
+
+def test_get_file_changes_raises_other_errors(codecommit):
+    codecommit.add_client_error(
+        "get_differences", service_error_code="CommitDoesNotExistException"
+    )
+
+    with pytest.raises(git_metadata.ClientError):
+        list(git_metadata.get_file_changes("repo", "before", "after", ["products"]))
@@ -0,0 +1,36 @@
+import boto3
+from botocore.stub import Stubber
+
+import servicecatalog
+
+
+def test_delete_principals_management_lambda_skips_deleted_lambdas(monkeypatch):
+    client = boto3.client("lambda")
+    monkeypatch.setattr(
+        servicecatalog, "get_account_client", lambda *args, **kwargs: client
+    )
+    with Stubber(client) as stubber:
+        stubber.add_client_error(
+            "get_function",
+            service_error_code="ResourceNotFoundException",
+            expected_params={"FunctionName": "Assign-111111111111"},
+        )
+        stubber.add_response(
+            "get_function",
+            {"Configuration": {"FunctionName": "Unassign-111111111111"}},
+            expected_params={"FunctionName": "Unassign-111111111111"},
+        )
+        stubber.add_response(
+            "delete_function",
+            {},
+            expected_params={"FunctionName": "Unassign-111111111111"},
+        )
+
+        servicecatalog.delete_principals_management_lambda(
+            role="Role",
+            account="111111111111",
+            assign_lambda_name="Assign",
+            unassign_lambda_name="Unassign",
+        )
+
+        stubber.assert_no_pending_responses()
@@ -0,0 +1,483 @@
+import configparser
+import datetime
+import io
+import json
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+import sync_catalog
+
+PRODUCTS_PATH = "service_catalog/products/"
+
+SECTION = {
+    "Owner": "Platform",
+    "Description": "Description",
+    "SupportDescription": "Support",
+    "SupportEmail": "support@example.com",
+    "SupportUrl": "https://example.com",
+    "ProductType": "CLOUD_FORMATION_TEMPLATE",
+    "Version": "v2",
+    "Diff_Description": "Changes",
+    "TemplateURL": "https://bucket.s3.amazonaws.com/templates/{}",
+    "Key_1": "Team",
+    "Value_1": "Platform",
+    "Retention": "5",
+}
+
+
+def get_config(*file_names, **options):
+    """Build a config.ini with a section per template file name."""
+    config = configparser.ConfigParser()
+    for file_name in file_names:
+        config[file_name] = dict(
+            SECTION,
+            Name=file_name.split(".")[0],
+            TemplateURL=SECTION["TemplateURL"].format(file_name),
+            **options
+        )
+    return config
+
+
+def get_inventory(**products):
+    """Build an inventory of portfolio port-1 with products by name."""
+    inventory = sync_catalog.PortfolioInventory(portfolio_id="port-1")
+    for name, product_id in products.items():
+        inventory.add_product(name=name, product_id=product_id, invalidate_cache=False)
+    return inventory
+
+
+def get_constraints(**launch_constraints):
+    """Build a constraint index with a LAUNCH constraint id by product id."""
+    constraints = sync_catalog.ConstraintIndex(portfolio_id="port-1")
+    for product_id, constraint_id in launch_constraints.items():
+        constraints.constraints[product_id] = [
+            {"ConstraintId": constraint_id, "Type": "LAUNCH", "ProductId": product_id}
+        ]
+    return constraints
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    """Point the sync to the products folder and a constant template hash."""
+    monkeypatch.setattr(sync_catalog, "PATH", PRODUCTS_PATH)
+    monkeypatch.setattr(sync_catalog, "BUCKET", "bucket")
+    monkeypatch.setattr(sync_catalog, "S3_PATH", "templates/")
+    monkeypatch.setattr(
+        sync_catalog, "get_template_hash", lambda path, config_section: "hash"
+    )
+
+
+@pytest.fixture
+def servicecatalog(monkeypatch):
+    """Answer the Service Catalog calls of sync_catalog from a stub."""
+    client = boto3.client("servicecatalog")
+    monkeypatch.setattr(sync_catalog, "auto_servicecatalog_client", client)
+    with Stubber(client) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """Answer the S3 calls of sync_catalog from a stub."""
+    client = boto3.client("s3")
+    monkeypatch.setattr(sync_catalog, "auto_s3_client", client)
+    with Stubber(client) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+
+def add_unshared_portfolio(servicecatalog):
+    """Stub the calls of list_shared_accounts() for a portfolio without shares."""
+    for share_type in ["ORGANIZATION", "ORGANIZATIONAL_UNIT"]:
+        servicecatalog.add_response(
+            "describe_portfolio_shares",
+            {"PortfolioShareDetails": []},
+            {"PortfolioId": "port-1", "Type": share_type},
+        )
+    servicecatalog.add_response(
+        "list_portfolio_access",
+        {"AccountIds": []},
+        {"AcceptLanguage": "en", "PortfolioId": "port-1", "PageSize": 20},
+    )
+
+
+def test_plan_portfolio_sync_creates_new_products(servicecatalog, s3):
+    plan = sync_catalog.plan_portfolio_sync(
+        config=get_config("a.yaml"),
+        added_files=[PRODUCTS_PATH + "a.yaml", "README.md"],
+        modified_files=[],
+        deleted_files=[],
+        inventory=get_inventory(),
+        constraints=get_constraints(),
+    )
+
+    assert [action.to_dict() for action in plan.actions] == [
+        sync_catalog.SyncAction(
+            operation=sync_catalog.SyncAction.CREATE,
+            template=PRODUCTS_PATH + "a.yaml",
+            template_hash="hash",
+            create_launch_constraint=True,
+        ).to_dict()
+    ]
+
+
+def test_plan_portfolio_sync_updates_changed_products(servicecatalog, s3):
+    s3.add_response(
+        "get_object_tagging",
+        {"TagSet": [{"Key": sync_catalog.TEMPLATE_HASH_TAG, "Value": "old"}]},
+        {"Bucket": "bucket", "Key": "templates/a.yaml"},
+    )
+    servicecatalog.add_response(
+        "describe_constraint",
+        {"ConstraintParameters": sync_catalog.parsed_string, "Status": "AVAILABLE"},
+        {"AcceptLanguage": "en", "Id": "cons-a"},
+    )
+    add_unshared_portfolio(servicecatalog)
+    servicecatalog.add_response(
+        "list_provisioning_artifacts",
+        {
+            "ProvisioningArtifactDetails": [
+                {"Id": "pa-1", "CreatedTime": datetime.datetime(2020, 1, 1)},
+                {"Id": "pa-2", "CreatedTime": datetime.datetime(2020, 1, 2)},
+            ]
+        },
+        {"AcceptLanguage": "en", "ProductId": "prod-a"},
+    )
+    servicecatalog.add_response(
+        "search_provisioned_products",
+        {"ProvisionedProducts": [{"ProvisioningArtifactId": "pa-1"}]},
+    )
+
+    plan = sync_catalog.plan_portfolio_sync(
+        config=get_config("a.yaml", Retention="1"),
+        added_files=[],
+        modified_files=[PRODUCTS_PATH + "a.yaml"],
+        deleted_files=[],
+        inventory=get_inventory(a="prod-a"),
+        constraints=get_constraints(**{"prod-a": "cons-a"}),
+    )
+
+    assert [action.to_dict() for action in plan.actions] == [
+        sync_catalog.SyncAction(
+            operation=sync_catalog.SyncAction.UPDATE,
+            template=PRODUCTS_PATH + "a.yaml",
+            product_id="prod-a",
+            template_hash="hash",
+            artifacts_to_delete=["pa-2"],
+        ).to_dict()
+    ]
+
+
+def test_plan_portfolio_sync_skips_templates_with_equal_hash(servicecatalog, s3):
+    s3.add_response(
+        "get_object_tagging",
+        {"TagSet": [{"Key": sync_catalog.TEMPLATE_HASH_TAG, "Value": "hash"}]},
+        {"Bucket": "bucket", "Key": "templates/a.yaml"},
+    )
+
+    plan = sync_catalog.plan_portfolio_sync(
+        config=get_config("a.yaml"),
+        added_files=[],
+        modified_files=[PRODUCTS_PATH + "a.yaml"],
+        deleted_files=[],
+        inventory=get_inventory(a="prod-a"),
+        constraints=get_constraints(**{"prod-a": "cons-a"}),
+    )
+
+    assert plan.actions == []
+    assert plan.unchanged == ["a"]
+
+
+def test_plan_portfolio_sync_deletes_products_of_deleted_templates(servicecatalog, s3):
+    plan = sync_catalog.plan_portfolio_sync(
+        config=get_config(),
+        added_files=[],
+        modified_files=[],
+        deleted_files=[PRODUCTS_PATH + "b.yaml"],
+        inventory=get_inventory(b="prod-b"),
+        constraints=get_constraints(**{"prod-b": "cons-b"}),
+    )
+
+    assert [action.to_dict() for action in plan.actions] == [
+        sync_catalog.SyncAction(
+            operation=sync_catalog.SyncAction.DELETE,
+            template=PRODUCTS_PATH + "b.yaml",
+            product_id="prod-b",
+            constraints_to_delete=["cons-b"],
+        ).to_dict()
+    ]
+
+
+def test_sync_plan_round_trip():
+    plan = sync_catalog.SyncPlan(portfolio_id="port-1")
+    plan.actions = [
+        sync_catalog.SyncAction(
+            operation=sync_catalog.SyncAction.CREATE,
+            template=PRODUCTS_PATH + "a.yaml",
+            template_hash="hash",
+            create_launch_constraint=True,
+            template_uploaded=True,
+        ),
+        sync_catalog.SyncAction(
+            operation=sync_catalog.SyncAction.UPDATE,
+            template=PRODUCTS_PATH + "b.yaml",
+            product_id="prod-b",
+            constraints_to_delete=["cons-b"],
+            artifacts_to_delete=["pa-1", "pa-2"],
+        ),
+    ]
+    plan.unchanged = ["c"]
+    plan.mark_completed(plan.actions[0], {plan.actions[0].template: KeyError("a")})
+    plan.fanout_id = "fanout-1"
+    plan.dispatched_at = 1600000000.5
+
+    restored = sync_catalog.SyncPlan.from_dict(json.loads(json.dumps(plan.to_dict())))
+
+    assert restored.to_dict() == plan.to_dict()
+    assert [action.template for action in restored.get_pending_actions()] == [
+        PRODUCTS_PATH + "b.yaml"
+    ]
+
+
+def test_plan_portfolio_sync_renames_products_of_renamed_templates(servicecatalog, s3):
+    add_unshared_portfolio(servicecatalog)
+    servicecatalog.add_response(
+        "list_provisioning_artifacts",
+        {
+            "ProvisioningArtifactDetails": [
+                {"Id": "pa-1", "CreatedTime": datetime.datetime(2020, 1, 1)}
+            ]
+        },
+        {"AcceptLanguage": "en", "ProductId": "prod-old"},
+    )
+
+    plan = sync_catalog.plan_portfolio_sync(
+        config=get_config("new.yaml"),
+        added_files=[],
+        modified_files=[],
+        deleted_files=[],
+        inventory=get_inventory(old="prod-old"),
+        constraints=get_constraints(),
+        renamed_files=[[PRODUCTS_PATH + "old.yaml", PRODUCTS_PATH + "new.yaml"]],
+    )
+
+    assert [action.to_dict() for action in plan.actions] == [
+        sync_catalog.SyncAction(
+            operation=sync_catalog.SyncAction.UPDATE,
+            template=PRODUCTS_PATH + "new.yaml",
+            product_id="prod-old",
+            template_hash="hash",
+            create_launch_constraint=True,
+            previous_template=PRODUCTS_PATH + "old.yaml",
+        ).to_dict()
+    ]
+    restored = sync_catalog.SyncAction.from_dict(plan.actions[0].to_dict())
+    assert restored.previous_product_key == "old"
+
+
+def test_apply_update_renames_product(servicecatalog, s3):
+    action = sync_catalog.SyncAction(
+        operation=sync_catalog.SyncAction.UPDATE,
+        template=PRODUCTS_PATH + "new.yaml",
+        product_id="prod-old",
+        template_hash="hash",
+        template_uploaded=True,
+        previous_template=PRODUCTS_PATH + "old.yaml",
+    )
+    servicecatalog.add_response(
+        "create_provisioning_artifact", {"ProvisioningArtifactDetail": {"Id": "pa-2"}},
+    )
+    servicecatalog.add_response(
+        "update_provisioning_artifact",
+        {},
+        {
+            "AcceptLanguage": "en",
+            "ProductId": "prod-old",
+            "ProvisioningArtifactId": "pa-2",
+            "Name": "v2",
+            "Description": "Changes",
+            "Active": True,
+            "Guidance": "DEFAULT",
+        },
+    )
+    servicecatalog.add_response(
+        "update_product",
+        {},
+        {
+            "AcceptLanguage": "en",
+            "Id": "prod-old",
+            "Name": "new",
+            "Owner": "Platform",
+            "Description": "Description",
+            "SupportDescription": "Support",
+            "SupportEmail": "support@example.com",
+            "SupportUrl": "https://example.com",
+        },
+    )
+    s3.add_response(
+        "put_object_tagging",
+        {},
+        {
+            "Bucket": "bucket",
+            "Key": "templates/new.yaml",
+            "Tagging": {
+                "TagSet": [{"Key": sync_catalog.TEMPLATE_HASH_TAG, "Value": "hash"}]
+            },
+        },
+    )
+    inventory = get_inventory(old="prod-old")
+
+    sync_catalog.apply_update(
+        action=action,
+        config=get_config("new.yaml"),
+        portfolio_id="port-1",
+        inventory=inventory,
+        constraints=get_constraints(),
+    )
+
+    assert inventory.get_product_id("old") is None
+    assert inventory.get_product_id("new") == "prod-old"
+
+
+def get_work_item(action):
+    """Build the work item, which dispatch_plan() publishes for an action."""
+    config = get_config(action.file_name)
+    return {
+        "PortfolioId": "port-1",
+        "Action": action.to_dict(),
+        "Config": dict(config.items(action.file_name, raw=True)),
+        "ResultKey": sync_catalog.get_result_key("fanout-1", action.template),
+    }
+
+
+def add_create_result(s3, work_item):
+    """Stub the calls, which store the hash and the result of a successful create."""
+    s3.add_response(
+        "put_object_tagging",
+        {},
+        {
+            "Bucket": "bucket",
+            "Key": "templates/a.yaml",
+            "Tagging": {
+                "TagSet": [{"Key": sync_catalog.TEMPLATE_HASH_TAG, "Value": "hash"}]
+            },
+        },
+    )
+    s3.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "bucket",
+            "Key": work_item["ResultKey"],
+            "Body": json.dumps(
+                {"Template": PRODUCTS_PATH + "a.yaml", "Error": None}
+            ).encode("utf-8"),
+        },
+    )
+
+
+@pytest.fixture
+def create_work_item():
+    """Work item of a create, whose template has been uploaded by dispatch_plan()."""
+    return get_work_item(
+        sync_catalog.SyncAction(
+            operation=sync_catalog.SyncAction.CREATE,
+            template=PRODUCTS_PATH + "a.yaml",
+            template_hash="hash",
+            create_launch_constraint=True,
+            template_uploaded=True,
+        )
+    )
+
+
+def test_process_work_items_marks_creates_as_started(
+    servicecatalog, s3, create_work_item
+):
+    started_key = sync_catalog.get_started_key(create_work_item["ResultKey"])
+    for key in [create_work_item["ResultKey"], started_key]:
+        s3.add_client_error(
+            "get_object",
+            service_error_code="NoSuchKey",
+            http_status_code=404,
+            expected_params={"Bucket": "bucket", "Key": key},
+        )
+    s3.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "bucket",
+            "Key": started_key,
+            "Body": json.dumps(
+                {"Template": PRODUCTS_PATH + "a.yaml", "Error": None}
+            ).encode("utf-8"),
+        },
+    )
+    servicecatalog.add_response(
+        "create_product",
+        {"ProductViewDetail": {"ProductViewSummary": {"ProductId": "prod-a"}}},
+    )
+    servicecatalog.add_response(
+        "associate_product_with_portfolio",
+        {},
+        {"AcceptLanguage": "en", "ProductId": "prod-a", "PortfolioId": "port-1"},
+    )
+    servicecatalog.add_response(
+        "create_constraint",
+        {"ConstraintDetail": {"ConstraintId": "cons-a", "Type": "LAUNCH"}},
+    )
+    add_create_result(s3, create_work_item)
+
+    sync_catalog.process_work_items.__wrapped__(
+        {"Records": [{"body": json.dumps(create_work_item)}]}, None
+    )
+
+
+def test_process_work_items_resumes_interrupted_creates(
+    servicecatalog, s3, create_work_item
+):
+    s3.add_client_error(
+        "get_object",
+        service_error_code="NoSuchKey",
+        http_status_code=404,
+        expected_params={"Bucket": "bucket", "Key": create_work_item["ResultKey"]},
+    )
+    s3.add_response(
+        "get_object",
+        {"Body": io.BytesIO(b'{"Template": "a.yaml", "Error": null}')},
+        {
+            "Bucket": "bucket",
+            "Key": sync_catalog.get_started_key(create_work_item["ResultKey"]),
+        },
+    )
+    servicecatalog.add_response(
+        "search_products_as_admin",
+        {
+            "ProductViewDetails": [
+                {"ProductViewSummary": {"ProductId": "prod-ab", "Name": "a-b"}},
+                {"ProductViewSummary": {"ProductId": "prod-a", "Name": "A"}},
+            ]
+        },
+        {"AcceptLanguage": "en", "Filters": {"FullTextSearch": ["a"]}},
+    )
+    servicecatalog.add_response(
+        "list_constraints_for_portfolio",
+        {
+            "ConstraintDetails": [
+                {"ConstraintId": "cons-a", "Type": "LAUNCH", "ProductId": "prod-a"}
+            ]
+        },
+        {"AcceptLanguage": "en", "PortfolioId": "port-1", "ProductId": "prod-a"},
+    )
+    servicecatalog.add_response(
+        "associate_product_with_portfolio",
+        {},
+        {"AcceptLanguage": "en", "ProductId": "prod-a", "PortfolioId": "port-1"},
+    )
+    add_create_result(s3, create_work_item)
+
+    sync_catalog.process_work_items.__wrapped__(
+        {"Records": [{"body": json.dumps(create_work_item)}]}, None
+    )